@@ -0,0 +1,124 @@
+"""
+Benchmarks Model 2 scoring on a synthetic entity-annotated corpus, using an in-memory index.
+
+Input:
+    -output Results file (JSON)
+    -num_docs Number of documents in the corpus
+    -doc_length Average document length in terms
+    -entities_per_doc Average number of entity mentions per document
+    -num_entities Number of distinct entities
+    -num_queries Number of queries
+    -first_pass_num_docs Number of documents retrieved in the first pass
+    -doc_cache_size Size in bytes of Model2's document statistics cache, 0 to disable it
+
+Output:
+    JSON file with per-query latency, broken down by first pass, second pass, p(e|d) and aggregation
+
+@author: Tino Hakim Lazreg
+"""
+
+import argparse
+import json
+import platform
+import time
+
+from nordlys.preprocessor.benchmark_preprocessor import get_peak_rss, get_version
+from nordlys.preprocessor.clueweb_facc_scorer import Model2
+from nordlys.preprocessor.memory_index import MemoryIndex
+from nordlys.preprocessor.metrics import Metrics, percentile
+from nordlys.preprocessor.synthetic_data import SyntheticCorpusGenerator
+from nordlys.retrieval.lucene_tools import Lucene
+
+PHASES = Model2.PHASES
+
+
+def get_config(first_pass_num_docs, doc_cache_size=Model2.DEFAULT_DOC_CACHE_SIZE):
+    return {'field_id': Lucene.FIELDNAME_ID,
+            'smoothing_method': "dirichlet",
+            'model': "lm",
+            'first_pass_field': Lucene.FIELDNAME_CONTENTS,
+            'first_pass_num_docs': first_pass_num_docs,
+            'num_docs': 100,
+            'doc_cache_size': doc_cache_size,
+            'run_id': 1}
+
+
+def benchmark_queries(model2, queries):
+    """
+    Scores each query with Model 2, and returns the per-query timings.
+
+    :param model2: Model2 object
+    :param queries: List of (query_id, query) tuples
+    :return: List of dictionaries with the query id, total time and the time of each phase
+    """
+    timings = []
+    for q_id, query in queries:
+        model2.metrics = Metrics()
+        start = time.time()
+        p_q_e_all = model2.get_p_q_e(q_id, query)
+        timing = {'query_id': q_id,
+                  'query': query,
+                  'total': time.time() - start,
+                  'num_entities': len(p_q_e_all)}
+        for phase in PHASES:
+            timing[phase] = sum(seconds for _, seconds in model2.metrics.timers.get(phase, {}).values())
+        timings.append(timing)
+    return timings
+
+
+def summarize(timings):
+    summary = {}
+    for key in ["total"] + PHASES:
+        values = [timing[key] for timing in timings]
+        summary[key] = {'mean': sum(values) / len(values) if values else None,
+                        'p50': percentile(values, 50),
+                        'p90': percentile(values, 90),
+                        'p99': percentile(values, 99)}
+        print "\t%-12s mean=%.4fs p50=%.4fs p99=%.4fs" % (key, summary[key]['mean'], summary[key]['p50'],
+                                                        summary[key]['p99'])
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-output", help="Results file", default="bench_model2.json")
+    parser.add_argument("-num_docs", help="Number of documents", type=int, default=10000)
+    parser.add_argument("-doc_length", help="Average document length", type=int, default=500)
+    parser.add_argument("-entities_per_doc", help="Average entity mentions per document", type=int, default=20)
+    parser.add_argument("-num_entities", help="Number of distinct entities", type=int, default=10000)
+    parser.add_argument("-num_queries", help="Number of queries", type=int, default=50)
+    parser.add_argument("-first_pass_num_docs", help="First pass documents", type=int, default=1000)
+    parser.add_argument("-doc_cache_size", help="Document cache size in bytes", type=int,
+                        default=Model2.DEFAULT_DOC_CACHE_SIZE)
+    args = parser.parse_args()
+
+    print "Generating corpus..."
+    generator = SyntheticCorpusGenerator(num_entities=args.num_entities)
+    corpus = generator.generate_corpus(args.num_docs, args.doc_length, args.entities_per_doc)
+    start = time.time()
+    index = MemoryIndex(corpus)
+    index_time = time.time() - start
+    corpus = None
+    queries = generator.generate_queries(args.num_queries)
+
+    model2 = Model2(get_config(args.first_pass_num_docs, args.doc_cache_size), lucene=index)
+    model2._open_index()
+    timings = benchmark_queries(model2, queries)
+    print "Per-query latency:"
+    summary = summarize(timings)
+
+    with open(args.output, "w") as f:
+        json.dump({'version': get_version(),
+                   'python': platform.python_version(),
+                   'timestamp': time.time(),
+                   'params': vars(args),
+                   'index_time': index_time,
+                   'peak_rss_mb': get_peak_rss(),
+                   'summary': summary,
+                   'doc_cache': model2.doc_cache.stats() if model2.doc_cache is not None else None,
+                   'queries': timings}, f, indent=2, sort_keys=True)
+    print "Results written to " + args.output
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+"""
+Benchmarks the preprocessor on synthetic WARC and FACC data.
+
+Times WarcEntry.replace_entity_mentions, WarcEntry.create_replacement_content, WarcEntry.clean_full_text
+and read_and_clean_files end to end, for each combination of page size and annotation density.
+
+Input:
+    -output Results file (JSON)
+    -work_dir Directory for the generated data
+    -num_files Number of WARC files per scenario
+    -records_per_file Number of records per WARC file
+    -page_sizes Comma separated page sizes in bytes
+    -densities Comma separated annotation densities (mentions per KB)
+    -non_utf8_ratio Fraction of WINDOWS-1252 records
+    -offset_bug_ratio Fraction of annotations with offset bugs
+
+Output:
+    JSON file with records/sec, MB/s and peak RSS per benchmark and scenario. Each benchmark runs in its own
+    process, so the peak RSS is that of the benchmark, not of the benchmarks run before it.
+
+@author: Tino Hakim Lazreg
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+
+import warc
+
+from nordlys.preprocessor.clueweb_facc_preprocessor import Annotation, WarcEntry
+from nordlys.preprocessor.indexer import read_and_clean_files
+from nordlys.preprocessor.metrics import Metrics
+from nordlys.preprocessor.synthetic_data import SyntheticWarcGenerator
+
+
+def get_peak_rss():
+    """Returns the peak resident set size of this process in MB, over the lifetime of the process."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def get_version():
+    """Returns the current git revision, or None if it is not available."""
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_annotations(ann_path):
+    with open(ann_path) as ann_file:
+        return [Annotation.parse_annotation(line) for line in ann_file]
+
+
+def read_payloads(warc_path):
+    """Returns a list of (record_id, payload) for all records with a WARC-TREC-ID."""
+    warc_file = warc.open(warc_path)
+    payloads = []
+    record, payload, record_id = WarcEntry.read_record(warc_file.reader)
+    while record is not None:
+        if record_id is not None:
+            payloads.append((record_id, payload))
+        record, payload, record_id = WarcEntry.read_record(warc_file.reader)
+    warc_file.close()
+    return payloads
+
+
+def summarize(name, elapsed, num_records, num_bytes, metrics=None):
+    result = {'benchmark': name,
+              'seconds': elapsed,
+              'records': num_records,
+              'bytes': num_bytes,
+              'records_per_sec': num_records / elapsed if elapsed > 0 else None,
+              'mb_per_sec': num_bytes / 1048576.0 / elapsed if elapsed > 0 else None,
+              'peak_rss_mb': get_peak_rss()}
+    if metrics is not None:
+        result['metrics'] = metrics.snapshot()
+    print "\t" + name + ": %.2f records/sec, %.2f MB/s" % (result['records_per_sec'] or 0, result['mb_per_sec'] or 0)
+    return result
+
+
+def bench_replace_entity_mentions(files):
+    metrics = Metrics()
+    num_records = 0
+    num_bytes = 0
+    start = time.time()
+    for warc_path, ann_path, file_bytes in files:
+        warc_file = warc.open(warc_path)
+        warc_entry = WarcEntry(warc_path, warc_file, load_annotations(ann_path), metrics)
+        output_data = warc_entry.replace_entity_mentions()
+        warc_file.close()
+        num_records += len(output_data)
+        num_bytes += file_bytes
+    return summarize("replace_entity_mentions", time.time() - start, num_records, num_bytes, metrics)
+
+
+def bench_clean_full_text(files):
+    num_records = 0
+    num_bytes = 0
+    elapsed = 0.0
+    for warc_path, _, _ in files:
+        warc_entry = WarcEntry(warc_path, warc.open(warc_path), [])
+        payloads = read_payloads(warc_path)
+        start = time.time()
+        for _, payload in payloads:
+            warc_entry.clean_full_text(payload)
+        elapsed += time.time() - start
+        num_records += len(payloads)
+        num_bytes += sum(len(payload) for _, payload in payloads)
+        warc_entry.warc_file.close()
+    return summarize("clean_full_text", elapsed, num_records, num_bytes)
+
+
+def bench_create_replacement_content(files):
+    """Matches all annotations first, and only times create_replacement_content()."""
+    inputs = []
+    for warc_path, ann_path, _ in files:
+        warc_entry = WarcEntry(warc_path, warc.open(warc_path), [])
+        annotations = {}
+        for annotation in load_annotations(ann_path):
+            annotations.setdefault(annotation.trec_id, []).append(annotation)
+        for record_id, payload in read_payloads(warc_path):
+            annotation_list = {}
+            annotation_bytes = []
+            record_content = None
+            for annotation in annotations.get(record_id, []):
+                match, annotation_list, annotation_bytes = warc_entry.match_text(payload, annotation,
+                                                                                 annotation_list, annotation_bytes)
+                if match:
+                    record_content = match
+            if record_content is not None:
+                inputs.append((record_content, annotation_list, annotation_bytes))
+        warc_entry.warc_file.close()
+    start = time.time()
+    for record_content, annotation_list, annotation_bytes in inputs:
+        WarcEntry.create_replacement_content(record_content, annotation_list, annotation_bytes)
+    return summarize("create_replacement_content", time.time() - start, len(inputs),
+                     sum(len(record_content) for record_content, _, _ in inputs))
+
+
+def bench_read_and_clean_files(files):
+    metrics = Metrics()
+    num_records = 0
+    num_bytes = 0
+    start = time.time()
+    for warc_path, ann_path, file_bytes in files:
+        cleaned_records, worker_metrics = read_and_clean_files(os.path.basename(warc_path),
+                                                               os.path.basename(ann_path),
+                                                               os.path.dirname(warc_path),
+                                                               os.path.dirname(ann_path))
+        metrics.merge(worker_metrics)
+        num_records += len(cleaned_records)
+        num_bytes += file_bytes
+    return summarize("read_and_clean_files", time.time() - start, num_records, num_bytes, metrics)
+
+
+def run_in_child(benchmark, *args):
+    """Runs a benchmark function in a new child process, and returns its result."""
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(benchmark, args)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def run_scenario(work_dir, num_files, records_per_file, page_size, density, non_utf8_ratio, offset_bug_ratio):
+    """Generates the data for one scenario, and runs all benchmarks on it."""
+    generator = SyntheticWarcGenerator(page_size=page_size, annotation_density=density,
+                                       non_utf8_ratio=non_utf8_ratio, offset_bug_ratio=offset_bug_ratio)
+    scenario_dir = os.path.join(work_dir, "p%d_d%s" % (page_size, density))
+    if not os.path.isdir(scenario_dir):
+        os.makedirs(scenario_dir)
+    files = []
+    for i in range(num_files):
+        file_id = "0000tw-%02d" % i
+        warc_path = os.path.join(scenario_dir, file_id + ".warc.gz")
+        ann_path = os.path.join(scenario_dir, file_id + ".anns.tsv")
+        files.append((warc_path, ann_path, generator.generate_file(warc_path, ann_path, records_per_file, file_id)))
+
+    print "Scenario: page_size=" + str(page_size) + ", density=" + str(density)
+    results = [run_in_child(benchmark, files)
+               for benchmark in [bench_replace_entity_mentions, bench_create_replacement_content,
+                                 bench_clean_full_text, bench_read_and_clean_files]]
+    for result in results:
+        result.update({'page_size': page_size,
+                       'annotation_density': density,
+                       'non_utf8_ratio': non_utf8_ratio,
+                       'offset_bug_ratio': offset_bug_ratio})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-output", help="Results file", default="bench_preprocessor.json")
+    parser.add_argument("-work_dir", help="Directory for the generated data", default=None)
+    parser.add_argument("-num_files", help="Number of WARC files per scenario", type=int, default=2)
+    parser.add_argument("-records_per_file", help="Number of records per WARC file", type=int, default=200)
+    parser.add_argument("-page_sizes", help="Comma separated page sizes in bytes", default="5000,50000")
+    parser.add_argument("-densities", help="Comma separated annotations per KB", default="0.5,2")
+    parser.add_argument("-non_utf8_ratio", help="Fraction of WINDOWS-1252 records", type=float, default=0.1)
+    parser.add_argument("-offset_bug_ratio", help="Fraction of annotations with offset bugs", type=float,
+                        default=0.05)
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="nordlys_bench_")
+    results = []
+    try:
+        for page_size in [int(size) for size in args.page_sizes.split(",")]:
+            for density in [float(density) for density in args.densities.split(",")]:
+                results += run_scenario(work_dir, args.num_files, args.records_per_file, page_size, density,
+                                        args.non_utf8_ratio, args.offset_bug_ratio)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir)
+
+    with open(args.output, "w") as f:
+        json.dump({'version': get_version(),
+                   'python': platform.python_version(),
+                   'timestamp': time.time(),
+                   'results': results}, f, indent=2, sort_keys=True)
+    print "Results written to " + args.output
+
+
+if __name__ == '__main__':
+    main()
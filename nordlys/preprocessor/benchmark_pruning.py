@@ -0,0 +1,204 @@
+"""
+Measures the effect of static entity pruning (see entity_pruning) on Model 2.
+
+Each pruning setting is run over the same queries. For each setting, the size of the candidate entity
+set, the number and estimated memory of the kept document-entity associations, the scoring latency and
+the retrieval quality (MAP and P@10) are reported, together with the change from the unpruned setting
+("none", which is added if no setting disables pruning).
+
+The queries are scored once before timing, to warm up the index. The settings are then run -repeats times,
+in a rotated order each time, so that no setting is always timed first or after the same setting; the
+latencies are taken over all repeats.
+
+With -index_dir, queries are scored on a Lucene (or NumPy) index and evaluated against a qrels file,
+e.g. data/dbpedia_entity_test_collection_qrels/qrels-v3.9-freebase.txt. Without it, a synthetic corpus
+is used, and the top 10 entities of the ranking of the unpruned setting are used as relevant entities.
+
+Input:
+    -settings Pruning settings, e.g. none top_n=50 mass=0.9 top_n=50,mass=0.9
+    -index_dir Index directory (optional)
+    -backend Index backend, lucene or numpy
+    -query_file Queries to score, with -index_dir
+    -qrels Qrels file, with -index_dir
+    -output Results file (JSON)
+    -num_docs, -doc_length, -entities_per_doc, -num_entities, -num_queries Synthetic corpus (without -index_dir)
+    -first_pass_num_docs Number of documents retrieved in the first pass
+    -repeats Number of timed runs of each setting
+
+Output:
+    JSON file with the measurements of each setting
+
+@author: Tino Hakim Lazreg
+"""
+
+from __future__ import division
+
+import argparse
+import json
+import time
+
+from nordlys.preprocessor import run_file
+from nordlys.preprocessor.benchmark_model2 import get_config
+from nordlys.preprocessor.clueweb_facc_scorer import Model2
+from nordlys.preprocessor.doc_cache import estimate_size
+from nordlys.preprocessor.entity_pruning import is_pruning
+from nordlys.preprocessor.evaluation import evaluate, load_qrels
+from nordlys.preprocessor.memory_index import MemoryIndex
+from nordlys.preprocessor.metrics import percentile
+from nordlys.preprocessor.synthetic_data import SyntheticCorpusGenerator
+
+
+def parse_setting(setting):
+    """Parses a setting like "top_n=50,mass=0.9" into (top_n, mass). "none" disables pruning."""
+    top_n, mass = None, None
+    if setting != "none":
+        for option in setting.split(","):
+            name, value = option.split("=")
+            if name == "top_n":
+                top_n = int(value)
+            elif name == "mass":
+                mass = float(value)
+            else:
+                raise ValueError("Unknown pruning option: " + name)
+    return top_n, mass
+
+
+def summarize_latencies(latencies):
+    return {'latency_mean': sum(latencies) / len(latencies),
+            'latency_p50': percentile(latencies, 50),
+            'latency_p99': percentile(latencies, 99)}
+
+
+def run_setting(index, queries, first_pass_num_docs, top_n, mass, max_rank=100):
+    """
+    Scores the queries with one pruning setting.
+
+    :return: (measurements, run, latencies) where run is {query_id: [entity_id]} in the format of the qrels,
+             and latencies are the seconds of each query
+    """
+    config = get_config(first_pass_num_docs)
+    config['prune_top_n'] = top_n
+    config['prune_mass'] = mass
+    model2 = Model2(config, lucene=index)
+    model2._open_index()
+    latencies = []
+    candidates = []
+    doc_ids = set()
+    run = {}
+    for q_id, query in queries:
+        start = time.time()
+        p_q_e_all = model2.get_p_q_e(q_id, query)
+        latencies.append(time.time() - start)
+        candidates.append(len(p_q_e_all))
+        doc_ids.update(model2.candidates)
+        ranking = sorted(p_q_e_all.iteritems(), key=lambda (k, v): (v, k), reverse=True)[:max_rank]
+        run[q_id] = [run_file.get_freebase_url(entity_id) for (entity_id, _), _ in ranking]
+
+    # Associations of all documents that were candidates for at least one query
+    associations = 0
+    memory = 0
+    for doc_id in doc_ids:
+        p_e_d = model2.get_p_e_d(doc_id).get_scores_sorted()
+        associations += len(p_e_d)
+        memory += estimate_size(p_e_d)
+    measurements = {'top_n': top_n,
+                    'mass': mass,
+                    'mean_candidates': sum(candidates) / len(candidates),
+                    'associations': associations,
+                    'associations_mb': memory / 2 ** 20}
+    measurements.update(summarize_latencies(latencies))
+    return measurements, run, latencies
+
+
+def load_queries(path):
+    with open(path) as f:
+        return [line.rstrip("\n").split("\t") for line in f if line.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-settings", help="Pruning settings", nargs="+",
+                        default=["none", "top_n=100", "top_n=50", "top_n=20", "mass=0.9", "mass=0.75"])
+    parser.add_argument("-index_dir", help="Index directory", default=None)
+    parser.add_argument("-backend", help="Index backend (lucene or numpy)", default="lucene",
+                        choices=["lucene", "numpy"])
+    parser.add_argument("-query_file", help="Query file", default=None)
+    parser.add_argument("-qrels", help="Qrels file", default=None)
+    parser.add_argument("-output", help="Results file", default="bench_pruning.json")
+    parser.add_argument("-num_docs", help="Number of documents", type=int, default=5000)
+    parser.add_argument("-doc_length", help="Average document length", type=int, default=500)
+    parser.add_argument("-entities_per_doc", help="Average entity mentions per document", type=int, default=50)
+    parser.add_argument("-num_entities", help="Number of distinct entities", type=int, default=10000)
+    parser.add_argument("-num_queries", help="Number of queries", type=int, default=50)
+    parser.add_argument("-first_pass_num_docs", help="First pass documents", type=int, default=1000)
+    parser.add_argument("-repeats", help="Timed runs of each setting", type=int, default=3)
+    args = parser.parse_args()
+
+    qrels = None
+    if args.index_dir is not None:
+        if args.backend == "numpy":
+            from nordlys.preprocessor.numpy_index import NumpyIndex
+            index = NumpyIndex(args.index_dir)
+        else:
+            from nordlys.retrieval.index_cache import IndexCache
+            index = IndexCache(args.index_dir)
+        queries = load_queries(args.query_file)
+        qrels = load_qrels(args.qrels)
+    else:
+        print "Generating corpus..."
+        generator = SyntheticCorpusGenerator(num_entities=args.num_entities)
+        index = MemoryIndex(generator.generate_corpus(args.num_docs, args.doc_length, args.entities_per_doc))
+        queries = generator.generate_queries(args.num_queries)
+
+    settings = list(args.settings)
+    if all(is_pruning(*parse_setting(setting)) for setting in settings):
+        print "Adding the unpruned setting: none"
+        settings.insert(0, "none")
+    baseline_setting = [setting for setting in settings if not is_pruning(*parse_setting(setting))][0]
+
+    print "Warming up..."
+    run_setting(index, queries, args.first_pass_num_docs, None, None)
+    measured = {}
+    runs = {}
+    latencies = {setting: [] for setting in settings}
+    for repeat in range(args.repeats):
+        shift = repeat % len(settings)
+        for setting in settings[shift:] + settings[:shift]:
+            top_n, mass = parse_setting(setting)
+            print "Setting: " + setting + " (run " + str(repeat + 1) + " of " + str(args.repeats) + ")"
+            measurements, run, setting_latencies = run_setting(index, queries, args.first_pass_num_docs, top_n, mass)
+            latencies[setting].extend(setting_latencies)
+            if setting not in measured:
+                measurements['setting'] = setting
+                measured[setting] = measurements
+                runs[setting] = run
+    results = [measured[setting] for setting in settings]
+    for measurements in results:
+        measurements.update(summarize_latencies(latencies[measurements['setting']]))
+
+    if qrels is None:
+        # The unpruned ranking is the reference
+        qrels = {q_id: {entity_id: 1 for entity_id in ranking[:10]}
+                 for q_id, ranking in runs[baseline_setting].iteritems()}
+    for measurements in results:
+        measurements.update(evaluate(runs[measurements['setting']], qrels))
+
+    baseline = measured[baseline_setting]
+    print "%-22s %10s %12s %10s %10s %8s %8s" % ("setting", "candidates", "associations", "memory_mb",
+                                                  "latency_ms", "MAP", "P@10")
+    for measurements in results:
+        for key in ['mean_candidates', 'associations', 'associations_mb', 'latency_mean', 'map', 'p10']:
+            if baseline[key]:
+                measurements[key + "_change"] = measurements[key] / baseline[key] - 1
+        print "%-22s %10.1f %12d %10.2f %10.2f %8.4f %8.4f" % (
+            measurements['setting'], measurements['mean_candidates'], measurements['associations'],
+            measurements['associations_mb'], measurements['latency_mean'] * 1000, measurements['map'],
+            measurements['p10'])
+
+    with open(args.output, "w") as f:
+        json.dump({'params': vars(args), 'results': results}, f, indent=2, sort_keys=True)
+    print "Results written to " + args.output
+
+
+if __name__ == '__main__':
+    main()
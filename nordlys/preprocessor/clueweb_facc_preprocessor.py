@@ -7,39 +7,33 @@ Input:
     -warc_file ClueWeb file in .warc format
 
 Output:
-    Cleaned records with entity mentions replaced, as a gzip containing the .txt files.
+    Cleaned records with entity mentions replaced, as a shard per warc file (see shard_store).
     
 @author: Tino Hakim Lazreg
 """
 
-import logging
+import codecs
 import os
 import os.path
 import re
-from HTMLParser import HTMLParser
+import time
+from HTMLParser import HTMLParser, HTMLParseError
 from warc.utils import FilePart
 from warc import WARCRecord
 import cchardet as chardet
 from bs4 import BeautifulSoup
 from unidecode import unidecode
 
+from nordlys.preprocessor.metrics import Metrics
+from nordlys.preprocessor.mismatch_log import log_mismatch, mismatch_logging_enabled
+from nordlys.preprocessor.shard_store import ShardWriter, get_shard_path
+
 ex_ws_re = re.compile('\\s+')
 ex_non_alpha_re = re.compile('\\W+')
 ex_punct_re = re.compile('[\\.,;:]+')
 
-# Create logger
-logger = logging.getLogger('')
-logger.setLevel(logging.DEBUG)
-# filehandle = logging.FileHandler('ClueWeb_B13_logger.csv')
-filehandle = logging.FileHandler('records_indexed_fix.csv')
-filehandle.setLevel(logging.DEBUG)
-# Create formatter
-formatter = logging.Formatter('%(name)s,%(message)s')
-filehandle.setFormatter(formatter)
-logger.addHandler(filehandle)
-
-
-# CSV format: Document id, annotation entity mention, found entity in document, cleaned entity, cleaned annotation
+# Size of the chunks oversized payloads are read and stripped in
+STREAM_CHUNK_SIZE = 64 * 1024
 
 
 class Annotation(object):
@@ -77,12 +71,74 @@ class Annotation(object):
         return Annotation(cols[0], cols[1], cols[2], cols[3], cols[4], cols[7])
 
 
+class TagStripper(HTMLParser):
+    """
+    Incremental HTML tag stripper, used for payloads too large to be parsed with BeautifulSoup.
+    Text inside script-, style- and sup-tags is dropped, like in WarcEntry.strip_tags.
+
+    :param max_text_size: Maximum number of characters of text kept
+    """
+    skip_tags = ("script", "style", "sup")
+
+    def __init__(self, max_text_size=None):
+        HTMLParser.__init__(self)
+        self.text = []
+        self.text_size = 0
+        self.max_text_size = max_text_size
+        self.skip_depth = 0
+        # True if text was dropped, because max_text_size was reached
+        self.truncated = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.skip_tags:
+            self.skip_depth += 1
+
+    def handle_endtag(self, tag):
+        if tag in self.skip_tags and self.skip_depth > 0:
+            self.skip_depth -= 1
+
+    def handle_data(self, data):
+        if self.skip_depth > 0:
+            return
+        if self.max_text_size is None or self.text_size < self.max_text_size:
+            self.text.append(data)
+            self.text_size += len(data)
+        elif data.strip():
+            self.truncated = True
+
+    def handle_entityref(self, name):
+        self.handle_data(self.unescape("&" + name + ";"))
+
+    def handle_charref(self, name):
+        self.handle_data(self.unescape("&#" + name + ";"))
+
+    def get_text(self):
+        return u"".join(self.text)
+
+
 class WarcEntry(object):
-    def __init__(self, warc_path, warc_file, annotation_list):
+    def __init__(self, warc_path, warc_file, annotation_list, metrics=None, skip_ids=None, max_payload_size=None):
+        """
+        :param skip_ids: Set of TREC-IDs of records that are neither matched nor cleaned, e.g. the duplicates found
+                         by indexer.find_folder_duplicates()
+        :param max_payload_size: Payloads larger than this number of bytes are not read into memory, but
+                                 stripped incrementally. Their entity mentions are not replaced, and their
+                                 cleaned text is cut to max_payload_size characters. None for no limit.
+        """
         self.warc_path = warc_path
         self.warc_file = warc_file
         self.reader = self.warc_file.reader
         self.annotation_list = annotation_list
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.skip_ids = skip_ids
+        self.max_payload_size = max_payload_size
+        # Cleaned text of the current record, if its payload was too large to be read into memory
+        self.oversized_text = None
+        # True if the current record is a duplicate, which is neither matched nor cleaned
+        self.duplicate = False
+        # Payload of the current record, whether it is valid UTF-8, and its last record content with the
+        # (decode, encode) encodings of it, see get_record_content()
+        self.content_cache = (None, None, None, None)
 
     @staticmethod
     def strip_tags(text):
@@ -149,25 +205,30 @@ class WarcEntry(object):
             folded_text.append(c)
         return ''.join(folded_text)
 
-    @staticmethod
-    def write_record(output_data, output_dir):
+    def write_record(self, output_data, output_dir):
         """
-        Cleans the record payload, and writes it to a .txt file.
+        Writes the cleaned records of the warc file to one shard in output_dir, see shard_store.
 
         :param output_dir: Output directory
-        :param output_data: Dictionary containing record_id and payload
+        :param output_data: List of dictionaries containing record_id, replaced_record, cleaned_record
+                            and entities_record
+        :return: Path of the shard
         """
-
         if not os.path.isdir(output_dir):
-            os.makedirs(output_dir)
-
-        for record in output_data:
-            fname = os.path.join(output_dir, record['record_id'] + "replaced.txt")
-            with open(fname, "w") as f:
-                f.write(record['replaced_record'])
-            fname = os.path.join(output_dir, record['record_id'] + "cleaned.txt")
-            with open(fname, "w") as f:
-                f.write(record['cleaned_record'])
+            try:
+                os.makedirs(output_dir)
+            except OSError:
+                # Created by another worker process
+                if not os.path.isdir(output_dir):
+                    raise
+
+        start = time.time()
+        shard_path = get_shard_path(output_dir, self.warc_path)
+        with ShardWriter(shard_path) as shard:
+            for record in output_data:
+                shard.write(record)
+        self.metrics.add_time('write_shard', time.time() - start)
+        return shard_path
 
     def clean_text(self, text):
         """
@@ -206,15 +267,65 @@ class WarcEntry(object):
         return text
 
     def clean_full_text(self, text):
+        start = time.time()
         text = text.decode('utf-8', 'replace')
         # Find index of <head>, and remove everything before that index
         i = text.find('<head')
         if i > 0:
             text = text[i:]
+        self.metrics.add_time('decode', time.time() - start)
+        start = time.time()
         text = self.strip_tags(text)
+        self.metrics.add_time('strip_tags', time.time() - start)
+        start = time.time()
         text = unidecode(text)
         text = ex_ws_re.sub(" ", text)
-        return text.lower()
+        text = text.lower()
+        self.metrics.add_time('normalize', time.time() - start)
+        return text
+
+    def clean_oversized_payload(self, payload_stream):
+        """
+        Cleans an oversized payload like clean_full_text(), reading and stripping it in chunks, so the
+        memory used is bounded by the chunk size and the size of the text. The text is cut to max_payload_size
+        characters, and its entity mentions are not replaced. Records whose text is cut are counted in the
+        oversized_truncated metric.
+
+        :param payload_stream: File-like object with the payload, e.g. a FilePart
+        :return: cleaned text
+        """
+        start = time.time()
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        stripper = TagStripper(self.max_payload_size)
+        head_found = False
+        try:
+            chunk = payload_stream.read(STREAM_CHUNK_SIZE)
+            while chunk:
+                text = decoder.decode(chunk)
+                if not head_found:
+                    # Remove everything before <head>, like clean_full_text()
+                    i = text.find('<head')
+                    if i > 0:
+                        text = text[i:]
+                    head_found = True
+                stripper.feed(text)
+                chunk = payload_stream.read(STREAM_CHUNK_SIZE)
+            stripper.close()
+        except HTMLParseError:
+            # Keep the text stripped so far, and skip the rest of the payload
+            while payload_stream.read(STREAM_CHUNK_SIZE):
+                pass
+            stripper.truncated = True
+        if stripper.truncated:
+            self.metrics.incr('oversized_truncated')
+        text = stripper.get_text()
+        self.metrics.add_time('strip_tags_incremental', time.time() - start)
+        start = time.time()
+        text = unidecode(text)
+        text = ex_ws_re.sub(" ", text)
+        text = text.lower()
+        self.metrics.add_time('normalize', time.time() - start)
+        return text
 
     def match_text(self, payload, annotation, annotation_list, annotation_bytes):
         """
@@ -310,6 +421,39 @@ class WarcEntry(object):
             end_pos = annotation.end_pos - 24
         return start_pos, end_pos
 
+    def get_record_content(self, payload, decode_encoding, encode_encoding):
+        """
+        Returns the payload decoded with decode_encoding, and encoded with encode_encoding.
+        Only the content of the last encodings is kept, so at most one copy of the payload is held, and
+        consecutive annotations matched with the same encodings do not decode the payload again.
+        A valid UTF-8 payload is returned as-is when it is decoded and encoded as UTF-8, to avoid a full copy.
+        Whether the payload is valid UTF-8 is only checked once per payload.
+        """
+        cached_payload, utf8_valid, cached_key, record_content = self.content_cache
+        if cached_payload is not payload:
+            utf8_valid, cached_key, record_content = None, None, None
+        if decode_encoding.lower() in ("utf-8", "utf8"):
+            decode_encoding = "utf-8"
+        key = (decode_encoding, encode_encoding)
+        if key == cached_key:
+            return record_content
+        # Release the previous content before decoding
+        record_content = None
+        self.content_cache = (None, None, None, None)
+        if key == ("utf-8", "utf-8"):
+            if utf8_valid is None:
+                try:
+                    payload.decode("utf-8")
+                    utf8_valid = True
+                except UnicodeDecodeError:
+                    utf8_valid = False
+            if utf8_valid:
+                record_content = payload
+        if record_content is None:
+            record_content = bytearray(payload.decode(decode_encoding, 'replace'), encode_encoding)
+        self.content_cache = (payload, utf8_valid, key, record_content)
+        return record_content
+
     def find_entity_mention(self, payload, annotation, encoding, annotation_list,
                             annotation_bytes, encodings):
         """
@@ -329,17 +473,13 @@ class WarcEntry(object):
         problem_encodings = ["EUC_KR", "GB18030", "SHIFT_JIS", "ISO-8859-1", "BIG5", "EUC-JP", "GB", "GB18_bug", "win",
                              "GB18030_bug", "win_bug", "html_bug", "clueweb16_bug", "clueweb12_bug"]
 
-        if encoding in problem_encodings:
-            record_content = payload.decode("utf-8", 'replace')
-            problem_encoding = True
-        else:
-            record_content = payload.decode(encoding, 'replace')
-            problem_encoding = False
-
-        if encoding == "utf-8-sig":
-            record_content = bytearray(record_content, 'utf-8-sig')
-        else:
-            record_content = bytearray(record_content, 'utf-8')
+        self.metrics.incr('match_probes', label=encoding)
+        start = time.time()
+        problem_encoding = encoding in problem_encodings
+        decode_encoding = "utf-8" if problem_encoding else encoding
+        encode_encoding = "utf-8-sig" if encoding == "utf-8-sig" else "utf-8"
+        record_content = self.get_record_content(payload, decode_encoding, encode_encoding)
+        self.metrics.add_time('decode', time.time() - start)
 
         if problem_encoding:
             start_pos, end_pos = self.fix_annotation_offset(encoding, annotation)
@@ -353,7 +493,9 @@ class WarcEntry(object):
             start_pos = annotation.start_pos
             end_pos = annotation.end_pos
 
-        found_entity = record_content[start_pos:end_pos]
+        # Only the bytes of the mention are copied out of the record content
+        content = memoryview(record_content)
+        found_entity = content[start_pos:end_pos].tobytes()
 
         try:
             cleaned_entity = self.clean_text(found_entity)
@@ -365,6 +507,7 @@ class WarcEntry(object):
             return False
 
         if cleaned_entity == cleaned_ann:
+            self.metrics.incr('match_hits', label=encoding)
             # Update encoding in object, in case another encoding was used
             annotation.encoding = encoding
             # Use start_pos of annotation as key, and freebase_id as value
@@ -376,28 +519,49 @@ class WarcEntry(object):
             if annotation.all_encodings_tried:
                 annotation.start_pos += 32768
                 annotation.end_pos += 32768
-                found_entity = record_content[start_pos + 32768:end_pos + 32768]
-                cleaned_entity = self.clean_text(found_entity)
-                cleaned_entity = self.remove_non_words(cleaned_entity)
-                logger.warn(str(annotation.trec_id) + ', ' + str(self.warc_path) + ', ' +
-                            str(annotation.entity_mention) + ', ' + str(found_entity) +
-                            ', ' + str(cleaned_entity) + ', ' + str(cleaned_ann))
+                # Only build the mismatch record if an entry point has configured mismatch logging
+                if mismatch_logging_enabled():
+                    found_entity = content[start_pos + 32768:end_pos + 32768].tobytes()
+                    cleaned_entity = self.clean_text(found_entity)
+                    cleaned_entity = self.remove_non_words(cleaned_entity)
+                    log_mismatch(annotation.trec_id, self.warc_path, annotation.entity_mention, found_entity,
+                                 cleaned_entity, cleaned_ann)
             return False, annotation_list, annotation_bytes
 
     @staticmethod
     def create_replacement_content(record_content, annotation_list, annotation_bytes):
+        """
+        Returns the record content, with the bytes of the annotations (annotation_bytes) removed, and the
+        freebase_id of each annotation (annotation_list) inserted at its start position.
+        The bytes between annotations are copied through a memoryview, without intermediate copies.
+        """
         replacement_content = bytearray()
-        for count, byte in enumerate(record_content):
-            # List containing all bytes in range(start_pos, end_pos) for the annotations
-            if count not in annotation_bytes:
-                replacement_content.append(byte)
-            else:
-                if count in annotation_list:  # dict containing start_pos of all annotations
-                    replacement_content += annotation_list[count]
+        content = memoryview(record_content)
+        content_length = len(record_content)
+        prev = 0
+        # Positions of all bytes in range(start_pos, end_pos) for the annotations
+        for count in sorted(set(annotation_bytes)):
+            if count < 0:
+                continue
+            if count >= content_length:
+                break
+            if count > prev:
+                replacement_content += content[prev:count]
+            if count in annotation_list:  # dict containing start_pos of all annotations
+                replacement_content += annotation_list[count]
+            prev = count + 1
+        replacement_content += content[prev:]
         return replacement_content
 
     @staticmethod
-    def read_record(warc_reader):
+    def read_record(warc_reader, max_payload_size=None):
+        """
+        Reads the next record.
+        :param warc_reader: WARCReader
+        :param max_payload_size: If the payload is larger, it is not read, and payload is None.
+                                 It can then be read from record.payload.
+        :return: record, payload, record_id
+        """
         warc_reader.finish_reading_current_record()
         fileobj = warc_reader.fileobj
         try:
@@ -408,11 +572,70 @@ class WarcEntry(object):
         if header is None:
             return None, None, None
         warc_reader.current_payload = FilePart(fileobj, header.content_length)
-        payload = warc_reader.current_payload.read()
+        if max_payload_size is not None and header.content_length > max_payload_size:
+            payload = None
+        else:
+            payload = warc_reader.current_payload.read()
         record_id = header.get('WARC-TREC-ID', None)
         record = WARCRecord(header, warc_reader.current_payload, defaults=False)
         return record, payload, record_id
 
+    def _read_next_record(self):
+        """
+        Reads the next record from the warc file, and updates the read metrics.
+        """
+        start = time.time()
+        self.content_cache = (None, None, None, None)
+        self.oversized_text = None
+        self.duplicate = False
+        record, payload, record_id = self.read_record(self.reader, self.max_payload_size)
+        self.metrics.add_time('read_record', time.time() - start)
+        if payload is not None:
+            self.metrics.incr('records_read')
+            self.metrics.incr('bytes_read', len(payload))
+            if record_id is not None and self.is_duplicate(record_id):
+                # Drop the payload before the annotations of the record are matched
+                self.duplicate = True
+                payload = None
+        elif record is not None:
+            self.metrics.incr('records_read')
+            self.metrics.incr('bytes_read', record.header.content_length)
+            if record_id is not None:
+                self.metrics.incr('oversized_records')
+                self.oversized_text = self.clean_oversized_payload(record.payload)
+            else:
+                # Skip the payload in chunks, instead of letting the reader read it into memory
+                while record.payload.read(STREAM_CHUNK_SIZE):
+                    pass
+        return record, payload, record_id
+
+    def is_duplicate(self, record_id):
+        """
+        :return: True if the record is one of the duplicates in skip_ids
+        """
+        if not self.skip_ids or record_id not in self.skip_ids:
+            return False
+        self.metrics.incr('duplicates_skipped')
+        return True
+
+    def _match_text(self, payload, annotation, annotation_list, annotation_bytes):
+        """
+        Calls match_text(), and updates the matching metrics.
+        """
+        start = time.time()
+        result = self.match_text(payload, annotation, annotation_list, annotation_bytes)
+        self.metrics.add_time('match', time.time() - start)
+        return result
+
+    def _create_replacement_content(self, record_content, annotation_list, annotation_bytes):
+        """
+        Calls create_replacement_content(), and updates the replacement metrics.
+        """
+        start = time.time()
+        replacements = self.create_replacement_content(record_content, annotation_list, annotation_bytes)
+        self.metrics.add_time('replace', time.time() - start)
+        return replacements
+
     def replace_entity_mentions(self):
         """ Traverses all records in a warc_file and finds the corresponding annotations.
         """
@@ -432,20 +655,29 @@ class WarcEntry(object):
         output_data = []
         annotation_list = {}
         annotation_bytes = []
-        record, warc_payload, record_id = self.read_record(self.reader)
+        record, warc_payload, record_id = self._read_next_record()
 
         while record is not None:
             if record_id is None:
-                record, warc_payload, record_id = self.read_record(self.reader)
+                record, warc_payload, record_id = self._read_next_record()
                 replaced_payload = None
             if record_id == ann.trec_id:
-                entity_found, annotation_list, annotation_bytes = self.match_text(warc_payload, ann, annotation_list,
-                                                                                  annotation_bytes)
+                if self.duplicate:
+                    # Annotations of duplicates are skipped without matching
+                    entity_found = False
+                elif warc_payload is not None:
+                    entity_found, annotation_list, annotation_bytes = self._match_text(warc_payload, ann,
+                                                                                       annotation_list,
+                                                                                       annotation_bytes)
+                else:
+                    # Oversized payload, entity mentions are not replaced
+                    entity_found = False
+                    self.metrics.incr('oversized_annotations')
                 if entity_found:
                     replaced_payload = entity_found
                     entities_record += ann.freebase_id
                     entity_found_count += 1
-                elif not entity_found:
+                elif not self.duplicate:
                     entity_not_found_count += 1
                 try:
                     ann = ann_iter.next()
@@ -458,7 +690,8 @@ class WarcEntry(object):
                     ann_end = True
             if ann.trec_id > record_id or ann_end:
                 if replaced_payload:
-                    replacements = self.create_replacement_content(replaced_payload, annotation_list, annotation_bytes)
+                    replacements = self._create_replacement_content(replaced_payload, annotation_list,
+                                                                    annotation_bytes)
                     # Delete contents in annotation_list and annotation_bytes
                     annotation_list.clear()
                     del annotation_bytes[:]
@@ -467,8 +700,7 @@ class WarcEntry(object):
                     replacements = None
                 else:
                     if warc_payload is not None:
-                        record_content = warc_payload.decode('utf-8', 'replace')
-                        record_content = bytearray(record_content, 'utf-8')
+                        record_content = self.get_record_content(warc_payload, 'utf-8', 'utf-8')
                         cleaned_replaced_record = self.clean_full_text(record_content)
                         record_content = None
                 if warc_payload is not None: 
@@ -477,12 +709,20 @@ class WarcEntry(object):
                                         'replaced_record': cleaned_replaced_record,
                                         'cleaned_record': cleaned_record,
                                         'entities_record' : entities_record})
+                elif self.oversized_text is not None:
+                    output_data.append({'record_id': record_id,
+                                        'replaced_record': self.oversized_text,
+                                        'cleaned_record': self.oversized_text,
+                                        'entities_record': entities_record})
                 entities_record = ""
                 cleaned_record = None
                 cleaned_replaced_record = None
                 warc_payload = None
-                record, warc_payload, record_id = self.read_record(self.reader)
+                record, warc_payload, record_id = self._read_next_record()
 
+        self.metrics.incr('entities_found', entity_found_count)
+        self.metrics.incr('entities_not_found', entity_not_found_count)
+        self.metrics.incr('records_cleaned', len(output_data))
         print "Entities found: " + str(entity_found_count)
         print "Entities NOT found: " + str(entity_not_found_count)
         return output_data
@@ -3,6 +3,9 @@ Implements Model 2.
 
 Scores a set of queries using a provided Lucene index.
 
+Input:
+    -resume Resume an interrupted run in output_file, instead of overwriting it
+
 Output:
     Run file with scores for the provided queries
 
@@ -11,8 +14,17 @@ Output:
 
 from __future__ import division
 
+import argparse
 import math
-
+import os
+import time
+from StringIO import StringIO
+
+from nordlys.preprocessor import run_file
+from nordlys.preprocessor.doc_cache import CachedIndex, LRUCache
+from nordlys.preprocessor.entity_pruning import is_pruning, prune_entities
+from nordlys.preprocessor.federated_index import SIMILARITY_LUCENE, FederatedIndex
+from nordlys.preprocessor.metrics import Metrics
 from nordlys.retrieval.index_cache import IndexCache
 from nordlys.retrieval.lucene_tools import Lucene
 from nordlys.retrieval.results import RetrievalResults
@@ -22,14 +34,46 @@ from nordlys.retrieval.scorer import Scorer
 class Model2(object):
     """ Model2 scorer """
 
-    FREEBASE_URL = "<http://rdf.freebase.com/ns/entity_id>"
+    FREEBASE_URL = run_file.FREEBASE_URL
     SCORER_DEBUG = False
+    DEFAULT_DOC_CACHE_SIZE = 512 * 1024 * 1024
+    # Timed phases of each query
+    PHASES = ["first_pass", "second_pass", "p_e_d", "aggregation"]
 
-    def __init__(self, config):
+    def __init__(self, config, lucene=None):
+        """
+        :param config: Configuration dictionary. Optional keys:
+                       'doc_cache_size': size in bytes of the per-document statistics cache, 0 to disable it
+                       'candidates_file': first-pass candidates of each query are written to this file
+                       'warm_candidates_file': candidates file of a previous run, used to warm the cache
+                       'index_dirs': shard indexes scored as one index (see federated_index), instead of index_dir
+                       'federated_depth': candidates retrieved per shard, as a multiple of first_pass_num_docs
+                       'federated_similarity': similarity of the shards, "lucene" (default) or "dirichlet"
+                       'smoothing_param': Dirichlet smoothing parameter, also used to rescore the shards
+                       'prune_top_n', 'prune_mass': static pruning of the entities of each document (see entity_pruning)
+                       'resume': resume an interrupted run in output_file, instead of overwriting it
+        :param lucene: Index to score against, defaults to an IndexCache of config['index_dir']
+        """
         # TODO: Set config parameters like in retrieval.py
         self.config = config
         self.queries = []
-        self.lucene = IndexCache(self.config['index_dir'])
+        if lucene is None:
+            if self.config.get('index_dirs'):
+                lucene = FederatedIndex([IndexCache(index_dir) for index_dir in self.config['index_dirs']],
+                                        depth=self.config.get('federated_depth', 2),
+                                        mu=self.config.get('smoothing_param', 2000),
+                                        similarity=self.config.get('federated_similarity', SIMILARITY_LUCENE))
+            else:
+                lucene = IndexCache(self.config['index_dir'])
+        self.lucene = lucene
+        self.metrics = Metrics()
+        # Per-document statistics are shared by all queries of a run
+        self.doc_cache = None
+        cache_size = self.config.get('doc_cache_size', self.DEFAULT_DOC_CACHE_SIZE)
+        if cache_size:
+            self.doc_cache = LRUCache(cache_size)
+            self.lucene = CachedIndex(self.lucene, self.doc_cache)
+        self.candidates = []
 
     def _load_queries(self):
         """
@@ -86,32 +130,18 @@ class Model2(object):
 
     @staticmethod
     def write_trec_format(query_id, run_id, out, p_q_e, max_rank=100):
-        """Outputs results in TREC format
-
-        :param query_id:
-        :param run_id:
-        :param out: Opened output file
-        :param p_q_e: p(q|e) probabilities for the given query
-        :param max_rank:
-        """
-        rank = 1
-        # Sort p_q_e_iteritems() by score
-        for entity_query_id, score in sorted(p_q_e.iteritems(), key=lambda (k, v): (v, k), reverse=True):
-            entity_id, q_id = entity_query_id
-            # Need to transform the entity_id to the correct format as in qrels
-            entity_id = entity_id[1:].replace("_", ".", 1)
-            entity_id = Model2.FREEBASE_URL.replace("entity_id", entity_id)
-            if rank <= max_rank:
-                out.write(
-                        query_id + "\tQ0\t" + entity_id + "\t" + str(rank) + "\t" + str(score) + "\t" + str(
-                            run_id) + "\n")
-            rank += 1
+        """Outputs results in TREC format, see run_file.write_trec_format()"""
+        run_file.write_trec_format(query_id, run_id, out, p_q_e, max_rank)
 
     def retrieve_entities(self, lucene_doc_id, field, term_freq):
         """ 
         Retrieves all entities associated with a document
 
         """
+        if self.doc_cache is not None:
+            cached = self.doc_cache.get(("entities", lucene_doc_id, field))
+            if cached is not None:
+                return cached
         doc_term_vector = self.lucene.get_doc_termvector(lucene_doc_id, field)
         entities = []
         num_entity_mentions = 0
@@ -121,6 +151,8 @@ class Model2(object):
                 num_entity_mentions += term_freq[term]
         if self.SCORER_DEBUG:
             print "\t\t num_entities =" + str(num_entity_mentions)
+        if self.doc_cache is not None:
+            self.doc_cache.put(("entities", lucene_doc_id, field), (entities, num_entity_mentions))
         return entities, num_entity_mentions
 
     def get_idf(self, entity, field):
@@ -143,12 +175,19 @@ class Model2(object):
         """
         field = "contents_annotated"
         p_e_d = RetrievalResults()
+        if self.doc_cache is not None:
+            cached = self.doc_cache.get(("p_e_d", doc_id))
+            if cached is not None:
+                for entity, p_e_d_score in cached:
+                    p_e_d.append(entity, p_e_d_score)
+                return p_e_d
         lucene_doc_id = self.lucene.get_lucene_document_id(doc_id)
         term_freq = self.lucene.get_doc_termfreqs(lucene_doc_id, field)
         if self.SCORER_DEBUG:
             print "\t\t doc_id: " + str(doc_id)
         entities, num_entity_mentions = self.retrieve_entities(lucene_doc_id, field, term_freq)
         # Calculate p_e_d for each entity associated with the document
+        scores = []
         for entity in entities:
             tf_entity = term_freq[entity] / num_entity_mentions
             # Normalize the score by using IDF
@@ -159,9 +198,16 @@ class Model2(object):
                 print "\t\t math.log(num_docs/doc_freq)=" + str(idf)
             # Final score
             p_e_d_score = tf_entity * idf
-            p_e_d.append(entity, p_e_d_score)
+            scores.append((entity, p_e_d_score))
             if self.SCORER_DEBUG:
                 print "\t\t p(e|d)= " + str(p_e_d_score)
+        top_n, mass = self.config.get('prune_top_n'), self.config.get('prune_mass')
+        if is_pruning(top_n, mass):
+            scores = prune_entities(scores, top_n, mass)
+        for entity, p_e_d_score in scores:
+            p_e_d.append(entity, p_e_d_score)
+        if self.doc_cache is not None:
+            self.doc_cache.put(("p_e_d", doc_id), p_e_d.get_scores_sorted())
         return p_e_d
 
     def get_p_q_d(self, query):
@@ -172,10 +218,14 @@ class Model2(object):
         """
         query = Lucene.preprocess(query)
         # score collection, to determine a set of relevant documents.
+        start = time.time()
         res_first_pass = self._first_pass_scoring(self.lucene, query)
+        self.metrics.add_time('first_pass', time.time() - start)
         # Use LM from scorer.py to calculate p(q|d)
+        start = time.time()
         scorer = Scorer.get_scorer(self.config['model'], self.lucene, query, self.config)
         p_q_d = self._second_pass_scoring(res_first_pass, scorer)
+        self.metrics.add_time('second_pass', time.time() - start)
         return p_q_d
 
     def get_p_q_e(self, q_id, query):
@@ -183,13 +233,48 @@ class Model2(object):
         Return p(q|e) probabilities for the documents in p(q|d)
 
         """
-        p_q_e_all = {}
         # get p(q|d) probs for top n documents
         print "scoring [" + q_id + "] " + query
-        p_q_d_all = self.get_p_q_d(query)   
+        p_q_d_all = self.get_p_q_d(query)
+        self.candidates = [doc_id for doc_id, _ in p_q_d_all.get_scores_sorted()]
+        return self._aggregate_p_q_e(q_id, p_q_d_all, self.get_p_e_d)
+
+    def get_p_q_e_batch(self, queries):
+        """
+        Returns p(q|e) probabilities for a batch of queries. p(e|d) is computed once for documents that
+        are candidates for several queries of the batch.
+
+        :param queries: List of (q_id, query) tuples
+        :return: Dictionary {q_id: p_q_e_all}
+        """
+        p_q_d_batch = []
+        for q_id, query in queries:
+            print "scoring [" + q_id + "] " + query
+            p_q_d_batch.append((q_id, self.get_p_q_d(query)))
+        p_e_d_batch = {}
 
+        def get_p_e_d(doc_id):
+            if doc_id not in p_e_d_batch:
+                p_e_d_batch[doc_id] = self.get_p_e_d(doc_id)
+            return p_e_d_batch[doc_id]
+
+        return {q_id: self._aggregate_p_q_e(q_id, p_q_d_all, get_p_e_d) for q_id, p_q_d_all in p_q_d_batch}
+
+    def _aggregate_p_q_e(self, q_id, p_q_d_all, get_p_e_d):
+        """
+        Returns p(q|e) probabilities, aggregated over the documents in p(q|d)
+
+        :param q_id: Query id
+        :param p_q_d_all: RetrievalResults object with p(q|d)
+        :param get_p_e_d: Function returning the p(e|d) RetrievalResults object of a document
+        """
+        p_q_e_all = {}
+        start = time.time()
+        p_e_d_time = 0
         for doc_id, p_q_d in p_q_d_all.get_scores_sorted():
-            p_e_d = self.get_p_e_d(doc_id)
+            p_e_d_start = time.time()
+            p_e_d = get_p_e_d(doc_id)
+            p_e_d_time += time.time() - p_e_d_start
             p_q_d = math.exp(p_q_d)
 
             if self.SCORER_DEBUG:
@@ -206,30 +291,104 @@ class Model2(object):
 
         # Take log of all scores in p(q|e)
         p_q_e_all.update({k: math.log(v) for k, v in p_q_e_all.items()})
+        self.metrics.add_time('p_e_d', p_e_d_time)
+        self.metrics.add_time('aggregation', time.time() - start - p_e_d_time)
 
         return p_q_e_all
 
+    def warm_cache(self, candidates_file):
+        """
+        Fills the document cache with the statistics of the candidates of a previous run, starting with the
+        documents that were candidates for the most queries, until the cache is full. Nothing is evicted while
+        warming, so the most popular documents stay cached. The cache statistics are reset afterwards, so they
+        only count the lookups of the run.
+
+        :param candidates_file: File with query_id<TAB>doc_id lines, written by score_all()
+        """
+        if self.doc_cache is None:
+            return
+        counts = {}
+        with open(candidates_file) as f:
+            for line in f:
+                doc_id = line.rstrip("\n").split("\t")[1]
+                counts[doc_id] = counts.get(doc_id, 0) + 1
+        print "Warming document cache..."
+        start = time.time()
+        self.doc_cache.evict = False
+        try:
+            for doc_id in sorted(counts, key=counts.get, reverse=True):
+                self.get_p_e_d(doc_id)
+                self.lucene.get_doc_termfreqs(self.lucene.get_lucene_document_id(doc_id),
+                                              self.config['first_pass_field'])
+                if self.doc_cache.is_full():
+                    break
+        finally:
+            self.doc_cache.evict = True
+            self.doc_cache.full = False
+        print "Document cache warmed in " + str(time.time() - start) + "s: " + str(self.doc_cache.stats())
+        self.doc_cache.reset_stats()
+
+    def _write_timing(self, timing_out, q_id, seconds, num_entities):
+        """Appends the total and per-phase time of a query to the timing log."""
+        phase_times = [sum(phase_seconds for _, phase_seconds in self.metrics.timers.get(phase, {}).values())
+                       for phase in self.PHASES]
+        timing_out.write("\t".join([q_id, repr(seconds), str(len(self.candidates)), str(num_entities)] +
+                                    [repr(phase_time) for phase_time in phase_times]) + "\n")
+        timing_out.flush()
+
     def score_all(self):
         """
         Scores all the given queries for the given index, using Model 2
 
+        Queries are appended to the output file as they are completed. With config['resume'], the output file of an
+        interrupted run is resumed, and only the queries that were not completed are scored (see
+        run_file.RunFileWriter); otherwise the output file is overwritten.
+        The time of each query is written to config['timing_file'], by default output_file + ".timing".
         """
         self._open_index()
         self._load_queries()
-        out = open(self.config['output_file'], "w")
+        if self.config.get('warm_candidates_file'):
+            self.warm_cache(self.config['warm_candidates_file'])
+        resume = self.config.get('resume', False)
+        writer = run_file.RunFileWriter(self.config['output_file'], self.config.get('candidates_file'), resume)
+        num_completed = writer.open()
+        if num_completed:
+            print "Resuming run: " + str(num_completed) + " queries already scored"
+        timing_file = self.config.get('timing_file', self.config['output_file'] + ".timing")
+        new_timing_file = not (num_completed and os.path.exists(timing_file))
+        timing_out = open(timing_file, "w" if new_timing_file else "a")
+        if new_timing_file:
+            timing_out.write("\t".join(["query_id", "total", "num_docs", "num_entities"] + self.PHASES) + "\n")
+        metrics = self.metrics
         # for each query
-        for q_id, query in self.queries:            
+        for q_id, query in self.queries:
+            if writer.is_completed(q_id):
+                continue
+            self.metrics = Metrics()
+            start = time.time()
             p_q_e_all = self.get_p_q_e(q_id, query)
             # Write p_q_e for query to output_file
+            out = StringIO()
             self.write_trec_format(q_id, self.config['run_id'], out, p_q_e_all, self.config['num_docs'])
-            print "Scores computed for: " + q_id
+            writer.write_query(q_id, out.getvalue(), "".join(q_id + "\t" + doc_id + "\n" for doc_id in self.candidates))
+            seconds = time.time() - start
+            self._write_timing(timing_out, q_id, seconds, len(p_q_e_all))
+            metrics.merge(self.metrics)
+            print "Scores computed for: " + q_id + " (" + str(seconds) + "s)"
             # Clear p_q_e after writing to file
             p_q_e_all.clear()
-        # Close output file
-        out.close()
+        self.metrics = metrics
+        writer.finish()
+        timing_out.close()
+        if self.doc_cache is not None:
+            print "Document cache: " + str(self.doc_cache.stats())
 
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-resume", help="Resume an interrupted run", action="store_true")
+    args = parser.parse_args()
+
     # TODO: Read config from json
     config = {'index_dir': '/home/tinohl/tino-thesis/output/ClueWeb12_merged_index',
               'field_id': Lucene.FIELDNAME_ID,
@@ -242,6 +401,7 @@ def main():
               'run_id': 1,
               'query_file': '/home/tinohl/tino-thesis/data/queries.txt',
               'output_file': '/home/tinohl/tino-thesis/output/new_runs/refactor_test.txt',
+              'resume': args.resume,
               'ann_dir': '/hdd2/export/nordlys/data/ClueWeb12-FACC1'}
 
     model2 = Model2(config)
@@ -0,0 +1,171 @@
+"""
+Exact and near-duplicate detection of ClueWeb records, before they are cleaned and indexed.
+
+Exact duplicates are found with an MD5 hash of the HTML of the record. Near-duplicates are found with
+a 64 bit SimHash of the word shingles of the record. The SimHash is split into bands, so that two
+fingerprints within max_distance bits share at least one band, and only records sharing a band are
+compared.
+
+Duplicates are found before any record is cleaned: the files of a folder are first fingerprinted in parallel
+(see indexer.fingerprint_file()), and the fingerprints are added to the store in file order by the main process.
+The TREC-IDs of the duplicates are then skipped when the files are cleaned. Only records that are not duplicates
+are added to the store, so every duplicate is mapped to a canonical record that is not a duplicate itself.
+
+The store is kept in memory by the main process, and grows with every record that is not a duplicate: about 190
+bytes per record for exact duplicates, and about 670 bytes per record with near-duplicates (measured on CPython
+2.7, 64 bit). A ClueWeb12 folder of 3-4 million records needs 0.7 GB (exact) or 2.5 GB (near), but the full
+ClueWeb12 collection (733 million records) would need about 140 GB (exact) or 490 GB (near). For large
+collections, the store should be reset per folder or per segment (see indexer -dedup_scope), which only finds the
+duplicates within each of them.
+
+@author: Tino Hakim Lazreg
+"""
+
+import hashlib
+import re
+import zlib
+
+import numpy as np
+
+ex_markup_re = re.compile('<script.*?</script>|<style.*?</style>|<[^>]*>', re.IGNORECASE | re.DOTALL)
+ex_word_re = re.compile('\\w+')
+
+SHINGLE_SIZE = 3
+SIMHASH_BITS = 64
+
+
+def get_html(payload):
+    """Returns the payload without the HTTP header."""
+    i = payload.find("\r\n\r\n")
+    if i >= 0:
+        return payload[i + 4:]
+    return payload
+
+
+def exact_fingerprint(payload):
+    """
+    Returns an MD5 hash of the whitespace normalized HTML of the payload.
+    """
+    return hashlib.md5(" ".join(get_html(payload).split())).hexdigest()
+
+
+def _hash64(feature):
+    return ((zlib.crc32(feature) & 0xffffffff) << 32) | (zlib.crc32(feature, 0x9e3779b9) & 0xffffffff)
+
+
+def simhash(payload):
+    """
+    Returns the 64 bit SimHash of the word shingles of the payload. HTML tags are removed with a regular
+    expression, which is much cheaper than the BeautifulSoup stripping used for cleaning.
+    """
+    words = ex_word_re.findall(ex_markup_re.sub(" ", get_html(payload)).lower())
+    if len(words) < SHINGLE_SIZE:
+        features = [" ".join(words)]
+    else:
+        features = [" ".join(words[i:i + SHINGLE_SIZE]) for i in xrange(len(words) - SHINGLE_SIZE + 1)]
+    hashes = np.array([_hash64(feature) for feature in features], dtype=np.uint64)
+    # One row of 64 bits per feature, most significant bit first
+    bits = np.unpackbits(hashes.byteswap().view(np.uint8).reshape(-1, 8), axis=1)
+    votes = 2 * bits.sum(axis=0).astype(np.int64) - len(features)
+    return int(np.packbits(votes > 0).view('>u8')[0])
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+def get_fingerprints(payload, near_duplicates=True):
+    """Returns the exact fingerprint and, with near_duplicates, the SimHash of a payload (or None)."""
+    return exact_fingerprint(payload), simhash(payload) if near_duplicates else None
+
+
+class FingerprintStore(object):
+    """
+    Store of the fingerprints of the records that are not duplicates.
+
+    :param near_duplicates: Detect near-duplicates, in addition to exact duplicates
+    :param max_distance: Maximum Hamming distance between the SimHashes of near-duplicates
+    """
+
+    def __init__(self, near_duplicates=True, max_distance=3):
+        self.near_duplicates = near_duplicates
+        self.max_distance = max_distance
+        self.num_bands = max_distance + 1
+        self.band_bits = SIMHASH_BITS // self.num_bands
+        # {exact fingerprint: TREC-ID} and {(band, band value): [(SimHash, TREC-ID)]}
+        self.exact = {}
+        self.bands = {}
+        # (duplicate TREC-ID, canonical TREC-ID) tuples
+        self.duplicates = []
+
+    def _band_keys(self, fingerprint):
+        mask = (1 << self.band_bits) - 1
+        return [(band, (fingerprint >> (band * self.band_bits)) & mask) for band in range(self.num_bands)]
+
+    def _find(self, exact, near, band_keys):
+        canonical = self.exact.get(exact)
+        if canonical is not None:
+            return canonical, "exact"
+        for key in band_keys:
+            for fingerprint, canonical in self.bands.get(key, ()):
+                if hamming_distance(fingerprint, near) <= self.max_distance:
+                    return canonical, "near"
+        return None, None
+
+    def add(self, trec_id, exact, near=None):
+        """
+        Returns the TREC-ID of the first record added with the same or a near-duplicate fingerprint, and the kind
+        of duplicate ("exact" or "near"). Returns (None, None), and adds the record to the store, if the record
+        is not a duplicate.
+
+        :param trec_id: WARC-TREC-ID of the record
+        :param exact: Exact fingerprint, see get_fingerprints()
+        :param near: SimHash, or None to only check for exact duplicates
+        """
+        band_keys = self._band_keys(near) if near is not None else []
+        canonical, kind = self._find(exact, near, band_keys)
+        if canonical is not None:
+            self.duplicates.append((trec_id, canonical))
+            return canonical, kind
+        self.exact[exact] = trec_id
+        for key in band_keys:
+            self.bands.setdefault(key, []).append((near, trec_id))
+        return None, None
+
+    def find_duplicate(self, trec_id, payload):
+        """
+        Fingerprints the payload, and adds the record, see add().
+
+        :param trec_id: WARC-TREC-ID of the record
+        :param payload: Record payload
+        """
+        return self.add(trec_id, *get_fingerprints(payload, self.near_duplicates))
+
+
+def resolve_duplicates(duplicates):
+    """
+    Maps each duplicate to the end of its chain of canonical records, e.g. C -> B and B -> A to C -> A and B -> A,
+    so that no canonical TREC-ID is a duplicate itself.
+
+    :param duplicates: List of (duplicate TREC-ID, canonical TREC-ID) tuples
+    :return: List of (duplicate TREC-ID, canonical TREC-ID) tuples, in the same order
+    """
+    canonicals = dict(duplicates)
+    resolved = []
+    for trec_id, canonical in duplicates:
+        seen = {trec_id}
+        while canonical in canonicals and canonical not in seen:
+            seen.add(canonical)
+            canonical = canonicals[canonical]
+        resolved.append((trec_id, canonical))
+    return resolved
+
+
+def write_duplicates(duplicates, path):
+    """
+    Appends the (duplicate TREC-ID, canonical TREC-ID) mapping to a .tsv file, with chains resolved to the
+    canonical record, see resolve_duplicates().
+    """
+    with open(path, "a") as f:
+        for trec_id, canonical in resolve_duplicates(duplicates):
+            f.write(trec_id + "\t" + canonical + "\n")
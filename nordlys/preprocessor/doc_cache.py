@@ -0,0 +1,140 @@
+"""
+Size-bounded LRU cache of per-document statistics, shared by all queries of a Model 2 run.
+
+The cache size is accounted in (estimated) bytes, so large documents take up more of the cache
+than small ones. CachedIndex wraps an index (IndexCache, MemoryIndex or NumpyIndex), and caches
+the per-document calls made by Model2 and the second-pass scorer.
+
+@author: Tino Hakim Lazreg
+"""
+
+import sys
+from collections import OrderedDict
+from itertools import islice
+
+# Number of items of a dict, list or tuple used to estimate its size
+SIZE_SAMPLE = 8
+
+
+def estimate_size(value):
+    """
+    Returns an estimate of the memory used by a value, including the contents of dicts, lists and tuples.
+    The size of the contents is extrapolated from the first few items, so the estimate is cheap for large values.
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        sample = list(islice(value.iteritems(), SIZE_SAMPLE))
+        if sample:
+            sample_size = sum(sys.getsizeof(key) + sys.getsizeof(item) for key, item in sample)
+            size += sample_size * len(value) // len(sample)
+    elif isinstance(value, (list, tuple)):
+        sample = value[:SIZE_SAMPLE]
+        if sample:
+            size += sum(estimate_size(item) for item in sample) * len(value) // len(sample)
+    return size
+
+
+class LRUCache(object):
+    """
+    Least recently used cache, bounded by the estimated size of its values.
+    When evict is False (e.g. while warming the cache), values that do not fit are not added, and nothing is evicted.
+
+    :param max_bytes: Maximum estimated size of the cached values
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.items = OrderedDict()
+        self.size = 0
+        self.evict = True
+        self.full = False
+        self.reset_stats()
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, default=None):
+        """Returns the cached value, and marks it as most recently used."""
+        item = self.items.pop(key, None)
+        if item is None:
+            self.misses += 1
+            return default
+        self.items[key] = item
+        self.hits += 1
+        return item[0]
+
+    def put(self, key, value):
+        """Adds a value, and evicts the least recently used values until the cache fits in max_bytes."""
+        size = estimate_size(value)
+        if size > self.max_bytes:
+            return
+        old_size = self.items[key][1] if key in self.items else 0
+        if not self.evict and self.size - old_size + size > self.max_bytes:
+            self.full = True
+            return
+        old = self.items.pop(key, None)
+        if old is not None:
+            self.size -= old[1]
+        self.items[key] = (value, size)
+        self.size += size
+        while self.size > self.max_bytes:
+            _, (_, evicted_size) = self.items.popitem(last=False)
+            self.size -= evicted_size
+            self.evictions += 1
+
+    def is_full(self):
+        """Returns True if the cache is full, or a value was not added because it did not fit without eviction."""
+        return self.full or self.size >= self.max_bytes
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / float(lookups) if lookups else None,
+                'evictions': self.evictions,
+                'items': len(self.items),
+                'bytes': self.size}
+
+
+class CachedIndex(object):
+    """
+    Wraps an index, and caches the results of the per-document and per-term calls in an LRUCache.
+    All other calls are passed on to the index.
+
+    :param index: Index object, e.g. IndexCache
+    :param cache: LRUCache
+    """
+
+    def __init__(self, index, cache):
+        self.index = index
+        self.cache = cache
+
+    def __getattr__(self, name):
+        return getattr(self.index, name)
+
+    def _cached(self, key, method, *args):
+        value = self.cache.get(key)
+        if value is None:
+            value = method(*args)
+            self.cache.put(key, value)
+        return value
+
+    def get_lucene_document_id(self, doc_id):
+        return self._cached(("id", doc_id), self.index.get_lucene_document_id, doc_id)
+
+    def get_doc_termfreqs(self, lucene_doc_id, field):
+        return self._cached(("tf", lucene_doc_id, field), self.index.get_doc_termfreqs, lucene_doc_id, field)
+
+    def get_doc_count(self, field):
+        return self._cached(("dc", field), self.index.get_doc_count, field)
+
+    def get_doc_freq(self, term, field):
+        return self._cached(("df", term, field), self.index.get_doc_freq, term, field)
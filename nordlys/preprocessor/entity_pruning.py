@@ -0,0 +1,87 @@
+"""
+Static pruning of the document-entity associations p(e|d) used by Model 2.
+
+Pages with a lot of boilerplate contain many entities with a tiny p(e|d), which enlarge the candidate
+entity set without changing the top of the ranking. Pruning keeps, for each document, the top_n entities
+with the highest p(e|d), and/or the highest scoring entities making up the given fraction (mass) of the
+total p(e|d) of the document. Ties are broken by entity id, so Model2 and the NumPy index prune the same
+entities.
+
+@author: Tino Hakim Lazreg
+"""
+
+import numpy as np
+
+# Relative tolerance of the mass threshold, so that the rounding differences of a running sum (prune_entities)
+# and a cumulative sum over all documents (prune_mask) do not change which entities are kept
+MASS_TOLERANCE = 1e-9
+
+
+def is_pruning(top_n=None, mass=None):
+    """Returns True if the settings prune any entities."""
+    return bool(top_n) or (mass is not None and mass < 1)
+
+
+def normalize_pruning(top_n=None, mass=None):
+    """Returns the (top_n, mass) settings, with None for the settings that do not prune."""
+    return top_n or None, mass if mass is not None and mass < 1 else None
+
+
+def prune_entities(entity_scores, top_n=None, mass=None):
+    """
+    Returns the entities of a document that are kept, sorted by descending p(e|d).
+
+    :param entity_scores: List of (entity_id, p(e|d)) tuples of a document
+    :param top_n: Maximum number of entities kept, None or 0 for no limit
+    :param mass: Fraction (0-1] of the total p(e|d) of the document kept, None for no limit
+    :return: List of (entity_id, p(e|d)) tuples
+    """
+    entity_scores = sorted(entity_scores, key=lambda (entity_id, score): (-score, entity_id))
+    if top_n:
+        entity_scores = entity_scores[:top_n]
+    if mass is not None and mass < 1:
+        threshold = mass * sum(score for _, score in entity_scores) * (1 - MASS_TOLERANCE)
+        kept = 0
+        cumulative = 0
+        for _, score in entity_scores:
+            if kept and cumulative >= threshold:
+                break
+            cumulative += score
+            kept += 1
+        entity_scores = entity_scores[:kept]
+    return entity_scores
+
+
+def prune_mask(doc_index, entity_ids, scores, top_n=None, mass=None):
+    """
+    Vectorized prune_entities() for the entities of several documents.
+
+    :param doc_index: Array with the document of each entity
+    :param entity_ids: Array with the entity (term) id of each entity, ordered like the entity ids
+    :param scores: Array with the p(e|d) of each entity
+    :param top_n: Maximum number of entities kept per document, None or 0 for no limit
+    :param mass: Fraction (0-1] of the total p(e|d) of each document kept, None for no limit
+    :return: Boolean array, True for the entities that are kept
+    """
+    keep = np.ones(len(scores), dtype=bool)
+    if not is_pruning(top_n, mass) or not len(scores):
+        return keep
+    order = np.lexsort((entity_ids, -scores, doc_index))
+    sorted_docs = doc_index[order]
+    # Start of each document in the sorted order, and the rank of each entity within its document
+    starts = np.flatnonzero(np.r_[True, sorted_docs[1:] != sorted_docs[:-1]])
+    lengths = np.diff(np.r_[starts, len(order)])
+    rank = np.arange(len(order)) - np.repeat(starts, lengths)
+    kept = np.ones(len(order), dtype=bool)
+    if top_n:
+        kept &= rank < top_n
+    if mass is not None and mass < 1:
+        sorted_scores = np.where(kept, scores[order], 0)
+        cumulative = np.cumsum(sorted_scores)
+        doc_offsets = np.repeat(cumulative[starts] - sorted_scores[starts], lengths)
+        # Sum of the scores ranked above each entity, within its document
+        before = cumulative - sorted_scores - doc_offsets
+        totals = np.repeat(np.add.reduceat(sorted_scores, starts), lengths)
+        kept &= (rank == 0) | (before < mass * totals * (1 - MASS_TOLERANCE))
+    keep[order] = kept
+    return keep
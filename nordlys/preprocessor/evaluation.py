@@ -0,0 +1,107 @@
+"""
+Evaluates TREC run files against qrels, e.g. the qrels in data/.
+
+Computes mean average precision (MAP) and precision at 10 (P@10) over the queries of the run that have
+relevance judgments, like trec_eval. Documents with a relevance above 0 are relevant.
+
+Input:
+    -run Run file
+    -qrels Qrels file
+
+Output:
+    MAP, P@10 and the number of evaluated queries
+
+@author: Tino Hakim Lazreg
+"""
+
+from __future__ import division
+
+import argparse
+
+
+def load_qrels(path):
+    """
+    Reads a qrels file with query_id, iteration, doc_id and relevance columns.
+
+    :return: Dictionary {query_id: {doc_id: relevance}}
+    """
+    qrels = {}
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 4:
+                continue
+            qrels.setdefault(fields[0], {})[fields[2]] = float(fields[3])
+    return qrels
+
+
+def load_run(path):
+    """
+    Reads a TREC run file.
+
+    :return: Dictionary {query_id: [doc_id]}, with the documents of each query sorted by rank
+    """
+    run = {}
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 4:
+                continue
+            run.setdefault(fields[0], []).append((int(fields[3]), fields[2]))
+    return {q_id: [doc_id for _, doc_id in sorted(ranking)] for q_id, ranking in run.iteritems()}
+
+
+def average_precision(ranking, relevant):
+    """
+    :param ranking: List of doc_ids, sorted by rank
+    :param relevant: Set of relevant doc_ids
+    """
+    if not relevant:
+        return 0
+    hits = 0
+    total = 0
+    for rank, doc_id in enumerate(ranking, 1):
+        if doc_id in relevant:
+            hits += 1
+            total += hits / rank
+    return total / len(relevant)
+
+
+def precision_at(ranking, relevant, k=10):
+    return sum(1 for doc_id in ranking[:k] if doc_id in relevant) / k
+
+
+def evaluate(run, qrels):
+    """
+    Returns MAP and P@10 of a run.
+
+    :param run: Dictionary {query_id: [doc_id]}, see load_run()
+    :param qrels: Dictionary {query_id: {doc_id: relevance}}, see load_qrels()
+    :return: Dictionary with 'map', 'p10' and 'num_queries'
+    """
+    aps = []
+    precisions = []
+    for q_id, ranking in run.iteritems():
+        if q_id not in qrels:
+            continue
+        relevant = set(doc_id for doc_id, relevance in qrels[q_id].iteritems() if relevance > 0)
+        aps.append(average_precision(ranking, relevant))
+        precisions.append(precision_at(ranking, relevant, 10))
+    return {'map': sum(aps) / len(aps) if aps else None,
+            'p10': sum(precisions) / len(precisions) if precisions else None,
+            'num_queries': len(aps)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-run", help="Run file")
+    parser.add_argument("-qrels", help="Qrels file")
+    args = parser.parse_args()
+    results = evaluate(load_run(args.run), load_qrels(args.qrels))
+    print "map\t" + str(results['map'])
+    print "P_10\t" + str(results['p10'])
+    print "num_q\t" + str(results['num_queries'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+"""
+Scores over a set of shard indexes (e.g. the per-folder indexes written by indexer.py) as if they were one
+merged index, so Model 2 can run without merge_indexer.py.
+
+Collection statistics (document counts, document frequencies, collection term frequencies and lengths) are
+summed over the shards, so LM smoothing and entity IDF use the same values as on the merged index. Documents
+are addressed by (shard number, Lucene document id) tuples.
+
+First-pass retrieval runs on every shard in parallel threads, and the top num_docs documents of the shards are
+merged. Ties are broken by (shard, Lucene document id), which is the document order of an index merged from the
+shards in order. How a shard is scored depends on the similarity of the shards:
+    dirichlet  Exact Dirichlet smoothed language models over all query terms in the collection, for shards that
+               can score with given collection probabilities, e.g. MemoryIndex and NumpyIndex (their p_t_c
+               argument). Each shard scores with the global statistics, so its top num_docs are its documents of
+               the global top num_docs, and the result is identical to the first pass on the merged index.
+    lucene     Lucene shards score with their own statistics, so each shard returns depth * num_docs candidates,
+               which are rescored with the global statistics in the thread of the shard. The rescoring mimics
+               Lucene's LMDirichletSimilarity: only matched query terms are scored, the score of each term is
+               clamped at 0, the collection model is (ttf + 1) / (tokens + 1), and document lengths are decoded
+               from one byte norms, see get_lucene_doc_length(). Lucene computes in single precision and may
+               discount overlapping tokens from the lengths, so scores can differ in the last digits, which can
+               reorder documents with nearly equal scores. A document of the global top num_docs is also missed if
+               it is ranked below depth * num_docs in its own shard, which only happens when the term statistics
+               of the shards are very different; increase depth if they are.
+
+@author: Tino Hakim Lazreg
+"""
+
+from __future__ import division
+
+import heapq
+import math
+import struct
+from multiprocessing.pool import ThreadPool
+
+from nordlys.preprocessor.doc_cache import LRUCache
+from nordlys.retrieval.results import RetrievalResults
+
+SIMILARITY_LUCENE = "lucene"
+SIMILARITY_DIRICHLET = "dirichlet"
+
+
+def attach_current_thread():
+    """Attaches the current thread to the PyLucene JVM, which is required before it calls into Lucene."""
+    try:
+        import lucene
+    except ImportError:
+        return
+    env = lucene.getVMEnv()
+    if env is not None:
+        env.attachCurrentThread()
+
+
+def _to_float32(value):
+    return struct.unpack('>f', struct.pack('>f', value))[0]
+
+
+def get_lucene_doc_length(length):
+    """
+    Returns a document length as Lucene's LMDirichletSimilarity sees it. The norm 1 / sqrt(length) is stored in
+    one byte with 3 mantissa bits (SmallFloat.floatToByte315), and decoded as 1 / norm ** 2.
+    """
+    norm = _to_float32(1.0 / _to_float32(math.sqrt(length)))
+    bits = struct.unpack('>i', struct.pack('>f', norm))[0]
+    small = bits >> 21
+    offset = (63 - 15) << 3
+    if small <= offset:
+        byte = 0 if bits <= 0 else 1
+    elif small >= offset + 0x100:
+        byte = 0xff
+    else:
+        byte = small - offset
+    if byte == 0:
+        return float('inf')
+    norm = struct.unpack('>f', struct.pack('>i', (byte << 21) + ((63 - 15) << 24)))[0]
+    return 1 / (norm * norm)
+
+
+class FederatedIndex(object):
+    """
+    Index made of several shard indexes, implementing the index calls used by Model2 and the LM scorer.
+
+    :param shards: List of index objects, e.g. IndexCache, MemoryIndex or NumpyIndex
+    :param depth: Number of candidates retrieved from each shard, as a multiple of num_docs
+    :param mu: Dirichlet smoothing parameter used to rescore the candidates of Lucene shards. Dirichlet shards
+               score with their own smoothing parameter.
+    :param similarity: Similarity of the shards, SIMILARITY_LUCENE or SIMILARITY_DIRICHLET
+    :param max_threads: Maximum number of threads scoring shards in parallel
+    :param location_cache_size: Size in bytes of the cache of document locations
+    """
+
+    def __init__(self, shards, depth=2, mu=2000, similarity=SIMILARITY_LUCENE, max_threads=16,
+                 location_cache_size=2 ** 26):
+        if similarity not in (SIMILARITY_LUCENE, SIMILARITY_DIRICHLET):
+            raise ValueError("Unknown similarity: " + str(similarity))
+        self.shards = shards
+        self.depth = depth
+        self.mu = mu
+        self.similarity = similarity
+        self.max_threads = max_threads
+        self.pool = None
+        # WARC-TREC-ID -> (shard, Lucene document id) of the documents recently returned by the first pass
+        self.doc_locations = LRUCache(location_cache_size)
+
+    def open_searcher(self):
+        for shard in self.shards:
+            shard.open_searcher()
+        if self.pool is None:
+            self.pool = ThreadPool(max(1, min(len(self.shards), self.max_threads)), initializer=attach_current_thread)
+
+    def close_reader(self):
+        for shard in self.shards:
+            shard.close_reader()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
+    def num_docs(self):
+        return sum(shard.num_docs() for shard in self.shards)
+
+    def get_lucene_document_id(self, doc_id):
+        """Returns the (shard, Lucene document id) tuple of a document, or None if no shard has it."""
+        location = self.doc_locations.get(doc_id)
+        if location is not None:
+            return location
+        for shard_no, shard in enumerate(self.shards):
+            try:
+                lucene_doc_id = shard.get_lucene_document_id(doc_id)
+            except (KeyError, IndexError):
+                continue
+            if lucene_doc_id is not None and lucene_doc_id >= 0:
+                self.doc_locations.put(doc_id, (shard_no, lucene_doc_id))
+                return shard_no, lucene_doc_id
+        return None
+
+    def get_doc_id(self, location):
+        shard_no, lucene_doc_id = location
+        return self.shards[shard_no].get_doc_id(lucene_doc_id)
+
+    def get_doc_termfreqs(self, location, field):
+        shard_no, lucene_doc_id = location
+        return self.shards[shard_no].get_doc_termfreqs(lucene_doc_id, field)
+
+    def get_doc_termvector(self, location, field):
+        shard_no, lucene_doc_id = location
+        return self.shards[shard_no].get_doc_termvector(lucene_doc_id, field)
+
+    def get_doc_length(self, location, field):
+        return sum(self.get_doc_termfreqs(location, field).itervalues())
+
+    def get_doc_count(self, field):
+        return sum(shard.get_doc_count(field) for shard in self.shards)
+
+    def get_doc_freq(self, term, field):
+        return sum(shard.get_doc_freq(term, field) for shard in self.shards)
+
+    def get_coll_termfreq(self, term, field):
+        return sum(shard.get_coll_termfreq(term, field) for shard in self.shards)
+
+    def get_coll_length(self, field):
+        return sum(shard.get_coll_length(field) for shard in self.shards)
+
+    def _get_term_weights(self, terms, field):
+        """Returns the collection probability of the query terms that are scored, see score_query()."""
+        coll_length = self.get_coll_length(field)
+        p_t_c = {}
+        for term in set(terms):
+            coll_termfreq = self.get_coll_termfreq(term, field)
+            if self.similarity == SIMILARITY_LUCENE:
+                # Lucene's DefaultCollectionModel
+                p_t_c[term] = (coll_termfreq + 1) / (coll_length + 1)
+            elif coll_termfreq:
+                p_t_c[term] = coll_termfreq / coll_length
+        return p_t_c
+
+    def _score_document(self, terms, p_t_c, tf):
+        doc_length = sum(tf.itervalues())
+        score = 0
+        if self.similarity == SIMILARITY_LUCENE:
+            doc_length = get_lucene_doc_length(doc_length)
+            for term in terms:
+                freq = tf.get(term, 0)
+                if freq:
+                    score += max(0, math.log(1 + freq / (self.mu * p_t_c[term])) +
+                                 math.log(self.mu / (doc_length + self.mu)))
+        else:
+            for term in terms:
+                if term in p_t_c:
+                    score += math.log((tf.get(term, 0) + self.mu * p_t_c[term]) / (doc_length + self.mu))
+        return score
+
+    def _score_shard(self, args):
+        """
+        Returns the top num_docs documents of a shard, scored with the global collection probabilities p_t_c, as
+        (-score, (shard, Lucene document id), doc_id) tuples.
+        """
+        shard_no, query, field_content, field_id, num_docs, p_t_c = args
+        shard = self.shards[shard_no]
+        if self.similarity == SIMILARITY_DIRICHLET:
+            results = shard.score_query(query, field_content=field_content, field_id=field_id, num_docs=num_docs,
+                                        p_t_c=p_t_c)
+            return [(-score, (shard_no, results.get_doc_id_int(doc_id)), doc_id)
+                    for doc_id, score in results.get_scores_sorted()]
+
+        # Lucene scores with the statistics of the shard, so its candidates are rescored
+        results = shard.score_query(query, field_content=field_content, field_id=field_id,
+                                    num_docs=self.depth * num_docs)
+        terms = query.split()
+        scores = []
+        for doc_id, _ in results.get_scores_sorted():
+            lucene_doc_id = results.get_doc_id_int(doc_id)
+            score = self._score_document(terms, p_t_c, shard.get_doc_termfreqs(lucene_doc_id, field_content))
+            scores.append((-score, (shard_no, lucene_doc_id), doc_id))
+        return heapq.nsmallest(num_docs, scores)
+
+    def score_query(self, query, field_content, field_id=None, num_docs=100):
+        """
+        Returns the top documents of all shards, scored with the similarity of the shards and the global
+        collection statistics.
+
+        :param query: Preprocessed query
+        :param field_content: Field to score
+        :param field_id: Document id field
+        :param num_docs: Number of documents to return
+        :return: RetrievalResults object with doc_id, score and (shard, Lucene document id)
+        """
+        if self.pool is None:
+            self.open_searcher()
+        p_t_c = self._get_term_weights(query.split(), field_content)
+        shard_args = [(shard_no, query, field_content, field_id, num_docs, p_t_c)
+                      for shard_no in range(len(self.shards))]
+        scores = [score for shard_scores in self.pool.map(self._score_shard, shard_args) for score in shard_scores]
+
+        results = RetrievalResults()
+        for score, location, doc_id in heapq.nsmallest(num_docs, scores):
+            self.doc_locations.put(doc_id, location)
+            results.append(doc_id, -score, location)
+        return results
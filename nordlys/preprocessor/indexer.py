@@ -6,29 +6,48 @@ Input:
     -cluweb_dir ClueWeb directory
     -output_dir Output directory
     -num_processes Number of processes to run
+    -metrics_file Optional file the pipeline metrics are written to
+    -metrics_format Format of the metrics file, json or prometheus
+    -metrics_interval Minimum number of seconds between metrics file writes
+    -mismatch_log CSV file unmatched entity mentions are logged to
+    -shard_dir Optional directory the cleaned records are written to as shards, before they are indexed
+    -dedup Skip duplicate records: none, exact or near (exact and near-duplicates)
+    -duplicates_dir Directory of the duplicates files, by default output_dir
+    -dedup_scope Find duplicates across all folders (all), or only within each folder (folder), which bounds the
+                 memory used by the fingerprints to one folder, see dedup
+    -max_payload_size Records larger than this number of bytes are stripped incrementally, without entity replacement,
+                      and their text is cut to max_payload_size characters. Their contents_annotated field is their
+                      cleaned text, without Freebase ids, and their entities field is empty
 
 Output:
-    Lucene index
+    Lucene index, and with -dedup a <folder>.duplicates.tsv per folder, next to the index of the folder,
+    mapping duplicate to canonical TREC-IDs
 
 @author: Tino Hakim Lazreg
 """
 
 import argparse
 import fileinput
+import multiprocessing
 import os
 import time
 
-import parmap
 import warc
 
 from nordlys.preprocessor.clueweb_facc_preprocessor import Annotation, WarcEntry
+from nordlys.preprocessor.dedup import FingerprintStore, get_fingerprints, write_duplicates
+from nordlys.preprocessor.metrics import Metrics, MetricsWriter
+from nordlys.preprocessor.mismatch_log import MismatchLogWriter
+from nordlys.preprocessor.shard_store import ShardReader
 from nordlys.retrieval.lucene_tools import Lucene
 
 class Indexer(object):
-    def __init__(self, output_dir):
+    def __init__(self, output_dir, metrics=None, metrics_writer=None):
         self.contents = None
         self.lucene = Lucene(output_dir)
         self.lucene.open_writer()
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.metrics_writer = metrics_writer
 
     def __add_to_contents(self, field_name, field_value, field_type):
         """Adds field to document contents."""
@@ -47,35 +66,49 @@ class Indexer(object):
         self.__add_to_contents(Lucene.FIELDNAME_CONTENTS, cleaned_record, Lucene.FIELDTYPE_TEXT_TVP)
         self.__add_to_contents("contents_annotated", replaced_annotated_record, Lucene.FIELDTYPE_TEXT_NTVP)
         self.__add_to_contents("entities", entities_record, Lucene.FIELDTYPE_TEXT_NTVP)
+        start = time.time()
         self.lucene.add_document(self.contents)
+        self.metrics.add_time('add_document', time.time() - start)
+        self.metrics.incr('records_indexed')
 
     def index_files(self, results):
         """
         Call index_file() on each record in results
-        :param results: List of dictionaries
+        :param results: List with a list of record dictionaries, or the path of a shard, per warc file
         """
-        
+
         for warc_file in results:
             # Annotation .tsv is empty
             if warc_file is False:
                 continue
+            if isinstance(warc_file, basestring):
+                # Stream the records from the shard
+                warc_file = ShardReader(warc_file)
             for record in warc_file:
+                start = time.time()
                 replaced_annotated_record = self.lucene.preprocess(record['replaced_record'])
                 cleaned_record = self.lucene.preprocess(record['cleaned_record'])
+                self.metrics.add_time('lucene_preprocess', time.time() - start)
                 self.index_file(record['record_id'], replaced_annotated_record, cleaned_record, record['entities_record'])
+            if self.metrics_writer is not None:
+                self.metrics_writer.maybe_write()
         self.lucene.close_writer()
 
 
-def read_and_clean_files(clueweb_file, ann_file, data_dir, ann_dir):
+def read_and_clean_files(clueweb_file, ann_file, data_dir, ann_dir, shard_dir=None, skip_ids=None,
+                         max_payload_size=None):
     """
     Read file from data_dir and ann_dir, replace entity mentions and clean records in that file
     :param clueweb_file:
     :param ann_file:
     :param data_dir: Warc files directory
     :param ann_dir: Annotations directory
-    :return: {'record_id': record_id,
+    :param shard_dir: If given, the records are written to a shard in this directory
+    :param skip_ids: Set of TREC-IDs of records that are skipped, e.g. duplicates
+    :param max_payload_size: Maximum size of payloads read into memory, see WarcEntry
+    :return: ([{'record_id': record_id,
 		'replaced_record': cleaned_replaced_record,
-		'cleaned_record': cleaned_record}
+		'cleaned_record': cleaned_record}] or shard path, metrics snapshot)
     """
     annotation_input = fileinput.FileInput(os.path.join(ann_dir, ann_file), openhook=fileinput.hook_compressed)
     annotation_list = []
@@ -86,12 +119,148 @@ def read_and_clean_files(clueweb_file, ann_file, data_dir, ann_dir):
     warc_file = warc.open(warc_path)
     print "Replacing entity mentions for ", clueweb_file, ":", ann_file, "..."
     start = time.time()
-    warc_entry = WarcEntry(warc_path, warc_file, annotation_list)
+    metrics = Metrics()
+    warc_entry = WarcEntry(warc_path, warc_file, annotation_list, metrics, skip_ids, max_payload_size)
     cleaned_records = warc_entry.replace_entity_mentions()
+    if shard_dir is not None and cleaned_records is not False:
+        cleaned_records = warc_entry.write_record(cleaned_records, shard_dir)
     end = time.time()
     print "Time used: ", end - start
+    metrics.add_time('read_and_clean_file', end - start)
+    metrics.incr('files_cleaned')
     warc_file.close()
-    return cleaned_records
+    return cleaned_records, metrics.snapshot()
+
+
+def fingerprint_file(clueweb_file, data_dir, near_duplicates=True, max_payload_size=None):
+    """
+    Fingerprints the records of a warc file, see dedup.get_fingerprints(). Oversized records are not fingerprinted.
+    :param clueweb_file: Warc file
+    :param data_dir: Warc files directory
+    :param near_duplicates: Also compute the SimHash of the records
+    :param max_payload_size: Maximum size of payloads read into memory, see WarcEntry
+    :return: ([(TREC-ID, exact fingerprint, SimHash or None)], metrics snapshot)
+    """
+    start = time.time()
+    metrics = Metrics()
+    fingerprints = []
+    warc_file = warc.open(os.path.join(data_dir, clueweb_file))
+    try:
+        while True:
+            record, payload, record_id = WarcEntry.read_record(warc_file.reader, max_payload_size)
+            if record is None:
+                break
+            if payload is not None and record_id is not None:
+                fingerprints.append((record_id,) + get_fingerprints(payload, near_duplicates))
+    finally:
+        warc_file.close()
+    metrics.add_time('dedup', time.time() - start)
+    return fingerprints, metrics.snapshot()
+
+
+def _fingerprint_task(task):
+    """
+    Calls fingerprint_file() in a worker process.
+    :return: (file number, (fingerprints, metrics snapshot))
+    """
+    file_no, args = task
+    return file_no, fingerprint_file(*args)
+
+
+def _read_and_clean_task(task):
+    """
+    Calls read_and_clean_files() in a worker process.
+    :return: (file number, (cleaned records, metrics snapshot))
+    """
+    file_no, args, skip_ids, max_payload_size = task
+    return file_no, read_and_clean_files(*args, skip_ids=skip_ids, max_payload_size=max_payload_size)
+
+
+def _run_tasks(pool, func, tasks, metrics, metrics_writer):
+    """
+    Runs (file number, ...) tasks on the pool. The metrics of each task are merged, and periodically written, as soon
+    as the task is done.
+    :return: List with the result of each task, in the order of the file numbers
+    """
+    results = [None] * len(tasks)
+    for file_no, (result, task_metrics) in pool.imap_unordered(func, tasks):
+        results[file_no] = result
+        metrics.merge(task_metrics)
+        metrics_writer.maybe_write()
+    return results
+
+
+def find_folder_duplicates(pool, clueweb_iter, clueweb_dir, fingerprint_store, metrics, metrics_writer,
+                           max_payload_size=None):
+    """
+    Fingerprints the files of a folder in parallel, and adds the fingerprints to the store in file order, which
+    finds the duplicates within the folder, and of the records of previous folders in the store.
+    :return: List with the set of TREC-IDs of the duplicates of each file
+    """
+    tasks = [(file_no, (clueweb_file, clueweb_dir, fingerprint_store.near_duplicates, max_payload_size))
+             for file_no, clueweb_file in enumerate(clueweb_iter)]
+    skip_ids = []
+    for fingerprints in _run_tasks(pool, _fingerprint_task, tasks, metrics, metrics_writer):
+        file_skip_ids = set()
+        for trec_id, exact, near in fingerprints:
+            canonical, kind = fingerprint_store.add(trec_id, exact, near)
+            if canonical is not None:
+                file_skip_ids.add(trec_id)
+                metrics.incr('duplicates', label=kind)
+        skip_ids.append(file_skip_ids)
+    return skip_ids
+
+
+def read_and_clean_folder(clueweb_iter, ann_list, clueweb_dir, ann_dir, num_processes, metrics, metrics_writer,
+                          shard_dir=None, fingerprint_store=None, max_payload_size=None):
+    """
+    Reads and cleans the files of a folder in parallel. The metrics of each file are merged, and periodically
+    written, as soon as the file is done.
+
+    With a fingerprint store, the duplicates are found first (see find_folder_duplicates()), so they are neither
+    matched nor cleaned. This reads each file twice, which is much cheaper than cleaning the duplicates.
+    :return: List with the cleaned records (or shard path) of each file, in the order of clueweb_iter
+    """
+    clueweb_iter = list(clueweb_iter)
+    pool = multiprocessing.Pool(num_processes)
+    try:
+        skip_ids = [None] * len(clueweb_iter)
+        if fingerprint_store is not None:
+            start = time.time()
+            skip_ids = find_folder_duplicates(pool, clueweb_iter, clueweb_dir, fingerprint_store, metrics,
+                                              metrics_writer, max_payload_size)
+            metrics.add_time('dedup_folder', time.time() - start)
+        tasks = [(file_no, (clueweb_file, ann_file, clueweb_dir, ann_dir, shard_dir), skip_ids[file_no],
+                  max_payload_size)
+                 for file_no, (clueweb_file, ann_file) in enumerate(zip(clueweb_iter, ann_list))]
+        results = _run_tasks(pool, _read_and_clean_task, tasks, metrics, metrics_writer)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return results
+
+
+def match_annotation_files(clueweb_dir, ann_dir):
+    """
+    Returns the ClueWeb files in clueweb_dir, and the corresponding annotation files in ann_dir.
+    :param clueweb_dir: Warc files directory
+    :param ann_dir: Annotations directory
+    :return: sorted list of warc files, list of annotation files
+    """
+    ann_iter = (sorted(os.listdir(ann_dir)))
+    clueweb_iter = (sorted(os.listdir(clueweb_dir)))
+    # Ann_dir and clueweb_dir sometimes have different number of files
+    # Loop through, and create new ann list with correct files
+    ann_list = []
+    for cw_file in clueweb_iter:
+        for ann_file in ann_iter:
+            # Split to only get filename, and not file extensions
+            if cw_file.split(".")[0] == ann_file.split(".")[0]:
+                ann_list.append(ann_file)
+    return clueweb_iter, ann_list
 
 
 def main():
@@ -100,42 +269,79 @@ def main():
     parser.add_argument("-clueweb_dir", help="Clueweb directory")
     parser.add_argument("-output_dir", help="Output directory")
     parser.add_argument("-num_processes", help="Number of processes to run")
+    parser.add_argument("-metrics_file", help="Metrics output file", default=None)
+    parser.add_argument("-metrics_format", help="Metrics format (json or prometheus)", default="json")
+    parser.add_argument("-metrics_interval", help="Seconds between metrics writes", type=int, default=60)
+    parser.add_argument("-mismatch_log", help="Mismatch log CSV file", default="records_indexed_fix.csv")
+    parser.add_argument("-shard_dir", help="Shard output directory", default=None)
+    parser.add_argument("-dedup", help="Duplicate detection (none, exact or near)", default="none",
+                        choices=["none", "exact", "near"])
+    parser.add_argument("-duplicates_dir", help="Duplicates file directory", default=None)
+    parser.add_argument("-dedup_scope", help="Find duplicates across all folders (all) or within each folder "
+                                             "(folder)", default="all", choices=["all", "folder"])
+    parser.add_argument("-max_payload_size", help="Records larger than this number of bytes are stripped "
+                                                  "incrementally and cut to this number of characters. Their entity "
+                                                  "mentions are not replaced, so their contents_annotated field is "
+                                                  "their plain cleaned text, without Freebase ids (see the "
+                                                  "oversized_annotations and oversized_truncated metrics)",
+                        type=int, default=None)
     args = parser.parse_args()
 
+    # Fingerprints of all folders, kept in the main process, see read_and_clean_folder()
+    fingerprint_store = None
+    if args.dedup != "none" and args.dedup_scope == "all":
+        fingerprint_store = FingerprintStore(near_duplicates=args.dedup == "near")
+    duplicates_dir = args.duplicates_dir if args.duplicates_dir is not None else args.output_dir
+
+    # Start the mismatch writer before the worker processes are forked, so they inherit the handler
+    mismatch_writer = MismatchLogWriter(args.mismatch_log)
+    mismatch_writer.start()
+
     num_processes = int(args.num_processes)
+    metrics = Metrics()
+    metrics_writer = MetricsWriter(metrics, args.metrics_file, args.metrics_format, args.metrics_interval)
 
-    # Iterate over each subdirectory in the clueweb dir
-    for subdir, dirs, files in os.walk(args.clueweb_dir):
-        for folder in dirs:
-            ann_dir = os.path.join(args.ann_dir, folder)
-            clueweb_dir = os.path.join(args.clueweb_dir, folder)
-            output_dir = os.path.join(args.output_dir, folder)
-            
-            ann_iter = (sorted(os.listdir(ann_dir)))
-            clueweb_iter = (sorted(os.listdir(clueweb_dir)))
-            # Ann_dir and clueweb_dir sometimes have different number of files
-            # Loop through, and create new ann list with correct files
-            ann_list = []
-            for cw_file in clueweb_iter:
-                for ann_file in ann_iter:
-                    # Split to only get filename, and not file extensions
-                    if cw_file.split(".")[0] == ann_file.split(".")[0]:
-                        ann_list.append(ann_file)
-            kwargs = {'processes': num_processes}
+    try:
+        # Iterate over each subdirectory in the clueweb dir
+        for subdir, dirs, files in os.walk(args.clueweb_dir):
+            for folder in dirs:
+                ann_dir = os.path.join(args.ann_dir, folder)
+                clueweb_dir = os.path.join(args.clueweb_dir, folder)
+                output_dir = os.path.join(args.output_dir, folder)
+                shard_dir = os.path.join(args.shard_dir, folder) if args.shard_dir is not None else None
             
-            start = time.time()
-            # Read and clean files in parallel
-            results = parmap.starmap(read_and_clean_files, zip(clueweb_iter, ann_list),
-                                     clueweb_dir, ann_dir, **kwargs)
-            end = time.time()
-            print "Time used reading and cleaning all files", end - start
-            start = time.time()
-            # Initiate indexer
-            indexer = Indexer(output_dir)
-            # Index all the cleaned records
-            indexer.index_files(results)
-            end = time.time()
-            print "Time used indexing all files", end - start
+                clueweb_iter, ann_list = match_annotation_files(clueweb_dir, ann_dir)
+                if args.dedup != "none" and args.dedup_scope == "folder":
+                    fingerprint_store = FingerprintStore(near_duplicates=args.dedup == "near")
+
+                start = time.time()
+                # Read and clean files in parallel
+                results = read_and_clean_folder(clueweb_iter, ann_list, clueweb_dir, ann_dir, num_processes,
+                                                metrics, metrics_writer, shard_dir, fingerprint_store,
+                                                args.max_payload_size)
+                end = time.time()
+                print "Time used reading and cleaning all files", end - start
+                if fingerprint_store is not None:
+                    # Written next to the index, since the index directory only contains Lucene files
+                    if not os.path.isdir(duplicates_dir):
+                        os.makedirs(duplicates_dir)
+                    write_duplicates(fingerprint_store.duplicates,
+                                     os.path.join(duplicates_dir, folder + ".duplicates.tsv"))
+                    del fingerprint_store.duplicates[:]
+                metrics.add_time('clean_folder', end - start)
+                metrics_writer.write()
+                start = time.time()
+                # Initiate indexer
+                indexer = Indexer(output_dir, metrics, metrics_writer)
+                # Index all the cleaned records
+                indexer.index_files(results)
+                end = time.time()
+                print "Time used indexing all files", end - start
+                metrics.add_time('index_folder', end - start)
+                metrics_writer.write()
+    finally:
+        # Flush the mismatch log, also when a worker failed
+        mismatch_writer.stop()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,143 @@
+"""
+In-memory stand-in for IndexCache, implementing the index calls used by Model2.
+
+Lets Model 2 be profiled and benchmarked on a synthetic corpus, without a ClueWeb12 Lucene index.
+First-pass retrieval uses Dirichlet smoothed language models, like Lucene's LMDirichletSimilarity.
+
+@author: Tino Hakim Lazreg
+"""
+
+from __future__ import division
+
+import heapq
+import math
+
+from nordlys.retrieval.results import RetrievalResults
+
+
+class MemoryIndex(object):
+    """
+    In-memory index of a corpus of pre-tokenized documents.
+
+    :param corpus: List of (doc_id, {field_name: [terms]}) tuples, e.g. from SyntheticCorpusGenerator
+    :param mu: Dirichlet smoothing parameter used by score_query()
+    """
+
+    def __init__(self, corpus, mu=2000):
+        self.mu = mu
+        self.doc_ids = []
+        self.lucene_doc_ids = {}
+        self.doc_termfreqs = []
+        self.doc_lengths = []
+        self.postings = {}
+        self.coll_termfreqs = {}
+        self.coll_lengths = {}
+        self.doc_counts = {}
+        for doc_id, fields in corpus:
+            self.add_document(doc_id, fields)
+
+    def add_document(self, doc_id, fields):
+        """
+        Adds a document to the index.
+
+        :param doc_id: WARC-TREC-ID of the document
+        :param fields: Dictionary {field_name: [terms]}
+        """
+        lucene_doc_id = len(self.doc_ids)
+        self.doc_ids.append(doc_id)
+        self.lucene_doc_ids[doc_id] = lucene_doc_id
+        termfreqs = {}
+        lengths = {}
+        for field, terms in fields.iteritems():
+            tf = {}
+            for term in terms:
+                tf[term] = tf.get(term, 0) + 1
+            termfreqs[field] = tf
+            lengths[field] = len(terms)
+            if terms:
+                self.doc_counts[field] = self.doc_counts.get(field, 0) + 1
+            self.coll_lengths[field] = self.coll_lengths.get(field, 0) + len(terms)
+            field_postings = self.postings.setdefault(field, {})
+            field_coll_termfreqs = self.coll_termfreqs.setdefault(field, {})
+            for term, freq in tf.iteritems():
+                field_postings.setdefault(term, []).append(lucene_doc_id)
+                field_coll_termfreqs[term] = field_coll_termfreqs.get(term, 0) + freq
+        self.doc_termfreqs.append(termfreqs)
+        self.doc_lengths.append(lengths)
+
+    def open_searcher(self):
+        pass
+
+    def close_reader(self):
+        pass
+
+    def num_docs(self):
+        return len(self.doc_ids)
+
+    def get_lucene_document_id(self, doc_id):
+        return self.lucene_doc_ids[doc_id]
+
+    def get_doc_id(self, lucene_doc_id):
+        return self.doc_ids[lucene_doc_id]
+
+    def get_doc_termfreqs(self, lucene_doc_id, field):
+        """Returns the term frequencies {term: freq} of a document field."""
+        return self.doc_termfreqs[lucene_doc_id].get(field, {})
+
+    def get_doc_termvector(self, lucene_doc_id, field):
+        """Returns the term vector as (term, termenum) pairs. There are no term enums in memory, so they are None."""
+        return [(term, None) for term in sorted(self.get_doc_termfreqs(lucene_doc_id, field))]
+
+    def get_doc_length(self, lucene_doc_id, field):
+        return self.doc_lengths[lucene_doc_id].get(field, 0)
+
+    def get_doc_count(self, field):
+        """Returns the number of documents with the field."""
+        return self.doc_counts.get(field, 0)
+
+    def get_doc_freq(self, term, field):
+        return len(self.postings.get(field, {}).get(term, []))
+
+    def get_coll_termfreq(self, term, field):
+        return self.coll_termfreqs.get(field, {}).get(term, 0)
+
+    def get_coll_length(self, field):
+        return self.coll_lengths.get(field, 0)
+
+    def score_query(self, query, field_content, field_id=None, num_docs=100, p_t_c=None):
+        """
+        Scores all documents containing at least one query term, using Dirichlet smoothed language models.
+
+        :param query: Preprocessed query
+        :param field_content: Field to score
+        :param field_id: Not used, document ids are stored with the documents
+        :param num_docs: Number of documents to return
+        :param p_t_c: Collection probability {term: p(t|C)} of the query terms, instead of the statistics of this
+                      index, e.g. the global statistics of a FederatedIndex. Terms with p(t|C) = 0 are not scored.
+        :return: RetrievalResults object with doc_id and log p(q|d)
+        """
+        terms = query.split()
+        if p_t_c is None:
+            coll_length = self.get_coll_length(field_content)
+            p_t_c = {term: self.get_coll_termfreq(term, field_content) / coll_length for term in set(terms)}
+        field_postings = self.postings.get(field_content, {})
+        candidates = set()
+        for term in terms:
+            candidates.update(field_postings.get(term, []))
+
+        scores = []
+        for lucene_doc_id in candidates:
+            tf = self.get_doc_termfreqs(lucene_doc_id, field_content)
+            doc_length = self.get_doc_length(lucene_doc_id, field_content)
+            score = 0
+            for term in terms:
+                if not p_t_c.get(term):
+                    continue
+                score += math.log((tf.get(term, 0) + self.mu * p_t_c[term]) / (doc_length + self.mu))
+            scores.append((-score, lucene_doc_id))
+
+        # Ties are broken by the lowest document id, like Lucene
+        results = RetrievalResults()
+        for score, lucene_doc_id in heapq.nsmallest(num_docs, scores):
+            results.append(self.doc_ids[lucene_doc_id], -score, lucene_doc_id)
+        return results
@@ -1,26 +1,243 @@
 """
 Merges several Lucene indexes into one Lucene index.
 
+In single mode, all indexes in index_dir are added to the merged index at once. In tree mode, the indexes are
+merged in groups of fan_in on parallel processes, and the merged groups are merged again until one index is
+left. Each sub-merge runs this module in single mode on a staging directory of symlinks to its inputs.
+Completed sub-merges are recorded in a checkpoint file, so an interrupted merge resumes where it stopped.
+
+Input:
+    -index_dir Directory with the indexes that should be merged (e.g. the per-folder indexes of indexer.py)
+    -merged_index_dir Merged index directory
+    -mode single or tree
+    -fan_in Number of indexes merged by each sub-merge (tree mode)
+    -num_processes Number of sub-merges running in parallel (tree mode)
+    -work_dir Directory for intermediate indexes and the checkpoint file (tree mode)
+    -max_segments Force-merge the merged index down to this number of segments
+
 @author: Tino Hakim Lazreg
 """
 
 import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
 from nordlys.retrieval.lucene_tools import Lucene
 
+CHECKPOINT_FILE = "checkpoint.json"
+
+
+def is_index(path):
+    """Returns True if the directory contains a Lucene index."""
+    return os.path.isdir(path) and any(name.startswith("segments") for name in os.listdir(path))
+
+
+def discover_indexes(index_dir):
+    """Returns the sorted paths of the Lucene indexes in a directory."""
+    return [os.path.join(index_dir, name) for name in sorted(os.listdir(index_dir))
+            if is_index(os.path.join(index_dir, name))]
+
+
+def get_index_size(path):
+    """Returns the size in bytes of the files of an index."""
+    path = os.path.realpath(path)
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path)
+               if os.path.isfile(os.path.join(path, name)))
+
+
+def plan_merges(indexes, merged_index_dir, work_dir, fan_in):
+    """
+    Returns the sub-merges of a tree merge, as a list of levels. Each level is a list of (output_dir, inputs)
+    tuples, which only depend on the outputs of previous levels. The last level writes merged_index_dir.
+    """
+    if len(indexes) == 1:
+        return [[(merged_index_dir, indexes)]]
+    levels = []
+    level_no = 0
+    while len(indexes) > 1:
+        level_no += 1
+        groups = [indexes[i:i + fan_in] for i in range(0, len(indexes), fan_in)]
+        if len(groups) == 1:
+            levels.append([(merged_index_dir, groups[0])])
+            break
+        level = []
+        next_indexes = []
+        for group_no, group in enumerate(groups):
+            if len(group) == 1:
+                # Nothing to merge, the index moves up a level as is
+                next_indexes.append(group[0])
+                continue
+            output_dir = os.path.join(work_dir, "level%d" % level_no, "merge%04d" % group_no)
+            level.append((output_dir, group))
+            next_indexes.append(output_dir)
+        levels.append(level)
+        indexes = next_indexes
+    return levels
+
+
+def plan_cleanup(levels):
+    """
+    Returns, for each level of a tree merge, the intermediate indexes that can be deleted once the level is merged.
+    An intermediate index is only deleted by the level that merges it; indexes that are carried up a level unmerged
+    are kept until then.
+    """
+    outputs = set(output_dir for level in levels for output_dir, _ in level)
+    return [[input_dir for _, inputs in level for input_dir in inputs if input_dir in outputs] for level in levels]
+
+
+def is_merged(checkpoint, output_dir, inputs):
+    """Returns True if the checkpoint records the sub-merge as done, and its output still exists or was used up."""
+    entry = checkpoint.get(output_dir, {})
+    return entry.get('inputs') == inputs and (entry.get('deleted', False) or os.path.isdir(output_dir))
+
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_checkpoint(checkpoint, path):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f, indent=2, sort_keys=True)
+    os.rename(tmp_path, path)
+
+
+def merge_indexes(index_dir, merged_index_dir, max_segments=None):
+    """
+    Adds all indexes in index_dir to the merged index.
+
+    :param index_dir: Directory with the indexes that should be merged
+    :param merged_index_dir: Merged index directory
+    :param max_segments: Force-merge the merged index down to this number of segments, None to skip it
+    """
+    lucene = Lucene(merged_index_dir)
+    lucene.open_writer()
+    print "Merging indexes..."
+    lucene.add_indexes(index_dir)
+    if max_segments is not None:
+        print "Force merging to " + str(max_segments) + " segments..."
+        lucene.writer.forceMerge(max_segments)
+    print "Indexes is now merged: " + merged_index_dir
+    lucene.close_writer()
+
+
+def _start_merge(output_dir, inputs, work_dir, max_segments):
+    """Starts a sub-merge process, merging the inputs through a staging directory of symlinks."""
+    staging_dir = os.path.join(work_dir, "staging", os.path.relpath(output_dir, work_dir).replace(os.sep, "_"))
+    if os.path.isdir(staging_dir):
+        shutil.rmtree(staging_dir)
+    os.makedirs(staging_dir)
+    for input_no, input_dir in enumerate(inputs):
+        os.symlink(os.path.abspath(input_dir), os.path.join(staging_dir, "%04d" % input_no))
+    # Remove the partial output of an interrupted run
+    if os.path.isdir(output_dir):
+        shutil.rmtree(output_dir)
+    command = [sys.executable, "-m", "nordlys.preprocessor.merge_indexer", "-mode", "single",
+               "-index_dir", staging_dir, "-merged_index_dir", output_dir]
+    if max_segments is not None:
+        command += ["-max_segments", str(max_segments)]
+    return subprocess.Popen(command), staging_dir
+
+
+def _record_merge(checkpoint, checkpoint_path, output_dir, staging_dir, inputs, num_bytes, merge_start):
+    """Records a completed sub-merge in the checkpoint, and returns its duration in seconds."""
+    shutil.rmtree(staging_dir)
+    seconds = time.time() - merge_start
+    checkpoint[output_dir] = {'inputs': inputs, 'bytes': num_bytes, 'seconds': seconds}
+    save_checkpoint(checkpoint, checkpoint_path)
+    return seconds
+
+
+def tree_merge(index_dir, merged_index_dir, work_dir, fan_in=2, num_processes=4, max_segments=None):
+    """
+    Merges the indexes in index_dir in a tree of parallel sub-merges.
+
+    :param index_dir: Directory with the indexes that should be merged
+    :param merged_index_dir: Merged index directory
+    :param work_dir: Directory for the intermediate indexes and the checkpoint file
+    :param fan_in: Number of indexes merged by each sub-merge
+    :param num_processes: Number of sub-merges running in parallel
+    :param max_segments: Force-merge the merged index down to this number of segments, None to skip it
+    """
+    indexes = discover_indexes(index_dir)
+    print "Found " + str(len(indexes)) + " indexes in " + index_dir
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+    checkpoint_path = os.path.join(work_dir, CHECKPOINT_FILE)
+    checkpoint = load_checkpoint(checkpoint_path)
+    levels = plan_merges(indexes, merged_index_dir, work_dir, fan_in)
+    cleanup = plan_cleanup(levels)
+    total_bytes = 0
+    start = time.time()
+
+    for level_no, level in enumerate(levels, 1):
+        pending = [(output_dir, inputs) for output_dir, inputs in level
+                   if not is_merged(checkpoint, output_dir, inputs)]
+        print "Level " + str(level_no) + ": " + str(len(level) - len(pending)) + " of " + str(len(level)) + \
+              " merges already done"
+        running = {}
+        while pending or running:
+            while pending and len(running) < num_processes:
+                output_dir, inputs = pending.pop(0)
+                final = output_dir == merged_index_dir
+                process, staging_dir = _start_merge(output_dir, inputs, work_dir, max_segments if final else None)
+                running[output_dir] = (process, staging_dir, inputs, sum(get_index_size(i) for i in inputs),
+                                       time.time())
+            time.sleep(1)
+            for output_dir, (process, staging_dir, inputs, num_bytes, merge_start) in running.items():
+                if process.poll() is None:
+                    continue
+                del running[output_dir]
+                if process.returncode != 0:
+                    # Let the other sub-merges finish, and checkpoint the successful ones, so they are not redone
+                    for other_dir, other in running.items():
+                        if other[0].wait() == 0:
+                            _record_merge(checkpoint, checkpoint_path, other_dir, *other[1:])
+                    raise RuntimeError("Merge of " + output_dir + " failed with exit code " +
+                                       str(process.returncode))
+                seconds = _record_merge(checkpoint, checkpoint_path, output_dir, staging_dir, inputs, num_bytes,
+                                        merge_start)
+                total_bytes += num_bytes
+                print "Merged " + output_dir + ": " + str(num_bytes // 2 ** 20) + " MB in " + \
+                      str(round(seconds, 1)) + "s (" + str(round(num_bytes / 2.0 ** 20 / max(seconds, 1e-6), 1)) + \
+                      " MB/s)"
+        # Intermediate indexes merged by this level are no longer needed
+        for index in cleanup[level_no - 1]:
+            if os.path.isdir(index):
+                shutil.rmtree(index)
+            checkpoint[index]['deleted'] = True
+        save_checkpoint(checkpoint, checkpoint_path)
+
+    seconds = time.time() - start
+    print "Indexes is now merged: " + merged_index_dir + " (" + str(total_bytes // 2 ** 20) + " MB merged in " + \
+          str(round(seconds, 1)) + "s, " + str(round(total_bytes / 2.0 ** 20 / max(seconds, 1e-6), 1)) + " MB/s)"
+
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-index_dir", help="Indexes that should be merged")
     parser.add_argument("-merged_index_dir", help="Merged index directory")
+    parser.add_argument("-mode", help="Merge all indexes at once (single) or in parallel groups (tree)",
+                        default="single", choices=["single", "tree"])
+    parser.add_argument("-fan_in", help="Indexes per sub-merge (tree mode)", type=int, default=2)
+    parser.add_argument("-num_processes", help="Parallel sub-merges (tree mode)", type=int, default=4)
+    parser.add_argument("-work_dir", help="Intermediate index directory (tree mode)", default=None)
+    parser.add_argument("-max_segments", help="Force-merge to this number of segments", type=int, default=None)
     args = parser.parse_args()
-    lucene = Lucene(args.merged_index_dir)
-    lucene.open_writer()
-    print "Merging indexes..."
-    lucene.add_indexes(args.index_dir)
-    print "Indexes is now merged: " + args.merged_index_dir
-    lucene.close_writer()
+    if args.mode == "tree":
+        work_dir = args.work_dir if args.work_dir is not None else args.merged_index_dir.rstrip(os.sep) + "_work"
+        tree_merge(args.index_dir, args.merged_index_dir, work_dir, args.fan_in, args.num_processes,
+                   args.max_segments)
+    else:
+        merge_indexes(args.index_dir, args.merged_index_dir, args.max_segments)
 
 
 if __name__ == '__main__':
     main()
-
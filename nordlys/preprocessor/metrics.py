@@ -0,0 +1,165 @@
+"""
+Lightweight instrumentation for the preprocessing pipeline.
+
+Counters and timers are plain dictionaries updated in-process, so they are cheap enough
+to leave on during long indexing runs. Worker processes return a snapshot of their
+metrics, which is merged in the main process and periodically written to disk.
+
+Output:
+    Metrics file in JSON or Prometheus text format
+
+@author: Tino Hakim Lazreg
+"""
+
+import json
+import math
+import os
+import time
+
+
+def percentile(values, p):
+    """Returns the p-th percentile (0-100) of a list of values, using the nearest rank."""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(0, min(len(values) - 1, int(math.ceil(p / 100.0 * len(values))) - 1))
+    return values[rank]
+
+
+class Metrics(object):
+    """
+    Collects counters and timers, optionally split by a label (e.g. encoding).
+
+    Counters are stored as {name: {label: value}}, timers as {name: {label: [count, seconds]}}.
+    The label "" is used when no label is given.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.timers = {}
+
+    def incr(self, name, value=1, label=""):
+        """
+        Increments a counter.
+
+        :param name: Counter name
+        :param value: Value to add
+        :param label: Optional label
+        """
+        counter = self.counters.setdefault(name, {})
+        counter[label] = counter.get(label, 0) + value
+
+    def add_time(self, name, seconds, label=""):
+        """
+        Adds a measured duration to a timer.
+
+        :param name: Timer name
+        :param seconds: Elapsed time in seconds
+        :param label: Optional label
+        """
+        timer = self.timers.setdefault(name, {})
+        if label in timer:
+            entry = timer[label]
+            entry[0] += 1
+            entry[1] += seconds
+        else:
+            timer[label] = [1, seconds]
+
+    def merge(self, other):
+        """
+        Merges another Metrics object, or a snapshot of one, into this object.
+
+        :param other: Metrics object or dictionary returned by snapshot()
+        """
+        if other is None:
+            return
+        if isinstance(other, Metrics):
+            other = other.snapshot()
+        for name, labels in other.get('counters', {}).iteritems():
+            for label, value in labels.iteritems():
+                self.incr(name, value, label)
+        for name, labels in other.get('timers', {}).iteritems():
+            timer = self.timers.setdefault(name, {})
+            for label, (count, seconds) in labels.iteritems():
+                entry = timer.setdefault(label, [0, 0.0])
+                entry[0] += count
+                entry[1] += seconds
+
+    def snapshot(self):
+        """
+        Returns a picklable and JSON serializable copy of the metrics.
+        """
+        return {'counters': {name: dict(labels) for name, labels in self.counters.iteritems()},
+                'timers': {name: {label: list(entry) for label, entry in labels.iteritems()}
+                           for name, labels in self.timers.iteritems()}}
+
+    def to_prometheus(self, prefix="nordlys_preprocessor"):
+        """
+        Returns the metrics in Prometheus text exposition format.
+
+        :param prefix: Prefix for all metric names
+        """
+        lines = []
+        for name in sorted(self.counters):
+            metric = prefix + "_" + name + "_total"
+            lines.append("# TYPE " + metric + " counter")
+            for label, value in sorted(self.counters[name].iteritems()):
+                lines.append(metric + self._format_label(label) + " " + str(value))
+        for name in sorted(self.timers):
+            metric = prefix + "_" + name + "_seconds"
+            lines.append("# TYPE " + metric + " summary")
+            for label, (count, seconds) in sorted(self.timers[name].iteritems()):
+                lines.append(metric + "_count" + self._format_label(label) + " " + str(count))
+                lines.append(metric + "_sum" + self._format_label(label) + " " + repr(seconds))
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _format_label(label):
+        if label == "":
+            return ""
+        return '{label="' + str(label).replace('\\', '\\\\').replace('"', '\\"') + '"}'
+
+    def write(self, path, fmt="json"):
+        """
+        Writes the metrics to a file. The file is replaced atomically, so readers never see a partial file.
+
+        :param path: Output file
+        :param fmt: "json" or "prometheus"
+        """
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            if fmt == "prometheus":
+                f.write(self.to_prometheus())
+            else:
+                json.dump(self.snapshot(), f, indent=2, sort_keys=True)
+        os.rename(tmp_path, path)
+
+
+class MetricsWriter(object):
+    """
+    Writes a Metrics object to disk, at most once per interval.
+
+    :param metrics: Metrics object
+    :param path: Output file, or None to disable writing
+    :param fmt: "json" or "prometheus"
+    :param interval: Minimum number of seconds between writes
+    """
+
+    def __init__(self, metrics, path, fmt="json", interval=60):
+        self.metrics = metrics
+        self.path = path
+        self.fmt = fmt
+        self.interval = interval
+        self.last_write = 0
+
+    def maybe_write(self):
+        """Writes the metrics if the interval has passed since the last write."""
+        if self.path is not None and time.time() - self.last_write >= self.interval:
+            self.write()
+
+    def write(self):
+        """Writes the metrics unconditionally."""
+        if self.path is None:
+            return
+        self.metrics.write(self.path, self.fmt)
+        self.last_write = time.time()
@@ -0,0 +1,128 @@
+"""
+Queue-based logging of entity mentions that could not be matched with their FACC annotation.
+
+Worker processes put structured mismatch records on a multiprocessing queue, and a single
+writer process batches them into a CSV file, so workers never block on disk I/O.
+Logging is disabled until an entry point calls MismatchLogWriter.start().
+
+Output:
+    CSV file with columns: trec_id, warc_path, entity_mention, found_entity, cleaned_entity, cleaned_annotation
+
+@author: Tino Hakim Lazreg
+"""
+
+import csv
+import logging
+import multiprocessing
+import os
+from Queue import Empty
+
+MISMATCH_FIELDS = ["trec_id", "warc_path", "entity_mention", "found_entity", "cleaned_entity", "cleaned_annotation"]
+
+mismatch_logger = logging.getLogger('nordlys.preprocessor.mismatch')
+mismatch_logger.propagate = False
+
+
+def mismatch_logging_enabled():
+    """
+    Returns True if a handler is attached, so callers can skip building mismatch records otherwise.
+    """
+    return bool(mismatch_logger.handlers)
+
+
+def log_mismatch(*fields):
+    """
+    Logs a mismatch record. The fields are sent as-is, and converted to CSV by the writer process.
+
+    :param fields: Values in the order of MISMATCH_FIELDS
+    """
+    mismatch_logger.warning("Entity mention mismatch", extra={'mismatch': fields})
+
+
+class QueueHandler(logging.Handler):
+    """
+    Sends the mismatch fields of log records to a multiprocessing queue.
+
+    :param queue: multiprocessing.Queue
+    """
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(getattr(record, 'mismatch', (record.getMessage(),)))
+        except Exception:
+            self.handleError(record)
+
+
+def _to_csv_value(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def _write_mismatches(queue, path, batch_size, flush_interval):
+    """
+    Writer process loop. Reads mismatch records from the queue until None is received,
+    and writes them to the CSV file in batches.
+    """
+    write_header = not os.path.exists(path) or os.path.getsize(path) == 0
+    with open(path, "ab") as f:
+        writer = csv.writer(f)
+        if write_header:
+            writer.writerow(MISMATCH_FIELDS)
+        batch = []
+        done = False
+        while not done:
+            try:
+                fields = queue.get(timeout=flush_interval)
+                if fields is None:
+                    done = True
+                else:
+                    batch.append([_to_csv_value(value) for value in fields])
+            except Empty:
+                pass
+            if batch and (done or len(batch) >= batch_size or queue.empty()):
+                writer.writerows(batch)
+                f.flush()
+                del batch[:]
+
+
+class MismatchLogWriter(object):
+    """
+    Runs the mismatch writer process, and attaches a QueueHandler to the mismatch logger.
+    Must be started before the worker processes are created, so they inherit the handler.
+
+    :param path: CSV output file
+    :param batch_size: Maximum number of records per write
+    :param flush_interval: Maximum number of seconds a record waits before it is written
+    """
+
+    def __init__(self, path, batch_size=1000, flush_interval=1.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = None
+        self.process = None
+        self.handler = None
+
+    def start(self):
+        self.queue = multiprocessing.Queue()
+        self.process = multiprocessing.Process(target=_write_mismatches,
+                                               args=(self.queue, self.path, self.batch_size, self.flush_interval))
+        self.process.daemon = True
+        self.process.start()
+        self.handler = QueueHandler(self.queue)
+        mismatch_logger.addHandler(self.handler)
+
+    def stop(self):
+        """Detaches the handler, and waits for the writer process to write the remaining records."""
+        if self.process is None:
+            return
+        mismatch_logger.removeHandler(self.handler)
+        self.queue.put(None)
+        self.process.join()
+        self.process = None
+        self.handler = None
@@ -0,0 +1,236 @@
+"""
+Long-running Model 2 scoring service.
+
+Keeps the index searcher and the document statistics cache of a Model2 object open, and serves
+entity rankings over HTTP. Concurrent requests are grouped into micro-batches, which are scored
+together so documents retrieved for several queries are only looked up once.
+
+Input:
+    -index_dir Index directory
+    -index_dirs Shard index directories, scored as one index without merging them (see federated_index)
+    -backend Index backend, lucene or numpy (see numpy_index)
+    -host Host to listen on
+    -port Port to listen on
+    -max_batch_size Maximum number of queries per batch
+    -max_wait_ms Maximum time a request waits for a batch to fill up
+    -first_pass_num_docs Number of documents retrieved in the first pass
+    -doc_cache_size Size in bytes of the document statistics cache
+
+Endpoints:
+    GET /ranking?q=<query>&k=<number of entities>   Top-k Freebase entities for the query
+    GET /stats                                      Latency percentiles, batch sizes and cache statistics
+
+@author: Tino Hakim Lazreg
+"""
+
+import argparse
+import itertools
+import threading
+import time
+from collections import deque
+from Queue import Queue, Empty
+
+from flask import Flask, request
+from flask_restful import Api, Resource, abort
+
+from nordlys.preprocessor.clueweb_facc_scorer import Model2
+from nordlys.preprocessor.federated_index import attach_current_thread
+from nordlys.preprocessor.metrics import percentile
+from nordlys.preprocessor.run_file import get_freebase_url
+from nordlys.retrieval.lucene_tools import Lucene
+
+
+class PendingQuery(object):
+    """A query waiting to be scored by the MicroBatcher."""
+
+    def __init__(self, q_id, query):
+        self.q_id = q_id
+        self.query = query
+        self.done = threading.Event()
+        self.p_q_e = None
+        self.error = None
+
+
+class MicroBatcher(object):
+    """
+    Scores queries submitted from several threads in micro-batches, on a single scoring thread.
+
+    :param model2: Model2 object with an opened index
+    :param max_batch_size: Maximum number of queries per batch
+    :param max_wait: Maximum number of seconds the first query of a batch waits for more queries
+    :param latency_window: Number of recent requests the latency percentiles are computed over
+    """
+
+    def __init__(self, model2, max_batch_size=16, max_wait=0.01, latency_window=10000):
+        self.model2 = model2
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = Queue()
+        self.q_ids = itertools.count()
+        self.latencies = deque(maxlen=latency_window)
+        self.num_batches = 0
+        self.num_queries = 0
+        self.num_failed_batches = 0
+        self.thread = threading.Thread(target=self._run, name="model2-batcher")
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def submit(self, query):
+        """
+        Scores a query, and blocks until its batch is scored.
+
+        :param query: Query text
+        :return: p(q|e) dictionary {(entity_id, q_id): score}
+        """
+        start = time.time()
+        pending = PendingQuery(str(next(self.q_ids)), query)
+        self.queue.put(pending)
+        pending.done.wait()
+        self.latencies.append(time.time() - start)
+        if pending.error is not None:
+            raise pending.error
+        return pending.p_q_e
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except Empty:
+                break
+        return batch
+
+    def _score_batch(self, queries):
+        """
+        Scores the queries of a batch. If the batch fails, the queries are scored one by one, so a failing query
+        only fails its own requests.
+
+        :param queries: List of (q_id, query) tuples
+        :return: Dictionary {q_id: (p(q|e) dictionary, exception)}, with None for the one that does not apply
+        """
+        try:
+            results = self.model2.get_p_q_e_batch(queries)
+            return {q_id: (results[q_id], None) for q_id, _ in queries}
+        except Exception as e:
+            if len(queries) == 1:
+                return {queries[0][0]: (None, e)}
+        self.num_failed_batches += 1
+        results = {}
+        for q_id, query in queries:
+            try:
+                results[q_id] = (self.model2.get_p_q_e_batch([(q_id, query)])[q_id], None)
+            except Exception as e:
+                results[q_id] = (None, e)
+        return results
+
+    def _run(self):
+        attach_current_thread()
+        while True:
+            batch = self._next_batch()
+            # Identical queries in a batch are scored once
+            unique = {}
+            for pending in batch:
+                unique.setdefault(pending.query, pending.q_id)
+            results = self._score_batch([(q_id, query) for query, q_id in unique.iteritems()])
+            for pending in batch:
+                pending.p_q_e, pending.error = results[unique[pending.query]]
+            self.num_batches += 1
+            self.num_queries += len(batch)
+            for pending in batch:
+                pending.done.set()
+
+    def stats(self):
+        latencies = list(self.latencies)
+        return {'requests': self.num_queries,
+                'batches': self.num_batches,
+                'failed_batches': self.num_failed_batches,
+                'mean_batch_size': self.num_queries / float(self.num_batches) if self.num_batches else None,
+                'latency_p50': percentile(latencies, 50),
+                'latency_p99': percentile(latencies, 99)}
+
+
+class EntityRanking(Resource):
+    batcher = None
+
+    def get(self):
+        query = request.args.get('q')
+        if not query:
+            abort(400, message="Missing query parameter q")
+        try:
+            k = int(request.args.get('k', 10))
+        except ValueError:
+            abort(400, message="k must be an integer")
+        start = time.time()
+        p_q_e = self.batcher.submit(query)
+        ranking = sorted(((score, entity_id) for (entity_id, _), score in p_q_e.iteritems()), reverse=True)[:k]
+        return {'query': query,
+                'results': [{'rank': rank, 'entity': get_freebase_url(entity_id), 'score': score}
+                            for rank, (score, entity_id) in enumerate(ranking, 1)],
+                'latency': time.time() - start}
+
+
+class Stats(Resource):
+    batcher = None
+
+    def get(self):
+        stats = self.batcher.stats()
+        doc_cache = self.batcher.model2.doc_cache
+        stats['doc_cache'] = doc_cache.stats() if doc_cache is not None else None
+        return stats
+
+
+def create_app(batcher):
+    """
+    Returns the Flask app serving the Model 2 rankings of the batcher.
+    """
+    app = Flask(__name__)
+    api = Api(app)
+    EntityRanking.batcher = batcher
+    Stats.batcher = batcher
+    api.add_resource(EntityRanking, '/ranking')
+    api.add_resource(Stats, '/stats')
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-index_dir", help="Index directory")
+    parser.add_argument("-index_dirs", help="Shard index directories", nargs="+")
+    parser.add_argument("-backend", help="Index backend (lucene or numpy)", default="lucene",
+                        choices=["lucene", "numpy"])
+    parser.add_argument("-host", help="Host to listen on", default="127.0.0.1")
+    parser.add_argument("-port", help="Port to listen on", type=int, default=5000)
+    parser.add_argument("-max_batch_size", help="Maximum queries per batch", type=int, default=16)
+    parser.add_argument("-max_wait_ms", help="Maximum batch wait in milliseconds", type=float, default=10)
+    parser.add_argument("-first_pass_num_docs", help="First pass documents", type=int, default=1000)
+    parser.add_argument("-doc_cache_size", help="Document cache size in bytes", type=int,
+                        default=Model2.DEFAULT_DOC_CACHE_SIZE)
+    args = parser.parse_args()
+
+    config = {'index_dir': args.index_dir,
+              'index_dirs': args.index_dirs,
+              'field_id': Lucene.FIELDNAME_ID,
+              'smoothing_method': "dirichlet",
+              'model': "lm",
+              'first_pass_field': Lucene.FIELDNAME_CONTENTS,
+              'first_pass_num_docs': args.first_pass_num_docs,
+              'doc_cache_size': args.doc_cache_size}
+    index = None
+    if args.backend == "numpy":
+        from nordlys.preprocessor.numpy_index import NumpyIndex
+        index = NumpyIndex(args.index_dir)
+    model2 = Model2(config, lucene=index)
+    model2._open_index()
+    batcher = MicroBatcher(model2, args.max_batch_size, args.max_wait_ms / 1000.0)
+    batcher.start()
+    create_app(batcher).run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
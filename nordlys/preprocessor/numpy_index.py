@@ -0,0 +1,634 @@
+"""
+Inverted index stored in memory-mapped NumPy arrays, for scoring Model 2 without Lucene and the JVM.
+
+The index is built either by exporting an existing Lucene index, or directly from the preprocessor
+output. First-pass Dirichlet LM scoring and Model 2 scoring traverse the postings with vectorized
+NumPy operations.
+
+Input:
+    -index_dir NumPy index directory
+    -lucene_index Lucene index to export (optional)
+    -clueweb_dir, -ann_dir ClueWeb and annotation directories to build the index from (optional)
+    -num_processes Number of processes used when building from ClueWeb
+    -analyzer Analyzer used when building from ClueWeb, regex or lucene (Lucene exports always use lucene)
+    -query_file Queries to score (optional)
+    -output_file Run file
+    -resume Resume an interrupted run in output_file, instead of overwriting it
+    -first_pass_num_docs Number of documents scored by Model 2
+    -num_docs Number of entities written per query
+    -mu Dirichlet smoothing parameter
+    -prune_top_n Keep only the top n entities of each document (see entity_pruning). Applied when the index is
+                 built, or at query time when an existing index is scored
+    -prune_mass Keep only the top entities making up this fraction of the p(e|d) of each document, like -prune_top_n
+
+Output:
+    NumPy index directory, and optionally a run file with Model 2 scores
+
+Memory:
+    The builder keeps the postings of all fields in memory until the index is written: about 12 bytes per
+    posting (a distinct term of a document field), plus about 100 bytes per distinct term and per document.
+    Writing a field sorts its postings twice, which takes about 50 more bytes per posting of that field. For
+    example, 1M pages with 400 distinct terms in each of the two fields take about 10 GB to collect, and 30 GB
+    at the peak. When building from ClueWeb, the cleaned records of the files being processed are also held,
+    until they are added to the index. Collections that do not fit are built per folder (one -index_dir per
+    -clueweb_dir folder), and scored with federated_index.FederatedIndex over the folder indexes.
+
+Index layout (one set of arrays per field f):
+    meta.json             Fields, number of documents, per-field document counts and collection lengths, and
+                          the analyzer of the index, which NumpyModel2 also applies to queries
+    doc_ids.npy           WARC-TREC-ID of each document, by internal document number
+    doc_ids_order.npy     Document numbers in WARC-TREC-ID order, for lookups by id
+    f.terms.npy           Sorted vocabulary
+    f.coll_termfreqs.npy  Collection frequency of each term
+    f.post_offsets.npy    Start of the postings of each term (vocabulary size + 1)
+    f.post_docs.npy       Postings document numbers, sorted per term
+    f.post_freqs.npy      Postings term frequencies
+    f.fwd_offsets.npy     Start of the forward list of each document (number of documents + 1)
+    f.fwd_terms.npy       Forward list term ids, sorted per document
+    f.fwd_freqs.npy       Forward list term frequencies
+    f.doc_lengths.npy     Length of each document
+    entities.*.npy        Forward lists restricted to the entity terms of the entity field, optionally pruned,
+                          and the number of entity mentions of each document
+
+@author: Tino Hakim Lazreg
+"""
+
+from __future__ import division
+
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import time
+from StringIO import StringIO
+from array import array
+
+import numpy as np
+
+from nordlys.preprocessor import run_file
+from nordlys.preprocessor.entity_pruning import is_pruning, normalize_pruning, prune_mask
+from nordlys.retrieval.results import RetrievalResults
+
+FIELD_CONTENTS = "contents"
+FIELD_ANNOTATED = "contents_annotated"
+ENTITY_PREFIX = "_m_"
+ANALYZER_REGEX = "regex"
+ANALYZER_LUCENE = "lucene"
+
+ex_token_re = re.compile('\\w+', re.UNICODE)
+
+
+def tokenize(text):
+    """
+    Default tokenizer used when building from preprocessor output. Lowercases and splits on non-word
+    characters, which keeps the _m_ entity ids intact. Use the lucene analyzer to get exactly the terms
+    of a Lucene index.
+    """
+    return ex_token_re.findall(text.lower())
+
+
+def analyze(text, analyzer=ANALYZER_REGEX):
+    """
+    Returns the terms of a text.
+
+    :param analyzer: ANALYZER_REGEX for tokenize(), or ANALYZER_LUCENE for Lucene.preprocess()
+    """
+    if analyzer == ANALYZER_LUCENE:
+        # Only needed for the lucene analyzer, which starts the JVM
+        from nordlys.retrieval.lucene_tools import Lucene
+        return Lucene.preprocess(text).split()
+    if analyzer == ANALYZER_REGEX:
+        return tokenize(text)
+    raise ValueError("Unknown analyzer: " + str(analyzer))
+
+
+def _encode(term):
+    if isinstance(term, unicode):
+        return term.encode('utf-8')
+    return term
+
+
+class NumpyIndexBuilder(object):
+    """
+    Collects documents and writes a NumPy index.
+
+    Postings are collected as compact (term id, document number, frequency) arrays, and sorted when
+    the index is written, so the builder needs memory proportional to the number of postings (see the
+    module docstring).
+
+    :param fields: Fields to index
+    :param entity_field: Field with the entity annotations
+    :param entity_prefix: Prefix of entity terms
+    :param prune_top_n: Keep only the top n entities of each document in the entity lists
+    :param prune_mass: Keep only the top entities making up this fraction of the p(e|d) of each document
+    :param analyzer: Analyzer of the records added with add_record(), see analyze()
+    """
+
+    def __init__(self, fields=(FIELD_CONTENTS, FIELD_ANNOTATED), entity_field=FIELD_ANNOTATED,
+                 entity_prefix=ENTITY_PREFIX, prune_top_n=None, prune_mass=None, analyzer=ANALYZER_REGEX):
+        self.fields = list(fields)
+        self.analyzer = analyzer
+        self.entity_field = entity_field
+        self.entity_prefix = entity_prefix
+        self.prune_top_n = prune_top_n
+        self.prune_mass = prune_mass
+        self.doc_ids = []
+        self.vocabulary = {field: {} for field in self.fields}
+        self.term_ids = {field: array('i') for field in self.fields}
+        self.doc_nos = {field: array('i') for field in self.fields}
+        self.freqs = {field: array('i') for field in self.fields}
+
+    def add_document(self, doc_id, fields):
+        """
+        Adds a document.
+
+        :param doc_id: WARC-TREC-ID of the document
+        :param fields: Dictionary {field_name: {term: freq}} or {field_name: [terms]}
+        """
+        doc_no = len(self.doc_ids)
+        self.doc_ids.append(doc_id)
+        for field in self.fields:
+            terms = fields.get(field, {})
+            if not isinstance(terms, dict):
+                termfreqs = {}
+                for term in terms:
+                    termfreqs[term] = termfreqs.get(term, 0) + 1
+                terms = termfreqs
+            vocabulary = self.vocabulary[field]
+            term_ids = self.term_ids[field]
+            doc_nos = self.doc_nos[field]
+            freqs = self.freqs[field]
+            for term, freq in terms.iteritems():
+                term = _encode(term)
+                term_id = vocabulary.get(term)
+                if term_id is None:
+                    term_id = len(vocabulary)
+                    vocabulary[term] = term_id
+                term_ids.append(term_id)
+                doc_nos.append(doc_no)
+                freqs.append(freq)
+
+    def add_record(self, record):
+        """
+        Adds a record produced by WarcEntry.replace_entity_mentions(), with the same fields as indexer.Indexer.
+        The texts are split into terms with the analyzer of the builder.
+
+        :param record: Dictionary with record_id, cleaned_record and replaced_record
+        """
+        fields = {}
+        for field, key in ((FIELD_CONTENTS, 'cleaned_record'), (FIELD_ANNOTATED, 'replaced_record')):
+            fields[field] = analyze(record[key], self.analyzer)
+        self.add_document(record['record_id'], fields)
+
+    def add_lucene_index(self, lucene):
+        """
+        Adds all documents of a Lucene index. The terms were produced by the Lucene analyzer, which is therefore
+        also the analyzer of the index.
+
+        :param lucene: Opened IndexCache or Lucene object
+        """
+        self.analyzer = ANALYZER_LUCENE
+        for lucene_doc_id in xrange(lucene.num_docs()):
+            fields = {field: lucene.get_doc_termfreqs(lucene_doc_id, field) for field in self.fields}
+            self.add_document(lucene.get_doc_id(lucene_doc_id), fields)
+
+    def build(self, index_dir):
+        """
+        Writes the index to index_dir.
+        """
+        if not os.path.isdir(index_dir):
+            os.makedirs(index_dir)
+        num_docs = len(self.doc_ids)
+        meta = {'fields': self.fields, 'num_docs': num_docs, 'doc_counts': {}, 'coll_lengths': {},
+                'entity_field': self.entity_field, 'entity_prefix': self.entity_prefix, 'analyzer': self.analyzer,
+                'entity_pruning': {'top_n': self.prune_top_n, 'mass': self.prune_mass}}
+
+        doc_ids = np.array([_encode(doc_id) for doc_id in self.doc_ids])
+        np.save(os.path.join(index_dir, "doc_ids.npy"), doc_ids)
+        np.save(os.path.join(index_dir, "doc_ids_order.npy"), np.argsort(doc_ids, kind='mergesort').astype(np.int64))
+
+        for field in self.fields:
+            vocabulary = self.vocabulary[field]
+            terms = sorted(vocabulary)
+            # Map term ids in insertion order to term ids in sorted order
+            remap = np.empty(len(terms), dtype=np.int32)
+            for new_id, term in enumerate(terms):
+                remap[vocabulary[term]] = new_id
+            term_ids = remap[np.frombuffer(self.term_ids[field], dtype=np.int32)] if terms \
+                else np.zeros(0, dtype=np.int32)
+            doc_nos = np.frombuffer(self.doc_nos[field], dtype=np.int32)
+            freqs = np.frombuffer(self.freqs[field], dtype=np.int32)
+
+            doc_lengths = np.bincount(doc_nos, weights=freqs, minlength=num_docs).astype(np.int64)
+            meta['doc_counts'][field] = int(np.count_nonzero(doc_lengths))
+            meta['coll_lengths'][field] = int(doc_lengths.sum())
+            arrays = {'terms': np.array(terms) if terms else np.zeros(0, dtype='S1'),
+                      'coll_termfreqs': np.bincount(term_ids, weights=freqs, minlength=len(terms)).astype(np.int64),
+                      'doc_lengths': doc_lengths}
+
+            # Postings, sorted by term and document
+            order = np.lexsort((doc_nos, term_ids))
+            arrays['post_offsets'] = self._offsets(term_ids, len(terms))
+            arrays['post_docs'] = doc_nos[order]
+            arrays['post_freqs'] = freqs[order]
+
+            # Forward lists, sorted by document and term
+            order = np.lexsort((term_ids, doc_nos))
+            arrays['fwd_offsets'] = self._offsets(doc_nos, num_docs)
+            arrays['fwd_terms'] = term_ids[order]
+            arrays['fwd_freqs'] = freqs[order]
+            for name, values in arrays.iteritems():
+                np.save(os.path.join(index_dir, field + "." + name + ".npy"), values)
+
+            if field == self.entity_field:
+                self._build_entities(index_dir, arrays, terms, num_docs, meta['doc_counts'][field])
+
+        with open(os.path.join(index_dir, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=2, sort_keys=True)
+
+    def _build_entities(self, index_dir, arrays, terms, num_docs, doc_count):
+        """
+        Writes the forward lists of the entity field, restricted to (the kept) entity terms. The number of entity
+        mentions is written separately, since p(e|d) is normalized by all mentions, including pruned ones.
+        """
+        is_entity = np.array([term.startswith(self.entity_prefix) for term in terms], dtype=bool)
+        fwd_terms = arrays['fwd_terms']
+        mask = is_entity[fwd_terms] if len(terms) else np.zeros(0, dtype=bool)
+        doc_nos = np.repeat(np.arange(num_docs, dtype=np.int32), np.diff(arrays['fwd_offsets']))[mask]
+        term_ids = fwd_terms[mask]
+        freqs = arrays['fwd_freqs'][mask]
+        num_mentions = np.bincount(doc_nos, weights=freqs, minlength=num_docs)
+        if is_pruning(self.prune_top_n, self.prune_mass):
+            doc_freqs = np.diff(arrays['post_offsets'])[term_ids]
+            p_e_d = freqs / num_mentions[doc_nos] * np.log(doc_count / doc_freqs)
+            keep = prune_mask(doc_nos, term_ids, p_e_d, self.prune_top_n, self.prune_mass)
+            print "Entity pruning kept " + str(int(keep.sum())) + " of " + str(len(keep)) + " entity associations"
+            doc_nos, term_ids, freqs = doc_nos[keep], term_ids[keep], freqs[keep]
+        np.save(os.path.join(index_dir, "entities.offsets.npy"), self._offsets(doc_nos, num_docs))
+        np.save(os.path.join(index_dir, "entities.terms.npy"), term_ids)
+        np.save(os.path.join(index_dir, "entities.freqs.npy"), freqs)
+        np.save(os.path.join(index_dir, "entities.num_mentions.npy"), num_mentions)
+
+    @staticmethod
+    def _offsets(keys, size):
+        """Returns the start offset of each key in an array sorted by key, plus the total length."""
+        offsets = np.zeros(size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(keys, minlength=size), out=offsets[1:])
+        return offsets
+
+
+class NumpyIndex(object):
+    """
+    Read-only NumPy index. Also implements the IndexCache calls used by Model2.
+
+    :param index_dir: Index directory written by NumpyIndexBuilder
+    :param mmap: Memory-map the arrays instead of reading them into memory
+    """
+
+    def __init__(self, index_dir, mmap=True):
+        self.index_dir = index_dir
+        self.mmap_mode = 'r' if mmap else None
+        with open(os.path.join(index_dir, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.fields = self.meta['fields']
+        self.entity_field = self.meta['entity_field']
+        # Indexes built before the analyzer was recorded were built with the regex tokenizer
+        self.analyzer = self.meta.get('analyzer', ANALYZER_REGEX)
+        self.doc_ids = self._load("doc_ids")
+        self.doc_ids_order = self._load("doc_ids_order")
+        self.arrays = {}
+        for field in self.fields:
+            self.arrays[field] = {name: self._load(field + "." + name)
+                                  for name in ('terms', 'coll_termfreqs', 'doc_lengths', 'post_offsets', 'post_docs',
+                                               'post_freqs', 'fwd_offsets', 'fwd_terms', 'fwd_freqs')}
+        self.entities = {name: self._load("entities." + name) for name in ('offsets', 'terms', 'freqs')}
+        # Indexes built before pruning was added have no separate mention counts
+        if os.path.exists(os.path.join(index_dir, "entities.num_mentions.npy")):
+            self.entities['num_mentions'] = self._load("entities.num_mentions")
+
+    def _load(self, name):
+        return np.load(os.path.join(self.index_dir, name + ".npy"), mmap_mode=self.mmap_mode)
+
+    def get_term_id(self, term, field):
+        """Returns the term id of a term in a field, or None if the term is not in the vocabulary."""
+        terms = self.arrays[field]['terms']
+        term = _encode(term)
+        i = int(np.searchsorted(terms, term))
+        if i < len(terms) and terms[i] == term:
+            return i
+        return None
+
+    def get_postings(self, term_id, field):
+        """Returns the (document numbers, frequencies) arrays of a term id."""
+        arrays = self.arrays[field]
+        start, end = arrays['post_offsets'][term_id], arrays['post_offsets'][term_id + 1]
+        return arrays['post_docs'][start:end], arrays['post_freqs'][start:end]
+
+    def score_dirichlet(self, query_terms, field, num_docs=1000, mu=2000, p_t_c=None):
+        """
+        Scores the documents containing at least one query term with Dirichlet smoothed language models.
+
+        :param query_terms: List of query terms
+        :param field: Field to score
+        :param num_docs: Number of documents to return
+        :param mu: Dirichlet smoothing parameter
+        :param p_t_c: Collection probability {term: p(t|C)} of the query terms, instead of the statistics of this
+                      index, e.g. the global statistics of a FederatedIndex. Terms with p(t|C) = 0 are not scored.
+        :return: (document numbers, log p(q|d)) arrays, sorted by descending score
+        """
+        if num_docs <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        arrays = self.arrays[field]
+        coll_length = self.meta['coll_lengths'][field]
+        # (postings or None, p(t|C)) of the scored terms, in query order
+        postings = []
+        for term in query_terms:
+            term_id = self.get_term_id(term, field)
+            if p_t_c is None:
+                if term_id is not None:
+                    postings.append((self.get_postings(term_id, field),
+                                     arrays['coll_termfreqs'][term_id] / coll_length))
+            elif p_t_c.get(term):
+                postings.append((self.get_postings(term_id, field) if term_id is not None else None, p_t_c[term]))
+        if not any(term_postings is not None for term_postings, _ in postings):
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+
+        candidates = np.unique(np.concatenate([term_postings[0] for term_postings, _ in postings
+                                               if term_postings is not None]))
+        norm = np.log(arrays['doc_lengths'][candidates] + mu)
+        scores = np.zeros(len(candidates))
+        for term_postings, term_p_t_c in postings:
+            if term_postings is None:
+                # The term is not in this index
+                scores += np.log(mu * term_p_t_c) - norm
+                continue
+            # Term frequency of each candidate, 0 if the candidate is not in the postings
+            docs, freqs = term_postings
+            i = np.minimum(np.searchsorted(docs, candidates), len(docs) - 1)
+            tf = np.where(docs[i] == candidates, freqs[i], 0)
+            scores += np.log(tf + mu * term_p_t_c) - norm
+
+        if len(candidates) > num_docs:
+            # Keep all candidates tied with the last one, so ties are broken by the lowest document number, like Lucene
+            kth_score = -np.partition(-scores, num_docs - 1)[num_docs - 1]
+            top = np.flatnonzero(scores >= kth_score)
+        else:
+            top = np.arange(len(candidates))
+        top = top[np.lexsort((candidates[top], -scores[top]))][:num_docs]
+        return candidates[top], scores[top]
+
+    def is_pruned(self, prune_top_n=None, prune_mass=None):
+        """Returns True if the entity lists were pruned with these settings when the index was built."""
+        pruning = self.meta.get('entity_pruning', {})
+        return is_pruning(prune_top_n, prune_mass) and \
+            normalize_pruning(prune_top_n, prune_mass) == normalize_pruning(pruning.get('top_n'), pruning.get('mass'))
+
+    def get_p_e_d(self, doc_nos, prune_top_n=None, prune_mass=None):
+        """
+        Returns p(e|d) for the entities of the given documents, as in Model2.get_p_e_d().
+
+        :param doc_nos: Array of document numbers
+        :param prune_top_n: Keep only the top n entities of each document (see entity_pruning)
+        :param prune_mass: Keep only the top entities making up this fraction of the p(e|d) of each document
+        :return: (index into doc_nos, entity term id, p(e|d)) arrays
+        """
+        offsets = self.entities['offsets']
+        starts = offsets[doc_nos]
+        lengths = offsets[doc_nos + 1] - starts
+        doc_index = np.repeat(np.arange(len(doc_nos)), lengths)
+        # Positions of the entity lists of all documents, concatenated
+        positions = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths) + \
+            np.repeat(starts, lengths)
+        term_ids = self.entities['terms'][positions]
+        freqs = self.entities['freqs'][positions].astype(np.float64)
+        if 'num_mentions' in self.entities:
+            num_mentions = self.entities['num_mentions'][doc_nos]
+        else:
+            num_mentions = np.bincount(doc_index, weights=freqs, minlength=len(doc_nos))
+
+        post_offsets = self.arrays[self.entity_field]['post_offsets']
+        doc_freqs = post_offsets[term_ids + 1] - post_offsets[term_ids]
+        idf = np.log(self.meta['doc_counts'][self.entity_field] / doc_freqs)
+        p_e_d = freqs / num_mentions[doc_index] * idf
+        if is_pruning(prune_top_n, prune_mass):
+            keep = prune_mask(doc_index, term_ids, p_e_d, prune_top_n, prune_mass)
+            return doc_index[keep], term_ids[keep], p_e_d[keep]
+        return doc_index, term_ids, p_e_d
+
+    def get_term(self, term_id, field):
+        return self.arrays[field]['terms'][term_id]
+
+    # IndexCache compatible calls, used when a NumpyIndex is passed to Model2
+
+    def open_searcher(self):
+        pass
+
+    def close_reader(self):
+        pass
+
+    def num_docs(self):
+        return self.meta['num_docs']
+
+    def get_lucene_document_id(self, doc_id):
+        doc_id = _encode(doc_id)
+        i = int(np.searchsorted(self.doc_ids, doc_id, sorter=self.doc_ids_order))
+        if i == len(self.doc_ids_order) or self.doc_ids[self.doc_ids_order[i]] != doc_id:
+            raise KeyError(doc_id)
+        return int(self.doc_ids_order[i])
+
+    def get_doc_id(self, lucene_doc_id):
+        return self.doc_ids[lucene_doc_id]
+
+    def get_doc_termfreqs(self, lucene_doc_id, field):
+        arrays = self.arrays[field]
+        start, end = arrays['fwd_offsets'][lucene_doc_id], arrays['fwd_offsets'][lucene_doc_id + 1]
+        terms = arrays['terms'][arrays['fwd_terms'][start:end]]
+        return dict(zip(terms, arrays['fwd_freqs'][start:end].tolist()))
+
+    def get_doc_termvector(self, lucene_doc_id, field):
+        return [(term, None) for term in sorted(self.get_doc_termfreqs(lucene_doc_id, field))]
+
+    def get_doc_length(self, lucene_doc_id, field):
+        return int(self.arrays[field]['doc_lengths'][lucene_doc_id])
+
+    def get_doc_count(self, field):
+        return self.meta['doc_counts'][field]
+
+    def get_doc_freq(self, term, field):
+        term_id = self.get_term_id(term, field)
+        if term_id is None:
+            return 0
+        offsets = self.arrays[field]['post_offsets']
+        return int(offsets[term_id + 1] - offsets[term_id])
+
+    def get_coll_termfreq(self, term, field):
+        term_id = self.get_term_id(term, field)
+        if term_id is None:
+            return 0
+        return int(self.arrays[field]['coll_termfreqs'][term_id])
+
+    def get_coll_length(self, field):
+        return self.meta['coll_lengths'][field]
+
+    def score_query(self, query, field_content, field_id=None, num_docs=100, mu=2000, p_t_c=None):
+        doc_nos, scores = self.score_dirichlet(query.split(), field_content, num_docs, mu, p_t_c)
+        results = RetrievalResults()
+        for doc_no, score in zip(doc_nos.tolist(), scores.tolist()):
+            results.append(self.doc_ids[doc_no], score, doc_no)
+        return results
+
+
+class NumpyModel2(object):
+    """
+    Model 2 scorer over a NumpyIndex. Uses the same configuration keys as Model2.
+
+    Both passes use Dirichlet smoothed language models on the first pass field, so the first-pass
+    scores are used as p(q|d) directly. Queries are analyzed with the analyzer the index was built with.
+    The optional 'prune_top_n' and 'prune_mass' keys prune the entities of each document at query time,
+    like in Model2, unless the index was built with the same pruning.
+
+    :param config: Configuration dictionary
+    :param index: NumpyIndex, defaults to a NumpyIndex of config['index_dir']
+    """
+
+    def __init__(self, config, index=None):
+        self.config = config
+        self.index = index if index is not None else NumpyIndex(config['index_dir'])
+        self.queries = []
+
+    def _load_queries(self):
+        with open(self.config['query_file']) as query_file:
+            for query in query_file:
+                self.queries.append(query.rstrip("\n").split("\t"))
+
+    def get_p_q_e(self, q_id, query):
+        """
+        Returns the p(q|e) scores of the query, as {(entity_id, q_id): log p(q|e)}.
+        """
+        doc_nos, p_q_d = self.index.score_dirichlet(analyze(query, self.index.analyzer),
+                                                    self.config['first_pass_field'],
+                                                    self.config['first_pass_num_docs'],
+                                                    self.config.get('smoothing_param', 2000))
+        prune_top_n, prune_mass = self.config.get('prune_top_n'), self.config.get('prune_mass')
+        if self.index.is_pruned(prune_top_n, prune_mass):
+            # Pruning by mass is not idempotent, so the entity lists are not pruned twice
+            prune_top_n, prune_mass = None, None
+        doc_index, term_ids, p_e_d = self.index.get_p_e_d(doc_nos, prune_top_n, prune_mass)
+        entity_ids, inverse = np.unique(term_ids, return_inverse=True)
+        p_q_e = np.bincount(inverse, weights=np.exp(p_q_d)[doc_index] * p_e_d, minlength=len(entity_ids))
+        with np.errstate(divide='ignore'):
+            p_q_e = np.log(p_q_e)
+        field = self.index.entity_field
+        return {(self.index.get_term(entity_id, field), q_id): score
+                for entity_id, score in zip(entity_ids.tolist(), p_q_e.tolist())}
+
+    def score_all(self):
+        """
+        Scores all the given queries, and appends the results to the output file. With config['resume'], queries
+        completed by an interrupted run are skipped (see run_file.RunFileWriter); otherwise the output file is
+        overwritten.
+        """
+        self._load_queries()
+        writer = run_file.RunFileWriter(self.config['output_file'], resume=self.config.get('resume', False))
+        num_completed = writer.open()
+        if num_completed:
+            print "Resuming run: " + str(num_completed) + " queries already scored"
+        for q_id, query in self.queries:
+            if writer.is_completed(q_id):
+                continue
+            start = time.time()
+            p_q_e_all = self.get_p_q_e(q_id, query)
+            out = StringIO()
+            run_file.write_trec_format(q_id, self.config['run_id'], out, p_q_e_all, self.config['num_docs'])
+            writer.write_query(q_id, out.getvalue())
+            print "Scores computed for: " + q_id + " (" + str(time.time() - start) + "s)"
+        writer.finish()
+
+def build_from_clueweb(clueweb_dir, ann_dir, index_dir, num_processes, prune_top_n=None, prune_mass=None,
+                       analyzer=ANALYZER_REGEX):
+    """
+    Builds a NumPy index from the ClueWeb and annotation directories, using the same preprocessing as indexer.main.
+    The records of each file are added to the index as soon as the file is cleaned, in folder and file order, so only
+    the records of the files being processed are held besides the index. The whole index is held in memory until it
+    is written, see the module docstring.
+    """
+    from nordlys.preprocessor.indexer import match_annotation_files, _read_and_clean_task
+
+    builder = NumpyIndexBuilder(prune_top_n=prune_top_n, prune_mass=prune_mass, analyzer=analyzer)
+    pool = multiprocessing.Pool(num_processes)
+    try:
+        for subdir, dirs, files in os.walk(clueweb_dir):
+            for folder in sorted(dirs):
+                folder_dir, folder_ann_dir = os.path.join(clueweb_dir, folder), os.path.join(ann_dir, folder)
+                clueweb_iter, ann_list = match_annotation_files(folder_dir, folder_ann_dir)
+                tasks = [(file_no, (clueweb_file, ann_file, folder_dir, folder_ann_dir), None, None)
+                         for file_no, (clueweb_file, ann_file) in enumerate(zip(clueweb_iter, ann_list))]
+                for _, (cleaned_records, _) in pool.imap(_read_and_clean_task, tasks):
+                    if cleaned_records is False:
+                        continue
+                    for record in cleaned_records:
+                        builder.add_record(record)
+                print "Added " + folder + ": " + str(len(builder.doc_ids)) + " documents"
+    finally:
+        pool.close()
+        pool.join()
+    builder.build(index_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-index_dir", help="NumPy index directory")
+    parser.add_argument("-lucene_index", help="Lucene index to export", default=None)
+    parser.add_argument("-clueweb_dir", help="Clueweb directory to build from (the whole index is held in memory, "
+                        "about 12 bytes per posting and 50 more per posting of the field being written)",
+                        default=None)
+    parser.add_argument("-ann_dir", help="Annotation directory to build from", default=None)
+    parser.add_argument("-num_processes", help="Number of processes to run", type=int, default=1)
+    parser.add_argument("-analyzer", help="Analyzer when building from Clueweb (regex or lucene)",
+                        default=ANALYZER_REGEX, choices=[ANALYZER_REGEX, ANALYZER_LUCENE])
+    parser.add_argument("-query_file", help="Query file", default=None)
+    parser.add_argument("-output_file", help="Run file", default=None)
+    parser.add_argument("-resume", help="Resume an interrupted run", action="store_true")
+    parser.add_argument("-first_pass_num_docs", help="First pass documents", type=int, default=1000)
+    parser.add_argument("-num_docs", help="Entities per query", type=int, default=100)
+    parser.add_argument("-mu", help="Dirichlet smoothing parameter", type=float, default=2000)
+    parser.add_argument("-prune_top_n", help="Entities kept per document", type=int, default=None)
+    parser.add_argument("-prune_mass", help="Fraction of p(e|d) kept per document", type=float, default=None)
+    args = parser.parse_args()
+
+    # An index built here is pruned when it is built, so its entity lists are not pruned again at query time
+    building = args.lucene_index is not None or args.clueweb_dir is not None
+    if args.lucene_index is not None:
+        from nordlys.retrieval.index_cache import IndexCache
+        lucene = IndexCache(args.lucene_index)
+        lucene.open_searcher()
+        print "Exporting " + args.lucene_index + "..."
+        builder = NumpyIndexBuilder(prune_top_n=args.prune_top_n, prune_mass=args.prune_mass)
+        builder.add_lucene_index(lucene)
+        lucene.close_reader()
+        builder.build(args.index_dir)
+    elif args.clueweb_dir is not None:
+        build_from_clueweb(args.clueweb_dir, args.ann_dir, args.index_dir, args.num_processes, args.prune_top_n,
+                           args.prune_mass, args.analyzer)
+
+    if args.query_file is not None:
+        start = time.time()
+        config = {'index_dir': args.index_dir,
+                  'first_pass_field': FIELD_CONTENTS,
+                  'first_pass_num_docs': args.first_pass_num_docs,
+                  'num_docs': args.num_docs,
+                  'smoothing_param': args.mu,
+                  'prune_top_n': None if building else args.prune_top_n,
+                  'prune_mass': None if building else args.prune_mass,
+                  'run_id': 1,
+                  'query_file': args.query_file,
+                  'output_file': args.output_file,
+                  'resume': args.resume}
+        model2 = NumpyModel2(config)
+        print "Index opened in " + str(time.time() - start) + "s"
+        model2.score_all()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+"""
+Reading and writing of TREC run files.
+
+@author: Tino Hakim Lazreg
+"""
+
+import os
+
+FREEBASE_URL = "<http://rdf.freebase.com/ns/entity_id>"
+
+
+def get_freebase_url(entity_id):
+    """
+    Transforms an indexed entity id to the format used in the qrels, e.g. _m_0abc -> <http://rdf.freebase.com/ns/m.0abc>
+    """
+    return FREEBASE_URL.replace("entity_id", entity_id[1:].replace("_", ".", 1))
+
+
+def write_trec_format(query_id, run_id, out, p_q_e, max_rank=100):
+    """Outputs results in TREC format
+
+    :param query_id:
+    :param run_id:
+    :param out: Opened output file
+    :param p_q_e: p(q|e) probabilities for the given query, as {(entity_id, query_id): score}
+    :param max_rank:
+    """
+    rank = 1
+    # Sort p_q_e_iteritems() by score
+    for entity_query_id, score in sorted(p_q_e.iteritems(), key=lambda (k, v): (v, k), reverse=True):
+        entity_id, q_id = entity_query_id
+        entity_id = get_freebase_url(entity_id)
+        if rank <= max_rank:
+            out.write(
+                    query_id + "\tQ0\t" + entity_id + "\t" + str(rank) + "\t" + str(score) + "\t" + str(
+                        run_id) + "\n")
+        rank += 1
+
+
+class RunFileWriter(object):
+    """
+    Appends the results of each query to a run file, so an interrupted run can be resumed.
+
+    The block of each query is written with one write, flushed and synced to disk. Its query id and the size of
+    the run file after the block are then appended to a progress file (path + ".progress"). When a run is
+    resumed, the run file is truncated to the size after the last completed query, which removes a partially
+    written block, and the completed queries are skipped. If the progress file is missing, the completed queries
+    are read from the run file; the last query in it may be incomplete, so it is removed and scored again. If the
+    run (or candidates) file is missing or shorter than the progress file says, the progress is discarded.
+
+    Resuming is opt-in: the files of a previous run may have been written with other settings, so by default they
+    are overwritten. When all queries are written, finish() removes the progress file, so only an interrupted run
+    leaves one behind.
+
+    :param path: Run file
+    :param candidates_path: Optional file with the first-pass candidates of each query, kept in step with the run
+    :param resume: Resume the run in the existing files, instead of overwriting them
+    """
+
+    PROGRESS_EXT = ".progress"
+
+    def __init__(self, path, candidates_path=None, resume=False):
+        self.path = path
+        self.candidates_path = candidates_path
+        self.resume = resume
+        self.progress_path = path + self.PROGRESS_EXT
+        self.completed = set()
+        self.out = None
+        self.candidates_out = None
+        self.progress_out = None
+
+    def _read_progress(self):
+        """Returns the completed queries, as (q_id, run file size, candidates file size) tuples."""
+        progress = []
+        if os.path.exists(self.progress_path):
+            with open(self.progress_path) as f:
+                for line in f:
+                    fields = line.rstrip("\n").split("\t")
+                    if len(fields) != 3 or not line.endswith("\n"):
+                        # Partially written last line
+                        break
+                    progress.append((fields[0], int(fields[1]), int(fields[2])))
+        elif os.path.exists(self.path):
+            # The candidates can not be matched to the run without the progress file, so they are discarded
+            size = 0
+            with open(self.path) as f:
+                for line in f:
+                    q_id = line.split("\t", 1)[0]
+                    if progress and progress[-1][0] == q_id:
+                        progress[-1] = (q_id, size + len(line), 0)
+                    else:
+                        progress.append((q_id, size + len(line), 0))
+                    size += len(line)
+            progress = progress[:-1]
+        return progress
+
+    @staticmethod
+    def _has_size(path, size):
+        """Returns True if the file holds at least size bytes, which a missing file does for size 0."""
+        return size == 0 or (os.path.exists(path) and os.path.getsize(path) >= size)
+
+    @staticmethod
+    def _open_truncated(path, size):
+        """Opens a file for appending, after truncating it to size."""
+        f = open(path, "ab")
+        f.truncate(size)
+        f.seek(0, os.SEEK_END)
+        return f
+
+    def open(self):
+        """
+        Opens the run file, and returns the number of queries completed by a previous run, 0 if not resuming.
+        """
+        progress = self._read_progress() if self.resume else []
+        run_size, candidates_size = progress[-1][1:] if progress else (0, 0)
+        if not self._has_size(self.path, run_size) or \
+                (self.candidates_path is not None and not self._has_size(self.candidates_path, candidates_size)):
+            # Truncating would pad the file with zeros, and skip queries whose results are lost
+            print "Run file is shorter than its progress file, starting a new run"
+            progress = []
+            run_size, candidates_size = 0, 0
+        self.completed = set(q_id for q_id, _, _ in progress)
+        self.out = self._open_truncated(self.path, run_size)
+        if self.candidates_path is not None:
+            self.candidates_out = self._open_truncated(self.candidates_path, candidates_size)
+        # Rewrite the progress file without a partially written last line
+        with open(self.progress_path + ".tmp", "w") as f:
+            f.write("".join(self._format_progress(*entry) for entry in progress))
+        os.rename(self.progress_path + ".tmp", self.progress_path)
+        self.progress_out = open(self.progress_path, "a")
+        return len(self.completed)
+
+    def is_completed(self, q_id):
+        return q_id in self.completed
+
+    @staticmethod
+    def _format_progress(q_id, run_size, candidates_size):
+        return q_id + "\t" + str(run_size) + "\t" + str(candidates_size) + "\n"
+
+    @staticmethod
+    def _append(f, data):
+        """Appends data to a file, syncs it to disk, and returns the new file size."""
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+        return os.fstat(f.fileno()).st_size
+
+    def write_query(self, q_id, run_lines, candidate_lines=""):
+        """
+        Appends the results of a query, and records the query as completed.
+
+        :param q_id: Query id
+        :param run_lines: Run file lines of the query, e.g. written by write_trec_format()
+        :param candidate_lines: Candidates file lines of the query
+        """
+        candidates_size = 0
+        if self.candidates_out is not None:
+            candidates_size = self._append(self.candidates_out, candidate_lines)
+        run_size = self._append(self.out, run_lines)
+        self._append(self.progress_out, self._format_progress(q_id, run_size, candidates_size))
+        self.completed.add(q_id)
+
+    def close(self):
+        for f in (self.out, self.candidates_out, self.progress_out):
+            if f is not None:
+                f.close()
+
+    def finish(self):
+        """Closes the files of a completed run, and removes its progress file."""
+        self.close()
+        if os.path.exists(self.progress_path):
+            os.remove(self.progress_path)
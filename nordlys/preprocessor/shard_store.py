@@ -0,0 +1,141 @@
+"""
+Packed storage of cleaned ClueWeb records: one shard per WARC file instead of two files per record.
+
+A shard is a sequence of length-prefixed, zlib compressed JSON records, written in large sequential
+buffers. An offset index (.idx) written next to the shard gives random access by WARC-TREC-ID.
+
+Shard record:
+    4 byte big-endian length, followed by the compressed JSON of
+    {'record_id', 'replaced_record', 'cleaned_record', 'entities_record'}
+
+Index file:
+    record_id<TAB>offset<TAB>length per line, in shard order
+
+@author: Tino Hakim Lazreg
+"""
+
+import bisect
+import json
+import os
+import struct
+import zlib
+
+SHARD_EXT = ".shard"
+INDEX_EXT = ".idx"
+HEADER = struct.Struct(">I")
+
+
+class ShardWriter(object):
+    """
+    Writes records to a shard. The shard and its index are written to temporary files, and renamed
+    when the writer is closed, so an interrupted run never leaves a truncated shard behind.
+
+    :param path: Shard file
+    :param buffer_size: Number of bytes buffered before they are written to disk
+    :param compress_level: zlib compression level
+    """
+
+    def __init__(self, path, buffer_size=8 * 1024 * 1024, compress_level=6):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.compress_level = compress_level
+        self.file = open(path + ".tmp", "wb")
+        self.buffer = []
+        self.buffered = 0
+        self.offset = 0
+        self.index = []
+
+    def write(self, record):
+        """
+        Adds a record to the shard.
+
+        :param record: Dictionary with record_id, replaced_record, cleaned_record and entities_record
+        """
+        data = zlib.compress(json.dumps({'record_id': record['record_id'],
+                                         'replaced_record': record['replaced_record'],
+                                         'cleaned_record': record['cleaned_record'],
+                                         'entities_record': record.get('entities_record', "")}),
+                             self.compress_level)
+        self.index.append((record['record_id'], self.offset, HEADER.size + len(data)))
+        self.buffer.append(HEADER.pack(len(data)))
+        self.buffer.append(data)
+        self.offset += HEADER.size + len(data)
+        self.buffered += HEADER.size + len(data)
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        self.file.write("".join(self.buffer))
+        del self.buffer[:]
+        self.buffered = 0
+
+    def close(self):
+        self.flush()
+        self.file.close()
+        with open(self.path + INDEX_EXT + ".tmp", "w") as f:
+            f.write("".join(record_id + "\t" + str(offset) + "\t" + str(length) + "\n"
+                            for record_id, offset, length in self.index))
+        os.rename(self.path + ".tmp", self.path)
+        os.rename(self.path + INDEX_EXT + ".tmp", self.path + INDEX_EXT)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+
+
+class ShardReader(object):
+    """
+    Reads records from a shard, either sequentially by iterating over the reader, or by WARC-TREC-ID with get().
+
+    :param path: Shard file
+    :param buffer_size: Read buffer size used when iterating
+    """
+
+    def __init__(self, path, buffer_size=8 * 1024 * 1024):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.record_ids = None
+        self.offsets = None
+
+    def __iter__(self):
+        with open(self.path, "rb", self.buffer_size) as f:
+            while True:
+                header = f.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    return
+                length, = HEADER.unpack(header)
+                yield json.loads(zlib.decompress(f.read(length)))
+
+    def _load_index(self):
+        index = []
+        with open(self.path + INDEX_EXT) as f:
+            for line in f:
+                record_id, offset, length = line.rstrip("\n").split("\t")
+                index.append((record_id, int(offset), int(length)))
+        index.sort()
+        self.record_ids = [record_id for record_id, _, _ in index]
+        self.offsets = [(offset, length) for _, offset, length in index]
+
+    def get(self, record_id):
+        """
+        Returns the record with the given WARC-TREC-ID, or None if it is not in the shard.
+        """
+        if self.record_ids is None:
+            self._load_index()
+        i = bisect.bisect_left(self.record_ids, record_id)
+        if i == len(self.record_ids) or self.record_ids[i] != record_id:
+            return None
+        offset, length = self.offsets[i]
+        with open(self.path, "rb") as f:
+            f.seek(offset + HEADER.size)
+            return json.loads(zlib.decompress(f.read(length - HEADER.size)))
+
+
+def get_shard_path(output_dir, warc_file):
+    """Returns the shard path for a WARC file, e.g. 0000tw-00.warc.gz -> output_dir/0000tw-00.shard"""
+    return os.path.join(output_dir, os.path.basename(warc_file).split(".")[0] + SHARD_EXT)
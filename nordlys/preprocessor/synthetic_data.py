@@ -0,0 +1,262 @@
+"""
+Generates synthetic ClueWeb-like data for benchmarking, so the preprocessor and Model 2 can be
+measured without the licensed ClueWeb12 and FACC1 data.
+
+Output:
+    -gzip'd WARC files with HTML response records
+    -FACC-style annotation .tsv files with byte offsets into the record payloads
+    -Entity-annotated corpora and queries, as indexed by indexer.Indexer
+
+@author: Tino Hakim Lazreg
+"""
+
+import bisect
+import os
+import random
+
+import warc
+
+from nordlys.preprocessor.clueweb_facc_preprocessor import Annotation, WarcEntry
+
+SYLLABLES = ["ka", "lo", "mi", "ren", "sa", "tor", "vel", "an", "dre", "qu", "is", "bor", "ne", "ul", "zan", "fe"]
+# Filler words, some with non-ASCII characters so byte offsets differ from character offsets
+FILLER_WORDS = [u"the", u"of", u"and", u"in", u"city", u"river", u"music", u"history", u"film", u"caf\xe9",
+                u"na\xefve", u"r\xe9sum\xe9", u"team", u"season", u"album", u"company", u"d\xe9j\xe0", u"university"]
+# Encodings with an offset bug that match_text corrects for, see WarcEntry.fix_annotation_offset
+OFFSET_BUG_ENCODINGS = ["ISO-8859-1", "EUC_KR", "GB18030", "BIG5", "EUC-JP", "SHIFT_JIS", "win", "clueweb12_bug"]
+CONTENT_LENGTH_BUG = 32768
+HTTP_HEADER = u"HTTP/1.1 200 OK\r\nContent-Type: text/html; charset={charset}\r\n\r\n"
+
+
+class ZipfSampler(object):
+    """
+    Samples integers in [0, n) with probability proportional to 1 / (rank + 1) ** s.
+
+    :param n: Number of items
+    :param s: Zipf exponent
+    :param rng: random.Random object
+    """
+
+    def __init__(self, n, s=1.0, rng=None):
+        self.rng = rng or random.Random()
+        self.cum_weights = []
+        total = 0.0
+        for rank in range(n):
+            total += 1.0 / (rank + 1) ** s
+            self.cum_weights.append(total)
+        self.total = total
+
+    def sample(self):
+        return bisect.bisect(self.cum_weights, self.rng.random() * self.total)
+
+
+class EntityVocabulary(object):
+    """
+    Synthetic entities with a mention text and a Freebase id.
+
+    :param num_entities: Number of entities
+    :param rng: random.Random object
+    """
+
+    def __init__(self, num_entities, rng):
+        self.mentions = []
+        self.freebase_ids = []
+        for i in range(num_entities):
+            words = ["".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))) for _ in range(rng.randint(1, 2))]
+            self.mentions.append(u" ".join(words).title())
+            self.freebase_ids.append("/m/0" + format(i, "x"))
+
+    def __len__(self):
+        return len(self.mentions)
+
+
+def get_offset_delta(encoding):
+    """
+    Returns the offset correction match_text applies for an encoding with an offset bug.
+    """
+    annotation = Annotation("", encoding, "", 0, 0, "")
+    start_pos, _ = WarcEntry.fix_annotation_offset(encoding, annotation)
+    return start_pos
+
+
+class SyntheticWarcGenerator(object):
+    """
+    Generates WARC files and matching FACC annotation files.
+
+    :param page_size: Approximate size of each HTML page in bytes
+    :param annotation_density: Number of annotated entity mentions per KB of page
+    :param non_utf8_ratio: Fraction of records encoded as WINDOWS-1252
+    :param offset_bug_ratio: Fraction of annotations with one of the offset bugs match_text handles
+    :param num_entities: Number of entities in the vocabulary
+    :param zipf_s: Zipf exponent of the entity distribution
+    :param seed: Random seed
+    """
+
+    def __init__(self, page_size=20000, annotation_density=1.0, non_utf8_ratio=0.1, offset_bug_ratio=0.05,
+                 num_entities=10000, zipf_s=1.0, seed=42):
+        self.page_size = page_size
+        self.annotation_density = annotation_density
+        self.non_utf8_ratio = non_utf8_ratio
+        self.offset_bug_ratio = offset_bug_ratio
+        self.rng = random.Random(seed)
+        self.entities = EntityVocabulary(num_entities, self.rng)
+        self.entity_sampler = ZipfSampler(num_entities, zipf_s, self.rng)
+
+    def _filler(self, num_bytes):
+        words = []
+        size = 0
+        while size < num_bytes:
+            word = self.rng.choice(FILLER_WORDS)
+            words.append(word)
+            size += len(word) + 1
+        return u" ".join(words)
+
+    def _annotation_offsets(self, start, end, charset):
+        """
+        Returns the encoding and offsets to write to the annotation file, possibly with an offset bug.
+        """
+        if charset != "UTF-8" or self.rng.random() >= self.offset_bug_ratio:
+            return charset, start, end
+        if self.rng.random() < 0.1:
+            # Annotation offsets beyond the content length of the record
+            return "UTF-8", start + CONTENT_LENGTH_BUG, end + CONTENT_LENGTH_BUG
+        encoding = self.rng.choice(OFFSET_BUG_ENCODINGS)
+        delta = get_offset_delta(encoding)
+        # Annotations labelled UTF-8, so match_text has to probe the other encodings
+        return "UTF-8", start - delta, end - delta
+
+    def generate_record(self, trec_id):
+        """
+        Generates the payload and annotations for one record.
+
+        :param trec_id: WARC-TREC-ID of the record
+        :return: payload, list of annotation .tsv lines
+        """
+        charset = "WINDOWS-1252" if self.rng.random() < self.non_utf8_ratio else "UTF-8"
+        num_mentions = max(0, int(round(self.page_size / 1024.0 * self.annotation_density)))
+        filler_size = max(1, (self.page_size - 300) // (num_mentions + 1))
+
+        pieces = [HTTP_HEADER.format(charset=charset.lower()),
+                  u"<html><head><title>" + self._filler(40) + u"</title>",
+                  u"<script>var x = 1;</script><style>p {color: red;}</style></head><body>"]
+        offset = sum(len(piece.encode('utf-8')) for piece in pieces)
+        lines = []
+        for _ in range(num_mentions):
+            text = u"<p>" + self._filler(filler_size) + u" "
+            pieces.append(text)
+            offset += len(text.encode('utf-8'))
+            entity = self.entity_sampler.sample()
+            mention = self.entities.mentions[entity]
+            start = offset
+            end = start + len(mention.encode('utf-8'))
+            pieces.append(mention)
+            offset = end
+            encoding, ann_start, ann_end = self._annotation_offsets(start, end, charset)
+            lines.append("\t".join([trec_id, encoding, mention.encode('utf-8'), str(ann_start), str(ann_end),
+                                    "0.99", "0.01", self.entities.freebase_ids[entity]]) + "\n")
+        pieces.append(u"<p>" + self._filler(filler_size) + u"</p></body></html>")
+        payload = u"".join(pieces).encode(charset.lower() if charset != "WINDOWS-1252" else "cp1252")
+        return payload, lines
+
+    def generate_file(self, warc_path, ann_path, num_records, file_id="0000tw-00"):
+        """
+        Writes a gzip'd WARC file with a warcinfo record followed by num_records response records,
+        and the corresponding annotation file.
+
+        :param warc_path: Output WARC file (.warc.gz)
+        :param ann_path: Output annotation file (.tsv)
+        :param num_records: Number of response records
+        :param file_id: Part of the WARC-TREC-ID identifying the file
+        :return: Total payload size in bytes
+        """
+        total_bytes = 0
+        warc_file = warc.open(warc_path, "w")
+        warc_file.write_record(warc.WARCRecord(payload="software: nordlys synthetic_data\r\n",
+                                               headers={'WARC-Type': 'warcinfo'}))
+        with open(ann_path, "w") as ann_file:
+            for i in range(num_records):
+                trec_id = "clueweb12-" + file_id + "-%05d" % i
+                payload, lines = self.generate_record(trec_id)
+                total_bytes += len(payload)
+                warc_file.write_record(warc.WARCRecord(payload=payload,
+                                                       headers={'WARC-Type': 'response',
+                                                                'WARC-TREC-ID': trec_id,
+                                                                'WARC-Target-URI': 'http://example.com/' + trec_id}))
+                ann_file.writelines(lines)
+        warc_file.close()
+        return total_bytes
+
+    def generate_folder(self, clueweb_dir, ann_dir, num_files, records_per_file, folder="0000tw"):
+        """
+        Writes num_files WARC and annotation files in the directory layout expected by indexer.main.
+
+        :return: Total payload size in bytes
+        """
+        clueweb_dir = os.path.join(clueweb_dir, folder)
+        ann_dir = os.path.join(ann_dir, folder)
+        for path in (clueweb_dir, ann_dir):
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        total_bytes = 0
+        for i in range(num_files):
+            file_id = folder + "-%02d" % i
+            total_bytes += self.generate_file(os.path.join(clueweb_dir, file_id + ".warc.gz"),
+                                              os.path.join(ann_dir, file_id + ".anns.tsv"),
+                                              records_per_file, file_id)
+        return total_bytes
+
+
+class SyntheticCorpusGenerator(object):
+    """
+    Generates an entity-annotated corpus as it is indexed by indexer.Indexer, with Zipfian
+    distributed terms and entities.
+
+    :param num_terms: Number of distinct terms
+    :param num_entities: Number of distinct entities
+    :param term_zipf_s: Zipf exponent of the term distribution
+    :param entity_zipf_s: Zipf exponent of the entity distribution
+    :param seed: Random seed
+    """
+
+    def __init__(self, num_terms=20000, num_entities=10000, term_zipf_s=1.0, entity_zipf_s=1.0, seed=42):
+        self.rng = random.Random(seed)
+        self.terms = ["".join(self.rng.choice(SYLLABLES) for _ in range(self.rng.randint(1, 4))) + str(i)
+                      for i in range(num_terms)]
+        self.entities = EntityVocabulary(num_entities, self.rng)
+        self.term_sampler = ZipfSampler(num_terms, term_zipf_s, self.rng)
+        self.entity_sampler = ZipfSampler(num_entities, entity_zipf_s, self.rng)
+
+    def generate_document(self, doc_length=500, entities_per_doc=20):
+        """
+        Returns the field terms of one document.
+
+        :param doc_length: Average number of terms
+        :param entities_per_doc: Average number of entity mentions
+        :return: {'contents': [terms], 'contents_annotated': [terms]}, where the entity mentions in
+                 contents_annotated are replaced with their Freebase id (e.g. _m_0abc)
+        """
+        terms = [self.terms[self.term_sampler.sample()]
+                 for _ in range(max(1, int(self.rng.expovariate(1.0 / doc_length))))]
+        contents = list(terms)
+        contents_annotated = list(terms)
+        for _ in range(int(self.rng.expovariate(1.0 / entities_per_doc)) if entities_per_doc else 0):
+            entity = self.entity_sampler.sample()
+            pos = self.rng.randint(0, len(contents_annotated))
+            contents_annotated.insert(pos, self.entities.freebase_ids[entity].replace('/', '_'))
+            contents.extend(self.entities.mentions[entity].lower().split())
+        return {'contents': contents, 'contents_annotated': contents_annotated}
+
+    def generate_corpus(self, num_docs, doc_length=500, entities_per_doc=20):
+        """
+        Returns a list of (doc_id, fields) tuples, see generate_document().
+        """
+        return [("clueweb12-0000tw-00-%05d" % i, self.generate_document(doc_length, entities_per_doc))
+                for i in range(num_docs)]
+
+    def generate_queries(self, num_queries, min_length=1, max_length=4):
+        """
+        Returns a list of (query_id, query) tuples, with query terms sampled from the term distribution.
+        """
+        return [(str(i), " ".join(self.terms[self.term_sampler.sample()]
+                                  for _ in range(self.rng.randint(min_length, max_length))))
+                for i in range(num_queries)]
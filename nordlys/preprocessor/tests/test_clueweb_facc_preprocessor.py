@@ -0,0 +1,98 @@
+"""
+Tests for the record content cache and the cleaning of oversized records.
+
+@author: Tino Hakim Lazreg
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from nordlys.preprocessor.clueweb_facc_preprocessor import TagStripper, WarcEntry
+from nordlys.preprocessor.indexer import read_and_clean_files
+from nordlys.preprocessor.metrics import Metrics
+from nordlys.preprocessor.synthetic_data import SyntheticWarcGenerator
+
+
+class FakeWarcFile(object):
+    reader = None
+
+
+def get_warc_entry(max_payload_size=None):
+    return WarcEntry("test.warc.gz", FakeWarcFile(), [], Metrics(), max_payload_size=max_payload_size)
+
+
+class TestGetRecordContent(unittest.TestCase):
+
+    def test_valid_utf8_is_not_copied(self):
+        payload = u"caf\xe9".encode("utf-8")
+        warc_entry = get_warc_entry()
+        self.assertIs(warc_entry.get_record_content(payload, "UTF-8", "utf-8"), payload)
+
+    def test_keeps_one_copy(self):
+        payload = u"caf\xe9 \xfcber".encode("utf-8")
+        warc_entry = get_warc_entry()
+        latin1 = warc_entry.get_record_content(payload, "latin-1", "utf-8")
+        self.assertEqual(latin1, bytearray(payload.decode("latin-1"), "utf-8"))
+        self.assertIs(warc_entry.get_record_content(payload, "latin-1", "utf-8"), latin1)
+        self.assertEqual(warc_entry.get_record_content(payload, "utf-8", "latin-1"),
+                         bytearray(payload.decode("utf-8"), "latin-1"))
+        # Only the content of the last encodings is cached
+        self.assertEqual(warc_entry.content_cache[2], ("utf-8", "latin-1"))
+        self.assertIsNot(warc_entry.content_cache[3], latin1)
+
+    def test_invalid_utf8(self):
+        payload = "caf\xe9"
+        warc_entry = get_warc_entry()
+        content = warc_entry.get_record_content(payload, "utf-8", "utf-8")
+        self.assertEqual(content, bytearray(u"caf\ufffd", "utf-8"))
+        self.assertFalse(warc_entry.content_cache[1])
+
+
+class TestOversizedRecords(unittest.TestCase):
+
+    def test_tag_stripper_truncates(self):
+        stripper = TagStripper(10)
+        stripper.feed("<p>0123456789</p><script>x</script><p>dropped</p>")
+        stripper.close()
+        self.assertEqual(stripper.get_text(), "0123456789")
+        self.assertTrue(stripper.truncated)
+
+    def test_clean_oversized_payload(self):
+        warc_entry = get_warc_entry(max_payload_size=5)
+        text = warc_entry.clean_oversized_payload(StringIO("<html><head></head><body>Hello <b>World</b></body>"))
+        self.assertEqual(text, "hello ")
+        self.assertEqual(warc_entry.metrics.counters['oversized_truncated'][''], 1)
+
+    def test_read_and_clean_files(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            generator = SyntheticWarcGenerator(page_size=20000, non_utf8_ratio=0.3, offset_bug_ratio=0.2)
+            generator.rng = random.Random(5)
+            generator.generate_folder(os.path.join(tmp_dir, "cw"), os.path.join(tmp_dir, "ann"), 1, 10)
+            stdout = sys.stdout
+            sys.stdout = open(os.devnull, "w")
+            try:
+                records, metrics = read_and_clean_files("0000tw-00.warc.gz", "0000tw-00.anns.tsv",
+                                                        os.path.join(tmp_dir, "cw", "0000tw"),
+                                                        os.path.join(tmp_dir, "ann", "0000tw"), max_payload_size=15000)
+            finally:
+                sys.stdout.close()
+                sys.stdout = stdout
+        finally:
+            shutil.rmtree(tmp_dir)
+        counters = metrics['counters']
+        self.assertEqual(counters['oversized_records'][''], len(records))
+        self.assertEqual(counters['oversized_truncated'][''], len(records))
+        self.assertGreater(counters['oversized_annotations'][''], 0)
+        for record in records:
+            self.assertEqual(record['replaced_record'], record['cleaned_record'])
+            self.assertEqual(record['entities_record'], "")
+
+
+if __name__ == '__main__':
+    unittest.main()
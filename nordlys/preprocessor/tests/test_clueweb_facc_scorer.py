@@ -0,0 +1,48 @@
+"""
+Tests for Model 2 on a synthetic in-memory index.
+
+@author: Tino Hakim Lazreg
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from nordlys.preprocessor.benchmark_model2 import get_config
+from nordlys.preprocessor.clueweb_facc_scorer import Model2
+from nordlys.preprocessor.memory_index import MemoryIndex
+from nordlys.preprocessor.synthetic_data import SyntheticCorpusGenerator
+
+
+class TestWarmCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        generator = SyntheticCorpusGenerator(num_terms=2000, num_entities=500)
+        self.corpus = generator.generate_corpus(400, 100, 10)
+        self.index = MemoryIndex(self.corpus)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_keeps_most_popular(self):
+        # The first document is a candidate for 50 queries, all others for one query
+        candidates_file = os.path.join(self.tmp_dir, "candidates.tsv")
+        with open(candidates_file, "w") as f:
+            for q_id in range(50):
+                f.write("%d\t%s\n" % (q_id, self.corpus[0][0]))
+            for doc_id, _ in self.corpus[1:]:
+                f.write("99\t%s\n" % doc_id)
+        model2 = Model2(get_config(100, doc_cache_size=200000), lucene=self.index)
+        model2.warm_cache(candidates_file)
+        cache = model2.doc_cache
+        self.assertIn(("p_e_d", self.corpus[0][0]), cache)
+        self.assertNotIn(("p_e_d", self.corpus[-1][0]), cache)
+        self.assertLessEqual(cache.size, cache.max_bytes)
+        self.assertEqual((cache.hits, cache.misses, cache.evictions), (0, 0, 0))
+        self.assertTrue(cache.evict)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+"""
+Tests for the duplicate detection of ClueWeb records, and the skipping of duplicates by the indexer.
+
+@author: Tino Hakim Lazreg
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+import warc
+
+from nordlys.preprocessor.dedup import FingerprintStore, get_fingerprints, hamming_distance, resolve_duplicates, \
+    simhash, write_duplicates
+from nordlys.preprocessor.indexer import read_and_clean_folder
+from nordlys.preprocessor.metrics import Metrics, MetricsWriter
+from nordlys.preprocessor.synthetic_data import SyntheticWarcGenerator
+
+HEADER = "HTTP/1.1 200 OK\r\nContent-Type: text/html\r\n\r\n"
+RNG = random.Random(1)
+WORDS = ["word%d" % RNG.randint(0, 5000) for _ in range(1000)]
+PAGE = HEADER + "<html><body><p>" + " ".join(WORDS) + "</p></body></html>"
+
+
+class TestFingerprintStore(unittest.TestCase):
+
+    def test_exact(self):
+        store = FingerprintStore(near_duplicates=False)
+        self.assertEqual(store.find_duplicate("a", PAGE), (None, None))
+        # Whitespace and the HTTP header are ignored
+        other_header = "HTTP/1.1 200 OK\r\n\r\n" + PAGE[len(HEADER):].replace(" ", "  ")
+        self.assertEqual(store.find_duplicate("b", other_header), ("a", "exact"))
+        self.assertEqual(store.find_duplicate("c", PAGE.replace("<p>", "<p>other ")), (None, None))
+        self.assertEqual(store.duplicates, [("b", "a")])
+
+    def test_near(self):
+        store = FingerprintStore(near_duplicates=True)
+        near_page = HEADER + "<html><body><p>" + " ".join(WORDS[:-1] + ["other"]) + "</p></body></html>"
+        self.assertLessEqual(hamming_distance(simhash(PAGE), simhash(near_page)), store.max_distance)
+        self.assertEqual(store.find_duplicate("a", PAGE), (None, None))
+        self.assertEqual(store.find_duplicate("b", near_page), ("a", "near"))
+        self.assertEqual(store.find_duplicate("c", HEADER + "<p>something else entirely</p>"), (None, None))
+
+    def test_duplicates_are_not_added(self):
+        store = FingerprintStore(near_duplicates=False)
+        store.add("a", *get_fingerprints(PAGE, False))
+        store.add("b", *get_fingerprints(PAGE, False))
+        self.assertEqual(store.exact.values(), ["a"])
+
+    def test_resolve_duplicates(self):
+        self.assertEqual(resolve_duplicates([("b", "a"), ("c", "b"), ("e", "d")]),
+                         [("b", "a"), ("c", "a"), ("e", "d")])
+        # Cycles do not loop forever
+        self.assertEqual(resolve_duplicates([("a", "b"), ("b", "a")]), [("a", "a"), ("b", "b")])
+
+    def test_write_duplicates(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, "duplicates.tsv")
+            write_duplicates([("b", "a"), ("c", "b")], path)
+            with open(path) as f:
+                self.assertEqual(f.read(), "b\ta\nc\ta\n")
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+class TestReadAndCleanFolder(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.generator = SyntheticWarcGenerator(page_size=3000, non_utf8_ratio=0, offset_bug_ratio=0)
+        self.generator.rng = random.Random(3)
+        self.records = {}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_file(self, folder, file_id, copies):
+        """Writes a warc file of 5 records, and its annotations. copies maps a record number to a TREC-ID."""
+        for name in ("cw", "ann"):
+            if not os.path.isdir(os.path.join(self.tmp_dir, name, folder)):
+                os.makedirs(os.path.join(self.tmp_dir, name, folder))
+        warc_file = warc.open(os.path.join(self.tmp_dir, "cw", folder, file_id + ".warc.gz"), "w")
+        with open(os.path.join(self.tmp_dir, "ann", folder, file_id + ".anns.tsv"), "w") as ann_file:
+            for i in range(5):
+                trec_id = "clueweb12-%s-%05d" % (file_id, i)
+                if i in copies:
+                    payload, lines = self.records[copies[i]]
+                    lines = [trec_id + line[line.index("\t"):] for line in lines]
+                else:
+                    payload, lines = self.generator.generate_record(trec_id)
+                self.records[trec_id] = (payload, lines)
+                warc_file.write_record(warc.WARCRecord(payload=payload, headers={'WARC-Type': 'response',
+                                                                                 'WARC-TREC-ID': trec_id}))
+                ann_file.writelines(lines)
+        warc_file.close()
+
+    def read_and_clean(self, folder, store, metrics):
+        clueweb_dir = os.path.join(self.tmp_dir, "cw", folder)
+        ann_dir = os.path.join(self.tmp_dir, "ann", folder)
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+        try:
+            results = read_and_clean_folder(sorted(os.listdir(clueweb_dir)), sorted(os.listdir(ann_dir)),
+                                            clueweb_dir, ann_dir, 2, metrics, MetricsWriter(metrics, None),
+                                            fingerprint_store=store)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        return [[record['record_id'] for record in records] for records in results]
+
+    def test_duplicates_are_not_cleaned(self):
+        self.write_file("f1", "f1-00", {2: "clueweb12-f1-00-00000"})
+        self.write_file("f1", "f1-01", {1: "clueweb12-f1-00-00003"})
+        self.write_file("f2", "f2-00", {0: "clueweb12-f1-00-00004", 3: "clueweb12-f2-00-00001"})
+        store = FingerprintStore(near_duplicates=True)
+        metrics = Metrics()
+
+        cleaned = self.read_and_clean("f1", store, metrics)
+        self.assertNotIn("clueweb12-f1-00-00002", cleaned[0])
+        self.assertNotIn("clueweb12-f1-01-00001", cleaned[1])
+        self.assertEqual(sorted(store.duplicates), [("clueweb12-f1-00-00002", "clueweb12-f1-00-00000"),
+                                                    ("clueweb12-f1-01-00001", "clueweb12-f1-00-00003")])
+        del store.duplicates[:]
+
+        cleaned = self.read_and_clean("f2", store, metrics)
+        self.assertEqual(cleaned[0], ["clueweb12-f2-00-00001", "clueweb12-f2-00-00002", "clueweb12-f2-00-00004"])
+        self.assertEqual(sorted(store.duplicates), [("clueweb12-f2-00-00000", "clueweb12-f1-00-00004"),
+                                                    ("clueweb12-f2-00-00003", "clueweb12-f2-00-00001")])
+        self.assertEqual(sum(metrics.counters['duplicates'].values()), 4)
+        self.assertEqual(sum(metrics.counters['duplicates_skipped'].values()), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
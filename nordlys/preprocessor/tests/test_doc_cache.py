@@ -0,0 +1,97 @@
+"""
+Tests for the size-bounded LRU cache and the cached index wrapper.
+
+@author: Tino Hakim Lazreg
+"""
+
+import unittest
+
+from nordlys.preprocessor.doc_cache import CachedIndex, LRUCache, estimate_size
+
+VALUE = "x" * 100
+
+
+class CountingIndex(object):
+    """Index stand-in that counts the calls made to it."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def get_doc_termfreqs(self, lucene_doc_id, field):
+        self.calls += 1
+        return {"term": lucene_doc_id}
+
+    def get_lucene_document_id(self, doc_id):
+        self.calls += 1
+        return int(doc_id)
+
+    def num_docs(self):
+        return 10
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def setUp(self):
+        self.size = estimate_size(VALUE)
+        self.cache = LRUCache(3 * self.size)
+
+    def test_evicts_least_recently_used(self):
+        for key in ["a", "b", "c"]:
+            self.cache.put(key, VALUE)
+        self.assertEqual(self.cache.get("a"), VALUE)
+        self.cache.put("d", VALUE)
+        self.assertNotIn("b", self.cache)
+        self.assertEqual(sorted(self.cache.items), ["a", "c", "d"])
+        self.assertEqual(self.cache.size, 3 * self.size)
+        self.assertEqual(self.cache.evictions, 1)
+
+    def test_replace(self):
+        self.cache.put("a", VALUE)
+        self.cache.put("a", VALUE)
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual(self.cache.size, self.size)
+
+    def test_too_large(self):
+        self.cache.put("a", "x" * (4 * self.size))
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.cache.size, 0)
+
+    def test_stats(self):
+        self.cache.put("a", VALUE)
+        self.cache.get("a")
+        self.assertIsNone(self.cache.get("b"))
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['hit_rate']), (1, 1, 0.5))
+        self.cache.reset_stats()
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions'], stats['items']), (0, 0, 0, 1))
+
+    def test_no_eviction(self):
+        self.cache.evict = False
+        for key in ["a", "b", "c"]:
+            self.cache.put(key, VALUE)
+        self.assertFalse(self.cache.full)
+        self.cache.put("d", VALUE)
+        self.assertTrue(self.cache.is_full())
+        self.assertEqual(sorted(self.cache.items), ["a", "b", "c"])
+        self.assertEqual(self.cache.evictions, 0)
+
+
+class TestCachedIndex(unittest.TestCase):
+
+    def test_caches_calls(self):
+        index = CountingIndex()
+        cached = CachedIndex(index, LRUCache(2 ** 20))
+        self.assertEqual(cached.get_doc_termfreqs(3, "body"), {"term": 3})
+        self.assertEqual(cached.get_doc_termfreqs(3, "body"), {"term": 3})
+        self.assertEqual(index.calls, 1)
+        self.assertEqual(cached.get_lucene_document_id("7"), 7)
+        self.assertEqual(index.calls, 2)
+        self.assertEqual(cached.cache.stats()['hits'], 1)
+
+    def test_passes_other_calls(self):
+        self.assertEqual(CachedIndex(CountingIndex(), LRUCache(2 ** 20)).num_docs(), 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
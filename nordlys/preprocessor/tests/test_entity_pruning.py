@@ -0,0 +1,82 @@
+"""
+Tests for the static pruning of document-entity associations, and the settings of the pruning benchmark.
+
+@author: Tino Hakim Lazreg
+"""
+
+import random
+import unittest
+
+import numpy as np
+
+from nordlys.preprocessor.benchmark_pruning import parse_setting
+from nordlys.preprocessor.entity_pruning import is_pruning, normalize_pruning, prune_entities, prune_mask
+
+ENTITY_SCORES = [(3, 0.1), (1, 0.4), (2, 0.2), (4, 0.2), (5, 0.1)]
+
+
+class TestSettings(unittest.TestCase):
+
+    def test_is_pruning(self):
+        self.assertFalse(is_pruning())
+        self.assertFalse(is_pruning(0, 1.0))
+        self.assertTrue(is_pruning(10))
+        self.assertTrue(is_pruning(mass=0.9))
+
+    def test_normalize_pruning(self):
+        self.assertEqual(normalize_pruning(0, 1.0), (None, None))
+        self.assertEqual(normalize_pruning(10, 0.9), (10, 0.9))
+
+    def test_parse_setting(self):
+        self.assertEqual(parse_setting("none"), (None, None))
+        self.assertEqual(parse_setting("top_n=50"), (50, None))
+        self.assertEqual(parse_setting("top_n=50,mass=0.9"), (50, 0.9))
+        self.assertRaises(ValueError, parse_setting, "depth=2")
+
+
+class TestPruneEntities(unittest.TestCase):
+
+    def test_no_pruning(self):
+        self.assertEqual(prune_entities(ENTITY_SCORES), [(1, 0.4), (2, 0.2), (4, 0.2), (3, 0.1), (5, 0.1)])
+
+    def test_top_n_ties_by_entity_id(self):
+        self.assertEqual(prune_entities(ENTITY_SCORES, top_n=2), [(1, 0.4), (2, 0.2)])
+
+    def test_mass(self):
+        # 0.4 + 0.2 + 0.2 = 0.8 of the total p(e|d)
+        self.assertEqual(prune_entities(ENTITY_SCORES, mass=0.8), [(1, 0.4), (2, 0.2), (4, 0.2)])
+        self.assertEqual(prune_entities(ENTITY_SCORES, mass=0.1), [(1, 0.4)])
+
+    def test_mass_of_top_n(self):
+        # The mass is a fraction of the entities kept by top_n
+        self.assertEqual(prune_entities(ENTITY_SCORES, top_n=3, mass=0.75), [(1, 0.4), (2, 0.2)])
+
+
+class TestPruneMask(unittest.TestCase):
+
+    def test_same_as_prune_entities(self):
+        rng = random.Random(1)
+        docs = []
+        for doc_no in range(50):
+            entity_ids = rng.sample(range(100), rng.randint(1, 30))
+            # Few distinct scores, so there are many ties
+            scores = [rng.randint(1, 5) / 10.0 for _ in entity_ids]
+            docs.append(zip(entity_ids, scores))
+        doc_index = np.array([doc_no for doc_no, doc in enumerate(docs) for _ in doc])
+        entity_ids = np.array([entity_id for doc in docs for entity_id, _ in doc])
+        scores = np.array([score for doc in docs for _, score in doc])
+
+        for top_n, mass in [(None, None), (5, None), (None, 0.5), (None, 0.9), (10, 0.75)]:
+            keep = prune_mask(doc_index, entity_ids, scores, top_n, mass)
+            for doc_no, doc in enumerate(docs):
+                kept = set(entity_ids[keep & (doc_index == doc_no)])
+                expected = set(entity_id for entity_id, _ in prune_entities(doc, top_n, mass))
+                self.assertEqual(kept, expected, (doc_no, top_n, mass))
+
+    def test_empty(self):
+        empty = np.array([], dtype=int)
+        self.assertEqual(len(prune_mask(empty, empty, np.array([]), top_n=5)), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
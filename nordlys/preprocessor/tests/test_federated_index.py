@@ -0,0 +1,98 @@
+"""
+Tests that a federated index of shards ranks like the index merged from the shards.
+
+@author: Tino Hakim Lazreg
+"""
+
+import shutil
+import tempfile
+import unittest
+
+from nordlys.preprocessor.federated_index import SIMILARITY_DIRICHLET, FederatedIndex, get_lucene_doc_length
+from nordlys.preprocessor.memory_index import MemoryIndex
+from nordlys.preprocessor.numpy_index import NumpyIndex, NumpyIndexBuilder
+from nordlys.preprocessor.synthetic_data import SyntheticCorpusGenerator
+
+FIELD = "contents"
+NUM_SHARDS = 3
+
+
+def build_numpy_index(corpus, index_dir):
+    builder = NumpyIndexBuilder()
+    for doc_id, fields in corpus:
+        builder.add_document(doc_id, fields)
+    builder.build(index_dir)
+    return NumpyIndex(index_dir)
+
+
+class TestFederatedIndex(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        generator = SyntheticCorpusGenerator(num_terms=500, num_entities=200)
+        # Short documents, so that many documents have equal scores
+        cls.corpus = generator.generate_corpus(600, 8, 2)
+        # A term that only occurs in the last shard
+        cls.corpus[-1][1][FIELD].append("rareterm")
+        cls.queries = [query for _, query in generator.generate_queries(20)]
+        cls.queries.append("rareterm " + cls.corpus[0][1][FIELD][0])
+        size = len(cls.corpus) // NUM_SHARDS + 1
+        cls.shard_corpora = [cls.corpus[i:i + size] for i in range(0, len(cls.corpus), size)]
+        cls.tmp_dir = tempfile.mkdtemp()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_dir)
+
+    def assert_same_ranking(self, merged, federated, num_docs):
+        offsets = [sum(len(corpus) for corpus in self.shard_corpora[:i]) for i in range(len(self.shard_corpora))]
+        for query in self.queries:
+            expected = merged.score_query(query, FIELD, num_docs=num_docs)
+            results = federated.score_query(query, FIELD, num_docs=num_docs)
+            self.assertEqual(dict(results.get_scores_sorted()), dict(expected.get_scores_sorted()), query)
+            for doc_id, _ in results.get_scores_sorted():
+                shard_no, lucene_doc_id = results.get_doc_id_int(doc_id)
+                self.assertEqual(offsets[shard_no] + lucene_doc_id, expected.get_doc_id_int(doc_id))
+
+    def test_memory_shards(self):
+        merged = MemoryIndex(self.corpus)
+        federated = FederatedIndex([MemoryIndex(corpus) for corpus in self.shard_corpora],
+                                   similarity=SIMILARITY_DIRICHLET)
+        try:
+            for num_docs in (5, 20, 1000):
+                self.assert_same_ranking(merged, federated, num_docs)
+        finally:
+            federated.close_reader()
+
+    def test_numpy_shards(self):
+        merged = build_numpy_index(self.corpus, self.tmp_dir + "/merged")
+        shards = [build_numpy_index(corpus, self.tmp_dir + "/shard%d" % i)
+                  for i, corpus in enumerate(self.shard_corpora)]
+        federated = FederatedIndex(shards, similarity=SIMILARITY_DIRICHLET)
+        try:
+            for num_docs in (5, 20, 1000):
+                self.assert_same_ranking(merged, federated, num_docs)
+        finally:
+            federated.close_reader()
+
+    def test_collection_statistics(self):
+        federated = FederatedIndex([MemoryIndex(corpus) for corpus in self.shard_corpora])
+        merged = MemoryIndex(self.corpus)
+        term = self.corpus[0][1][FIELD][0]
+        self.assertEqual(federated.num_docs(), merged.num_docs())
+        self.assertEqual(federated.get_coll_length(FIELD), merged.get_coll_length(FIELD))
+        self.assertEqual(federated.get_coll_termfreq(term, FIELD), merged.get_coll_termfreq(term, FIELD))
+        self.assertEqual(federated.get_doc_freq(term, FIELD), merged.get_doc_freq(term, FIELD))
+        location = federated.get_lucene_document_id(self.corpus[-1][0])
+        self.assertEqual(location, (len(self.shard_corpora) - 1, len(self.shard_corpora[-1]) - 1))
+        self.assertEqual(federated.get_doc_id(location), self.corpus[-1][0])
+
+    def test_lucene_doc_length(self):
+        # Lengths that fit the 3 mantissa bits of the norm are exact
+        for length in (1, 4, 16, 64):
+            self.assertAlmostEqual(get_lucene_doc_length(length), length)
+        self.assertAlmostEqual(get_lucene_doc_length(100), 113.77777, places=4)
+
+
+if __name__ == '__main__':
+    unittest.main()
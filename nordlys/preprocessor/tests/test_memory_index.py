@@ -0,0 +1,40 @@
+"""
+Tests for the first-pass retrieval of the in-memory index.
+
+@author: Tino Hakim Lazreg
+"""
+
+import unittest
+
+from nordlys.preprocessor.memory_index import MemoryIndex
+
+CORPUS = [("d0", {"contents": ["a", "b", "c"]}),
+          ("d1", {"contents": ["a", "a", "b"]}),
+          ("d2", {"contents": ["a", "a", "b"]}),
+          ("d3", {"contents": ["c", "d"]}),
+          ("d4", {"contents": ["a", "a", "b"]})]
+
+
+class TestScoreQuery(unittest.TestCase):
+
+    def setUp(self):
+        self.index = MemoryIndex(CORPUS, mu=10)
+
+    def test_candidates(self):
+        results = self.index.score_query("a", "contents", num_docs=10)
+        self.assertEqual(sorted(doc_id for doc_id, _ in results.get_scores_sorted()), ["d0", "d1", "d2", "d4"])
+
+    def test_ties_by_lowest_doc_id(self):
+        # d1, d2 and d4 have the same score, and the highest
+        results = self.index.score_query("a", "contents", num_docs=2)
+        self.assertEqual(sorted(doc_id for doc_id, _ in results.get_scores_sorted()), ["d1", "d2"])
+        self.assertEqual(results.get_doc_id_int("d2"), 2)
+
+    def test_scores(self):
+        results = dict(self.index.score_query("a c", "contents", num_docs=10).get_scores_sorted())
+        self.assertGreater(results["d0"], results["d1"])
+        self.assertEqual(results["d1"], results["d4"])
+
+
+if __name__ == '__main__':
+    unittest.main()
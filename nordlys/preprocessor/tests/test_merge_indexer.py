@@ -0,0 +1,91 @@
+"""
+Tests for the tree merge plan and the cleanup of intermediate indexes.
+
+@author: Tino Hakim Lazreg
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from nordlys.preprocessor import merge_indexer
+
+
+class FakeProcess(object):
+    """A finished sub-merge process."""
+
+    def __init__(self, returncode=0):
+        self.returncode = returncode
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        return self.returncode
+
+
+def fake_start_merge(output_dir, inputs, work_dir, max_segments):
+    """Writes an index with a segments file, instead of merging with Lucene."""
+    for input_dir in inputs:
+        if not merge_indexer.is_index(input_dir):
+            raise IOError("missing index " + input_dir)
+    staging_dir = os.path.join(work_dir, "staging", os.path.relpath(output_dir, work_dir).replace(os.sep, "_"))
+    os.makedirs(staging_dir)
+    os.makedirs(output_dir)
+    open(os.path.join(output_dir, "segments_1"), "w").close()
+    return FakeProcess(), staging_dir
+
+
+class TestPlanMerges(unittest.TestCase):
+
+    def test_uneven_fan_in(self):
+        indexes = ["a", "b", "c", "d", "e", "f"]
+        levels = merge_indexer.plan_merges(indexes, "merged", "work", 2)
+        l1 = [os.path.join("work", "level1", "merge%04d" % i) for i in range(3)]
+        l2 = os.path.join("work", "level2", "merge0000")
+        self.assertEqual(levels, [[(l1[0], ["a", "b"]), (l1[1], ["c", "d"]), (l1[2], ["e", "f"])],
+                                  [(l2, [l1[0], l1[1]])],
+                                  [("merged", [l2, l1[2]])]])
+        # The carried-up level 1 index is only deleted by the final merge
+        self.assertEqual(merge_indexer.plan_cleanup(levels), [[], [l1[0], l1[1]], [l2, l1[2]]])
+
+    def test_single_index(self):
+        self.assertEqual(merge_indexer.plan_merges(["a"], "merged", "work", 2), [[("merged", ["a"])]])
+        self.assertEqual(merge_indexer.plan_cleanup([[("merged", ["a"])]]), [[]])
+
+
+class TestTreeMerge(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.index_dir = os.path.join(self.tmp_dir, "indexes")
+        for name in ["a", "b", "c", "d", "e", "f"]:
+            os.makedirs(os.path.join(self.index_dir, name))
+            open(os.path.join(self.index_dir, name, "segments_1"), "w").close()
+        self.merged_index_dir = os.path.join(self.tmp_dir, "merged")
+        self.work_dir = os.path.join(self.tmp_dir, "work")
+        self.start_merge = merge_indexer._start_merge
+        merge_indexer._start_merge = fake_start_merge
+
+    def tearDown(self):
+        merge_indexer._start_merge = self.start_merge
+        shutil.rmtree(self.tmp_dir)
+
+    def test_uneven_fan_in(self):
+        merge_indexer.tree_merge(self.index_dir, self.merged_index_dir, self.work_dir, fan_in=2, num_processes=4)
+        self.assertTrue(merge_indexer.is_index(self.merged_index_dir))
+        checkpoint = merge_indexer.load_checkpoint(os.path.join(self.work_dir, merge_indexer.CHECKPOINT_FILE))
+        intermediate = [output_dir for output_dir in checkpoint if output_dir != self.merged_index_dir]
+        self.assertEqual(len(intermediate), 4)
+        for output_dir in intermediate:
+            self.assertTrue(checkpoint[output_dir]['deleted'])
+            self.assertFalse(os.path.exists(output_dir))
+
+        # Resuming a finished merge does not redo or miss anything
+        merge_indexer.tree_merge(self.index_dir, self.merged_index_dir, self.work_dir, fan_in=2, num_processes=4)
+        self.assertTrue(merge_indexer.is_index(self.merged_index_dir))
+
+
+if __name__ == '__main__':
+    unittest.main()
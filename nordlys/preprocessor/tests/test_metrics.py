@@ -0,0 +1,120 @@
+"""
+Tests for the pipeline metrics.
+
+@author: Tino Hakim Lazreg
+"""
+
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+from nordlys.preprocessor.metrics import Metrics, MetricsWriter, percentile
+
+
+class TestPercentile(unittest.TestCase):
+
+    def test_nearest_rank(self):
+        values = range(1, 101)
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile(values, 100), 100)
+        self.assertEqual(percentile(values, 0), 1)
+
+    def test_small_lists(self):
+        self.assertEqual(percentile([3, 1, 2], 50), 2)
+        self.assertEqual(percentile([3, 1, 2], 99), 3)
+        self.assertEqual(percentile([7], 99), 7)
+        self.assertIsNone(percentile([], 50))
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = Metrics()
+        self.metrics.incr("records")
+        self.metrics.incr("records", 2)
+        self.metrics.incr("records", label="utf-8")
+        self.metrics.add_time("clean", 0.5)
+        self.metrics.add_time("clean", 1.5)
+
+    def test_incr_and_add_time(self):
+        self.assertEqual(self.metrics.counters, {"records": {"": 3, "utf-8": 1}})
+        self.assertEqual(self.metrics.timers, {"clean": {"": [2, 2.0]}})
+
+    def test_merge(self):
+        other = Metrics()
+        other.incr("records", label="utf-8")
+        other.incr("skipped")
+        other.add_time("clean", 1.0)
+        other.add_time("read", 0.25, label="gz")
+        # A snapshot, as returned by a worker process, merges like the object itself
+        self.metrics.merge(other.snapshot())
+        self.metrics.merge(other)
+        self.metrics.merge(None)
+        self.assertEqual(self.metrics.counters, {"records": {"": 3, "utf-8": 3}, "skipped": {"": 2}})
+        self.assertEqual(self.metrics.timers, {"clean": {"": [4, 4.0]}, "read": {"gz": [2, 0.5]}})
+
+    def test_snapshot_is_a_copy(self):
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(pickle.loads(pickle.dumps(snapshot)), snapshot)
+        self.assertEqual(json.loads(json.dumps(snapshot)), snapshot)
+        self.metrics.incr("records")
+        self.metrics.add_time("clean", 1.0)
+        self.assertEqual(snapshot['counters']["records"][""], 3)
+        self.assertEqual(snapshot['timers']["clean"][""], [2, 2.0])
+
+    def test_to_prometheus(self):
+        self.metrics.incr("records", label='a"b')
+        self.assertEqual(self.metrics.to_prometheus(prefix="p").splitlines(),
+                         ['# TYPE p_records_total counter',
+                          'p_records_total 3',
+                          'p_records_total{label="a\\"b"} 1',
+                          'p_records_total{label="utf-8"} 1',
+                          '# TYPE p_clean_seconds summary',
+                          'p_clean_seconds_count 2',
+                          'p_clean_seconds_sum 2.0'])
+
+
+class TestMetricsWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "metrics.json")
+        self.metrics = Metrics()
+        self.metrics.incr("records")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_write_formats(self):
+        self.metrics.write(self.path)
+        with open(self.path) as f:
+            self.assertEqual(json.load(f), self.metrics.snapshot())
+        self.metrics.write(self.path, fmt="prometheus")
+        with open(self.path) as f:
+            self.assertEqual(f.read(), self.metrics.to_prometheus())
+        self.assertFalse(os.path.exists(self.path + ".tmp"))
+
+    def test_interval(self):
+        writer = MetricsWriter(self.metrics, self.path, interval=3600)
+        writer.maybe_write()
+        self.metrics.incr("records")
+        writer.maybe_write()
+        with open(self.path) as f:
+            self.assertEqual(json.load(f)['counters']["records"][""], 1)
+        writer.write()
+        with open(self.path) as f:
+            self.assertEqual(json.load(f)['counters']["records"][""], 2)
+
+    def test_disabled(self):
+        writer = MetricsWriter(self.metrics, None, interval=0)
+        writer.maybe_write()
+        writer.write()
+        self.assertEqual(os.listdir(self.tmp_dir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
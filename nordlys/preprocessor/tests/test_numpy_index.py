@@ -0,0 +1,116 @@
+"""
+Tests for building and scoring a NumPy index.
+
+@author: Tino Hakim Lazreg
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+from nordlys.preprocessor.indexer import read_and_clean_files
+from nordlys.preprocessor.memory_index import MemoryIndex
+from nordlys.preprocessor.numpy_index import NumpyIndex, NumpyIndexBuilder, build_from_clueweb
+from nordlys.preprocessor.synthetic_data import SyntheticCorpusGenerator, SyntheticWarcGenerator
+
+FIELD = "contents"
+
+
+class TestNumpyIndex(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        generator = SyntheticCorpusGenerator(num_terms=500, num_entities=200)
+        cls.corpus = generator.generate_corpus(300, 8, 2)
+        # Documents with equal scores for the query "tie"
+        for doc_no in (250, 40, 120, 7):
+            cls.corpus[doc_no][1][FIELD] = ["tie", "filler", "filler"]
+        cls.queries = [query for _, query in generator.generate_queries(20)]
+        cls.index_dir = tempfile.mkdtemp()
+        builder = NumpyIndexBuilder()
+        for doc_id, fields in cls.corpus:
+            builder.add_document(doc_id, fields)
+        builder.build(cls.index_dir)
+        cls.index = NumpyIndex(cls.index_dir)
+        cls.memory_index = MemoryIndex(cls.corpus)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.index_dir)
+
+    def test_statistics(self):
+        term = self.corpus[0][1][FIELD][0]
+        self.assertEqual(self.index.num_docs(), len(self.corpus))
+        self.assertEqual(self.index.get_coll_length(FIELD), self.memory_index.get_coll_length(FIELD))
+        self.assertEqual(self.index.get_coll_termfreq(term, FIELD), self.memory_index.get_coll_termfreq(term, FIELD))
+        self.assertEqual(self.index.get_doc_freq(term, FIELD), self.memory_index.get_doc_freq(term, FIELD))
+        self.assertEqual(self.index.get_doc_freq("unknownterm", FIELD), 0)
+        doc_id = self.corpus[5][0]
+        self.assertEqual(self.index.get_lucene_document_id(doc_id), 5)
+        self.assertEqual(self.index.get_doc_termfreqs(5, FIELD), self.memory_index.get_doc_termfreqs(5, FIELD))
+        self.assertRaises(KeyError, self.index.get_lucene_document_id, "clueweb12-unknown")
+
+    def test_scores_like_memory_index(self):
+        for query in self.queries:
+            expected = dict(self.memory_index.score_query(query, FIELD, num_docs=10).get_scores_sorted())
+            scores = dict(self.index.score_query(query, FIELD, num_docs=10).get_scores_sorted())
+            self.assertEqual(sorted(scores), sorted(expected), query)
+            for doc_id, score in scores.iteritems():
+                self.assertAlmostEqual(score, expected[doc_id], places=9)
+
+    def test_ties_by_lowest_doc_no(self):
+        doc_nos, scores = self.index.score_dirichlet(["tie"], FIELD, num_docs=2)
+        self.assertEqual(doc_nos.tolist(), [7, 40])
+        self.assertEqual(scores[0], scores[1])
+
+
+class TestBuildFromClueweb(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.clueweb_dir = os.path.join(self.tmp_dir, "cw")
+        self.ann_dir = os.path.join(self.tmp_dir, "ann")
+        generator = SyntheticWarcGenerator(page_size=2000, non_utf8_ratio=0, offset_bug_ratio=0)
+        generator.rng = random.Random(5)
+        for folder in ("0000tw", "0001tw"):
+            generator.generate_folder(self.clueweb_dir, self.ann_dir, 3, 4, folder)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_same_as_cleaned_records(self):
+        index_dir = os.path.join(self.tmp_dir, "index")
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+        try:
+            build_from_clueweb(self.clueweb_dir, self.ann_dir, index_dir, 2)
+            builder = NumpyIndexBuilder()
+            for folder in sorted(os.listdir(self.clueweb_dir)):
+                for file_no in range(3):
+                    file_id = folder + "-%02d" % file_no
+                    records, _ = read_and_clean_files(file_id + ".warc.gz", file_id + ".anns.tsv",
+                                                      os.path.join(self.clueweb_dir, folder),
+                                                      os.path.join(self.ann_dir, folder))
+                    for record in records:
+                        builder.add_record(record)
+            builder.build(os.path.join(self.tmp_dir, "expected"))
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+        index = NumpyIndex(index_dir)
+        expected = NumpyIndex(os.path.join(self.tmp_dir, "expected"))
+        self.assertEqual(index.num_docs(), 24)
+        # Folders and files are added in order
+        self.assertEqual([index.get_doc_id(doc_no) for doc_no in range(24)], builder.doc_ids)
+        for field in (FIELD, "contents_annotated"):
+            self.assertEqual(index.get_coll_length(field), expected.get_coll_length(field))
+            for doc_no in range(24):
+                self.assertEqual(index.get_doc_termfreqs(doc_no, field), expected.get_doc_termfreqs(doc_no, field))
+
+
+if __name__ == '__main__':
+    unittest.main()
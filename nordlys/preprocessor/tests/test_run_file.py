@@ -0,0 +1,95 @@
+"""
+Tests for writing and resuming run files.
+
+@author: Tino Hakim Lazreg
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from nordlys.preprocessor.run_file import RunFileWriter, get_freebase_url, write_trec_format
+
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+
+class TestWriteTrecFormat(unittest.TestCase):
+
+    def test_freebase_url(self):
+        self.assertEqual(get_freebase_url("_m_0abc_d"), "<http://rdf.freebase.com/ns/m.0abc_d>")
+
+    def test_ranks(self):
+        out = StringIO()
+        write_trec_format("q1", 1, out, {("_m_1", "q1"): -2.0, ("_m_2", "q1"): -1.0, ("_m_3", "q1"): -3.0}, max_rank=2)
+        lines = [line.split("\t") for line in out.getvalue().splitlines()]
+        self.assertEqual([(fields[2], fields[3]) for fields in lines],
+                         [("<http://rdf.freebase.com/ns/m.2>", "1"), ("<http://rdf.freebase.com/ns/m.1>", "2")])
+
+
+class TestRunFileWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "run.txt")
+        self.candidates_path = os.path.join(self.tmp_dir, "candidates.tsv")
+        self.stdout = sys.stdout
+        sys.stdout = StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, q_ids, resume=False, finish=False):
+        writer = RunFileWriter(self.path, self.candidates_path, resume)
+        num_completed = writer.open()
+        for q_id in q_ids:
+            if not writer.is_completed(q_id):
+                writer.write_query(q_id, q_id + "\tQ0\te\t1\t0.5\t1\n", q_id + "\td\n")
+        if finish:
+            writer.finish()
+        else:
+            writer.close()
+        return num_completed
+
+    def test_resume(self):
+        self.write(["q1", "q2"])
+        # A partially written block of the next query
+        with open(self.path, "a") as f:
+            f.write("q3\tQ0\te")
+        self.assertEqual(self.write(["q1", "q2", "q3"], resume=True, finish=True), 2)
+        self.assertEqual(read(self.path), "".join(q + "\tQ0\te\t1\t0.5\t1\n" for q in ["q1", "q2", "q3"]))
+        self.assertEqual(read(self.candidates_path), "q1\td\nq2\td\nq3\td\n")
+
+    def test_finish_removes_progress(self):
+        self.write(["q1"])
+        self.assertTrue(os.path.exists(self.path + RunFileWriter.PROGRESS_EXT))
+        self.write(["q1", "q2"], resume=True, finish=True)
+        self.assertFalse(os.path.exists(self.path + RunFileWriter.PROGRESS_EXT))
+
+    def test_resume_without_progress(self):
+        self.write(["q1", "q2"], finish=True)
+        # The last query of the run file may be incomplete, so it is scored again
+        self.assertEqual(self.write(["q1", "q2"], resume=True), 1)
+        self.assertEqual(read(self.path).count("q2\t"), 1)
+
+    def test_no_resume_overwrites(self):
+        self.write(["q1", "q2"])
+        self.assertEqual(self.write(["q3"]), 0)
+        self.assertEqual(read(self.path), "q3\tQ0\te\t1\t0.5\t1\n")
+
+    def test_shorter_run_file_discards_progress(self):
+        self.write(["q1", "q2"])
+        with open(self.path, "w") as f:
+            f.write("")
+        self.assertEqual(self.write(["q1", "q2"], resume=True), 0)
+        self.assertEqual(read(self.path).count("\n"), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
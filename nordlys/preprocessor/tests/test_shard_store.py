@@ -0,0 +1,68 @@
+"""
+Tests for the packed storage of cleaned records.
+
+@author: Tino Hakim Lazreg
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from nordlys.preprocessor.shard_store import INDEX_EXT, ShardReader, ShardWriter, get_shard_path
+
+RECORDS = [{'record_id': "clueweb12-0000tw-00-%05d" % i,
+            'replaced_record': u"text of record %d with fb_m_0%d" % (i, i),
+            'cleaned_record': u"text of record %d with caf\xe9" % i,
+            'entities_record': "fb_m_0%d" % i} for i in (3, 0, 2, 1)]
+
+
+class TestShardStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "0000tw-00.shard")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_records(self, **kwargs):
+        with ShardWriter(self.path, **kwargs) as shard:
+            for record in RECORDS:
+                shard.write(record)
+
+    def test_iterate_in_shard_order(self):
+        # A buffer smaller than a record flushes after every record
+        self.write_records(buffer_size=1)
+        self.assertEqual(list(ShardReader(self.path)), RECORDS)
+
+    def test_get(self):
+        self.write_records()
+        reader = ShardReader(self.path)
+        for record in RECORDS:
+            self.assertEqual(reader.get(record['record_id']), record)
+        self.assertIsNone(reader.get("clueweb12-0000tw-00-00004"))
+        self.assertIsNone(reader.get(""))
+
+    def test_missing_entities_record(self):
+        with ShardWriter(self.path) as shard:
+            shard.write({'record_id': "r", 'replaced_record': u"a", 'cleaned_record': u"a"})
+        self.assertEqual(ShardReader(self.path).get("r")['entities_record'], "")
+
+    def test_interrupted_writer_leaves_no_shard(self):
+        try:
+            with ShardWriter(self.path) as shard:
+                shard.write(RECORDS[0])
+                raise IOError("interrupted")
+        except IOError:
+            pass
+        self.assertFalse(os.path.exists(self.path))
+        self.assertFalse(os.path.exists(self.path + INDEX_EXT))
+
+    def test_get_shard_path(self):
+        self.assertEqual(get_shard_path("out", "/data/0000tw/0000tw-00.warc.gz"),
+                         os.path.join("out", "0000tw-00.shard"))
+
+
+if __name__ == '__main__':
+    unittest.main()